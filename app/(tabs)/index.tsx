@@ -6,7 +6,7 @@ import { ActivityIndicator, Alert, Animated, Dimensions, FlatList, Image, Keyboa
 import { API_URL } from '../config/api';
 import { useCart } from '../context/CartContext';
 import { OrderItem, useOrders } from '../context/OrdersContext';
-import { getImageUrl } from '../utils/image';
+import { getImageUrl, getSrcsetUrl, ImageSrcset } from '../utils/image';
 import { checkServerHealth, getConnectionErrorMessage } from '../utils/serverCheck';
 import { FloatingChatButton } from '@/components/FloatingChatButton';
 import { loadFavorites, saveFavorites, toggleFavorite as toggleFavoriteUtil } from '../utils/favorites';
@@ -37,6 +37,7 @@ type Product = {
   old_price?: number;  // For discount logic
   unit?: string;  // Measurement unit (e.g., "шт", "г", "мл")
   variants?: Variant[];  // Variants with different prices
+  srcset?: ImageSrcset | null;  // Pre-generated image sizes from the server
 };
 
 // BannerImage component for handling banner images with error fallback
@@ -86,19 +87,15 @@ const BannerImage = ({ uri, width, height }: { uri: string; width: number; heigh
 };
 
 // ProductImage component for handling images with error fallback
-const ProductImage = ({ uri }: { uri: string }) => {
+const ProductImage = ({ uri, srcset }: { uri: string; srcset?: ImageSrcset | null }) => {
   const [error, setError] = useState(false);
   const { width } = Dimensions.get('window');
   
   // Вычисляем оптимальный размер для карточки товара (2 колонки)
   const cardImageWidth = Math.round((width - 40) / 2); // Ширина экрана минус отступы, делим на 2 колонки
   
-  // Clean the URI and get full URL with automatic optimization for local images
-  const validUri = uri ? getImageUrl(uri.trim(), {
-    width: cardImageWidth,
-    quality: 80,
-    format: 'webp' // WebP для лучшего сжатия
-  }) : getImageUrl(null);
+  // Для загруженных картинок берем готовый вариант нужного размера (WebP), иначе - оригинал
+  const validUri = uri ? getSrcsetUrl(srcset, uri.trim(), cardImageWidth) : getImageUrl(null);
 
   if (error) {
     // Fallback UI (Placeholder)
@@ -612,7 +609,7 @@ export default function Index() {
         }}
       >
         <View style={{ marginBottom: 5, borderRadius: 8, overflow: 'hidden', backgroundColor: '#f5f5f5', justifyContent: 'center', alignItems: 'center' }}>
-          <ProductImage uri={item.picture || item.image || item.image_url || ''} />
+          <ProductImage uri={item.picture || item.image || item.image_url || ''} srcset={item.srcset} />
           {safeBadge && (
             <View style={{ position: 'absolute', top: 5, left: 5, backgroundColor: 'black', paddingHorizontal: 8, paddingVertical: 4, borderRadius: 8 }}>
               <Text style={{ color: 'white', fontSize: 10, fontWeight: 'bold' }}>{safeBadge}</Text>
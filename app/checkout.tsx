@@ -2,7 +2,7 @@ import { FloatingChatButton } from '@/components/FloatingChatButton';
 import { Ionicons } from '@expo/vector-icons';
 import * as Linking from 'expo-linking';
 import { useRouter } from 'expo-router';
-import { useEffect, useState } from 'react';
+import { useEffect, useRef, useState } from 'react';
 import {
     ActivityIndicator,
     Alert,
@@ -39,6 +39,9 @@ export default function CheckoutScreen() {
   const { items, totalPrice, clearCart } = useCart();
   const { addOrder } = useOrders();
   const [successVisible, setSuccessVisible] = useState(false);
+  // Ключ идемпотентности: повторная отправка той же корзины (двойное нажатие,
+  // повтор после ошибки) возвращает уже созданный заказ, а не второй
+  const idempotencyRef = useRef<{ payload: string; key: string } | null>(null);
   const [isPending, setIsPending] = useState(false);
   const [currentOrderId, setCurrentOrderId] = useState<number | null>(null);
   const [pendingPurchaseItems, setPendingPurchaseItems] = useState<any[]>([]);
@@ -471,12 +474,21 @@ export default function CheckoutScreen() {
         payment_method: paymentMethod,
       };
 
+      const payload = JSON.stringify(orderData);
+      if (!idempotencyRef.current || idempotencyRef.current.payload !== payload) {
+        idempotencyRef.current = {
+          payload,
+          key: `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`,
+        };
+      }
+
       const response = await fetch(`${API_URL}/create_order`, {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          'Idempotency-Key': idempotencyRef.current.key,
         },
-        body: JSON.stringify(orderData),
+        body: payload,
       });
 
       // Check if response is ok before parsing
@@ -1,4 +1,4 @@
-import React, { createContext, ReactNode, useContext, useEffect, useState } from 'react';
+import React, { createContext, ReactNode, useContext, useEffect, useRef, useState } from 'react';
 import { API_URL } from '../config/api';
 import { checkServerHealth, getConnectionErrorMessage } from '../utils/serverCheck';
 
@@ -22,6 +22,7 @@ export interface Product {
   old_price?: number;  // For discount logic
   unit?: string;  // Measurement unit (e.g., "шт", "г", "мл")
   variants?: any;  // Variants with different prices (can be array or JSON string)
+  srcset?: Record<string, Record<string, string>> | null;  // Pre-generated image sizes: format -> width -> path
 }
 
 export type OrderItem = {
@@ -73,6 +74,8 @@ export const OrdersProvider = ({ children }: { children: ReactNode }) => {
   // --- PRODUCTS STATE ---
   const [products, setProducts] = useState<Product[]>([]);
   const [isLoading, setIsLoading] = useState(false);
+  // ETag последнего загруженного каталога: при обновлении сервер ответит 304, если каталог не менялся
+  const productsEtagRef = useRef<string | null>(null);
 
   const fetchProducts = async () => {
     try {
@@ -94,16 +97,26 @@ export const OrdersProvider = ({ children }: { children: ReactNode }) => {
       const controller = new AbortController();
       const timeoutId = setTimeout(() => controller.abort(), 10000); // 10 секунд timeout
       
+      const headers: Record<string, string> = {
+        'Accept': 'application/json',
+      };
+      if (productsEtagRef.current) {
+        headers['If-None-Match'] = productsEtagRef.current;
+      }
+      
       const response = await fetch(productsUrl, {
         method: 'GET',
-        headers: {
-          'Accept': 'application/json',
-        },
+        headers,
         signal: controller.signal,
       });
       
       clearTimeout(timeoutId);
       
+      if (response.status === 304) {
+        console.log("Products not modified, keeping current list");
+        return;
+      }
+      
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
@@ -123,6 +136,7 @@ export const OrdersProvider = ({ children }: { children: ReactNode }) => {
             variantsType: typeof data[0].variants
           });
         }
+        productsEtagRef.current = response.headers.get('ETag');
         setProducts(data);
       } else {
         console.warn("API returned non-array data, using empty array");
@@ -1,3 +1,4 @@
+import { PixelRatio } from 'react-native';
 import { API_URL } from '../config/api';
 
 /**
@@ -33,3 +34,26 @@ export const getImageUrl = (
   return `${baseUrl}/${cleanPath}`;
 };
 
+
+/** Карта готовых вариантов картинки с сервера: формат -> ширина -> путь */
+export type ImageSrcset = Record<string, Record<string, string>>;
+
+/**
+ * Выбирает из srcset готовый вариант под ширину на экране (с учетом плотности пикселей):
+ * наименьший, который не меньше нужного, иначе самый большой.
+ * Если вариантов нет (внешняя картинка), возвращает обычный URL картинки.
+ */
+export const getSrcsetUrl = (
+  srcset: ImageSrcset | null | undefined,
+  fallbackPath: string | null | undefined,
+  displayWidth: number,
+  format: 'webp' | 'jpg' = 'webp'
+) => {
+  const sizes = srcset?.[format] || (srcset ? Object.values(srcset)[0] : undefined);
+  if (!sizes) return getImageUrl(fallbackPath);
+
+  const target = PixelRatio.getPixelSizeForLayoutSize(displayWidth);
+  const widths = Object.keys(sizes).map(Number).sort((a, b) => a - b);
+  const width = widths.find((w) => w >= target) ?? widths[widths.length - 1];
+  return getImageUrl(sizes[String(width)]);
+};
@@ -0,0 +1,335 @@
+"""
+Кэш каталога товаров в памяти.
+
+GET /products отдает готовый снимок (snapshot) каталога: строки уже
+нормализованы (картинки, pack_sizes, variants), поэтому на запрос не
+выполняется ни SQL, ни json.loads. Эндпоинты записи патчат снимок после
+коммита своей транзакции (db.pool.after_commit) или сбрасывают его целиком
+после массового импорта; следующий запрос перечитывает каталог.
+
+Для каждой версии снимка один раз собирается готовое тело ответа (JSON
+и его gzip/brotli варианты) со строгим ETag, так что повторные запросы
+не сериализуют и не сжимают каталог заново.
+
+query_products() - постраничная выдача с фильтрами прямо из базы (keyset
+пагинация по индексам), ее стоимость зависит от размера страницы, а не каталога.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import logging
+import threading
+
+from db import pool
+from images import rendition_srcset
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен - без него отдаем gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+# Поля модели Product и колонки таблицы products, из которых они получаются
+PRODUCT_FIELDS = {
+    "id": ("id",),
+    "name": ("name",),
+    "price": ("price",),
+    "image": ("image",),
+    "picture": ("image",),
+    "image_url": ("image",),
+    "description": ("description",),
+    "category": ("category",),
+    "weight": ("weight",),
+    "composition": ("composition",),
+    "usage": ("usage",),
+    "pack_sizes": ("pack_sizes",),
+    "old_price": ("old_price",),
+    "unit": ("unit",),
+    "variants": ("variants",),
+    "srcset": ("image",),
+}
+
+# sort= -> (колонка, по убыванию); id всегда добавляется вторым ключом
+SORT_KEYS = {
+    "id": ("id", False),
+    "-id": ("id", True),
+    "price": ("price", False),
+    "-price": ("price", True),
+    "name": ("name", False),
+    "-name": ("name", True),
+}
+
+
+def normalize_product(row):
+    """Приводит строку таблицы products к формату API (модель Product)"""
+    item = dict(row)
+
+    # CSV импорт сохраняет image_url в колонку image, XML может использовать picture,
+    # а фронтенд ожидает picture - поэтому заполняем все три поля
+    image_value = item.get("image") or ""
+    if not item.get("image_url"):
+        item["image_url"] = image_value
+    if not item.get("picture"):
+        item["picture"] = item["image_url"] or image_value or None
+    item["image"] = image_value
+    # Готовые варианты картинки разных размеров (для загруженных в /uploads)
+    item["srcset"] = rendition_srcset(image_value)
+
+    pack_sizes_val = item.get("pack_sizes")
+    if pack_sizes_val and isinstance(pack_sizes_val, str):
+        item["pack_sizes"] = [x.strip() for x in pack_sizes_val.split(",") if x.strip()]
+    else:
+        item["pack_sizes"] = []
+
+    if not item.get("unit"):
+        item["unit"] = "шт"
+
+    variants_val = item.get("variants")
+    if variants_val and isinstance(variants_val, str):
+        try:
+            item["variants"] = json.loads(variants_val) or None
+        except Exception as e:
+            logger.warning(f"⚠️ Error parsing variants for product {item.get('id')}: {e}")
+            item["variants"] = None
+    else:
+        item["variants"] = variants_val or None
+
+    return item
+
+
+def parse_fields(fields):
+    """Разбирает fields=id,name,price; None - все поля"""
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in PRODUCT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(PRODUCT_FIELDS)}")
+    # id нужен клиенту всегда (ключ карточки)
+    return ["id"] + [f for f in dict.fromkeys(requested) if f != "id"]
+
+
+def encode_cursor(sort, value, product_id):
+    raw = json.dumps([sort, value, product_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, product_id = json.loads(raw)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort:
+        raise ValueError("Cursor was issued for a different sort order")
+    return value, product_id
+
+
+def query_products(conn, limit, cursor=None, category=None, min_price=None, max_price=None,
+                   sort="id", fields=None):
+    """
+    Одна страница каталога с фильтрами (keyset пагинация).
+    Возвращает {"items": [...], "next_cursor": str | None}; ValueError при неверных параметрах.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort: {sort}. Allowed: {', '.join(SORT_KEYS)}")
+    column, descending = SORT_KEYS[sort]
+    selected = parse_fields(fields) or list(PRODUCT_FIELDS)
+
+    columns = {"id", column}
+    for field in selected:
+        columns.update(PRODUCT_FIELDS[field])
+
+    where, params = [], []
+    if category:
+        where.append("category = ?")
+        params.append(category)
+    if min_price is not None:
+        where.append("price >= ?")
+        params.append(min_price)
+    if max_price is not None:
+        where.append("price <= ?")
+        params.append(max_price)
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort)
+        op = "<" if descending else ">"
+        if column == "id":
+            where.append(f"id {op} ?")
+            params.append(last_id)
+        else:
+            where.append(f"({column}, id) {op} (?, ?)")
+            params.extend([value, last_id])
+
+    direction = "DESC" if descending else "ASC"
+    order_by = f"id {direction}" if column == "id" else f"{column} {direction}, id {direction}"
+    sql = f"SELECT {', '.join(sorted(columns))} FROM products"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order_by} LIMIT ?"
+    rows = conn.execute(sql, params + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort, rows[-1][column], rows[-1]["id"])
+
+    items = []
+    for row in rows:
+        item = normalize_product(row)
+        items.append({f: item.get(f) for f in selected})
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def parse_accept_encoding(header):
+    """Возвращает множество кодировок из Accept-Encoding с q > 0"""
+    accepted = set()
+    for part in (header or "").split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            accepted.add(token)
+    return accepted
+
+
+class EncodedPayload:
+    """Сериализованный каталог: тело ответа в каждой кодировке и ETag"""
+
+    def __init__(self, body):
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+        # Разные content-coding - разные представления, поэтому и ETag у них разный
+        self.etags = {
+            encoding: f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"'
+            for encoding in self.bodies
+        }
+
+    def choose(self, accept_encoding):
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in self.bodies and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def matches(self, if_none_match):
+        """Слабое сравнение для If-None-Match: подходит ETag любого представления"""
+        if not if_none_match:
+            return False
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or bool(tags & set(self.etags.values()))
+
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога определенной версии"""
+
+    def __init__(self, version, products):
+        self.version = version
+        self.products = products
+        self.by_id = {p["id"]: p for p in products}
+        self._encoded = None
+        self._encode_lock = threading.Lock()
+
+    @property
+    def is_encoded(self):
+        return self._encoded is not None
+
+    def encoded(self, serialize):
+        """
+        Готовое тело ответа для этой версии (собирается один раз).
+        serialize(products) -> bytes приводит товары к модели ответа.
+        """
+        if self._encoded is None:
+            with self._encode_lock:
+                if self._encoded is None:
+                    self._encoded = EncodedPayload(serialize(self.products))
+                    logger.debug(
+                        f"📦 Каталог v{self.version} сериализован: "
+                        + ", ".join(f"{k}={len(v)}B" for k, v in self._encoded.bodies.items())
+                    )
+        return self._encoded
+
+
+class CatalogCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = 0
+        # Меняется при каждом изменении каталога, чтобы отбросить результат
+        # загрузки, начатой до изменения
+        self._generation = 0
+
+    @property
+    def version(self):
+        return self._version
+
+    def current(self):
+        return self._snapshot
+
+    def _store(self, products):
+        self._version += 1
+        self._snapshot = CatalogSnapshot(self._version, products)
+        return self._snapshot
+
+    def load(self, conn):
+        """Читает каталог из базы и сохраняет снимок (выполнять в потоке БД)"""
+        generation = self._generation
+        products = [normalize_product(row) for row in conn.execute("SELECT * FROM products ORDER BY id").fetchall()]
+        with self._lock:
+            if generation == self._generation:
+                snapshot = self._store(products)
+                logger.debug(f"📦 Каталог загружен в кэш: {len(products)} товаров, версия {snapshot.version}")
+                return snapshot
+        # Пока мы читали, каталог изменился - отдаем прочитанное, но не кэшируем
+        return CatalogSnapshot(self._version, products)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._snapshot = None
+
+    def _patch(self, upserted, deleted_ids):
+        with self._lock:
+            self._generation += 1
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+            changed = {p["id"]: p for p in upserted}
+            products = [changed.pop(p["id"], p) for p in snapshot.products if p["id"] not in deleted_ids]
+            products.extend(sorted(changed.values(), key=lambda p: p["id"]))
+            self._store(products)
+
+    def patch_after_commit(self, conn, product_ids=(), deleted_ids=()):
+        """
+        Перечитывает указанные товары внутри текущей транзакции и применяет их
+        к снимку после коммита. Товары, которых уже нет в базе, удаляются.
+        """
+        product_ids = list(product_ids)
+        upserted = []
+        if product_ids:
+            placeholders = ",".join("?" * len(product_ids))
+            rows = conn.execute(f"SELECT * FROM products WHERE id IN ({placeholders})", product_ids).fetchall()
+            upserted = [normalize_product(row) for row in rows]
+        found = {p["id"] for p in upserted}
+        deleted = set(deleted_ids) | {pid for pid in product_ids if pid not in found}
+        pool.after_commit(lambda: self._patch(upserted, deleted))
+
+    def invalidate_after_commit(self):
+        pool.after_commit(self.invalidate)
+
+
+catalog = CatalogCache()
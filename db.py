@@ -0,0 +1,337 @@
+"""
+Общий слой доступа к SQLite (shop.db).
+
+Каждый поток получает собственное долгоживущее соединение. PRAGMA
+(WAL, busy_timeout, synchronous=NORMAL) выставляются один раз при открытии
+соединения, а подготовленные выражения кэшируются самим sqlite3
+(параметр cached_statements), поэтому повторные запросы не компилируются заново.
+
+Асинхронные обработчики не должны трогать пул напрямую: для них есть
+AsyncDatabase, который выполняет запросы в отдельных потоках и не блокирует
+event loop.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv("DB_PATH", "shop.db")
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "16"))
+DB_LOCK_RETRIES = int(os.getenv("DB_LOCK_RETRIES", "5"))
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", "8"))
+# pid процесса сервера, которому принадлежит база (см. ConnectionPool.bind_process).
+# Дочерние процессы наследуют переменную и соединений не открывают
+DB_OWNER_PID_ENV = "DB_OWNER_PID"
+
+
+def _is_lock_error(error):
+    message = str(error).lower()
+    return "database is locked" in message or "database is busy" in message
+
+
+class ConnectionPool:
+    """
+    Пул соединений SQLite: одно соединение на поток, не более max_connections
+    одновременно выданных соединений и метрики ожидания/выдачи/повторов.
+    """
+
+    def __init__(self, path=DB_PATH, max_connections=DB_MAX_CONNECTIONS,
+                 busy_timeout_ms=DB_BUSY_TIMEOUT_MS, cached_statements=DB_STATEMENT_CACHE_SIZE,
+                 lock_retries=DB_LOCK_RETRIES):
+        self.path = path
+        self.max_connections = max_connections
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self.lock_retries = lock_retries
+
+        self._local = threading.local()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._wal_ready = False
+
+        self._checkouts = 0
+        self._in_use = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._lock_retries = 0
+        self._lock_failures = 0
+        self._opened = 0
+        self._refused = 0
+
+    def bind_process(self):
+        """
+        Закрепляет базу за текущим процессом (вызывается при старте сервера).
+        Процессы пула изображений (spawn) наследуют окружение, и попытка
+        открыть в них соединение - например, из-за повторного импорта main -
+        завершится RuntimeError, а не изменением базы.
+        """
+        os.environ[DB_OWNER_PID_ENV] = str(os.getpid())
+
+    def _connect(self):
+        owner = os.environ.get(DB_OWNER_PID_ENV)
+        if owner and owner != str(os.getpid()):
+            with self._lock:
+                self._refused += 1
+            raise RuntimeError(f"SQLite: процесс {os.getpid()} не владеет базой (владелец - процесс {owner})")
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            cached_statements=self.cached_statements,
+            # Соединение живет в одном потоке, флаг нужен только для
+            # закрытия соединений завершившихся потоков и close_all()
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        with self._lock:
+            # journal_mode=WAL хранится в самом файле базы, достаточно одного раза
+            if not self._wal_ready:
+                mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+                self._wal_ready = True
+                logger.info(f"✅ SQLite {self.path}: journal_mode={mode}")
+            self._prune_dead_threads()
+            self._connections[threading.current_thread()] = conn
+            self._opened += 1
+        return conn
+
+    def _prune_dead_threads(self):
+        # Потоки пула исполнителей периодически пересоздаются - не держим их соединения
+        for thread in [t for t in self._connections if not t.is_alive()]:
+            try:
+                self._connections.pop(thread).close()
+            except Exception:
+                pass
+
+    def _thread_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Выдает соединение текущего потока.
+
+        При выходе незавершенная транзакция фиксируется, а при исключении
+        откатывается, так что соединение всегда возвращается чистым.
+        Вложенные вызовы в одном потоке используют то же соединение.
+        """
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0:
+            started = time.perf_counter()
+            self._slots.acquire()
+            waited = time.perf_counter() - started
+            with self._lock:
+                self._checkouts += 1
+                self._in_use += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+        self._local.depth = depth + 1
+        try:
+            conn = self._thread_connection()
+            try:
+                yield conn
+            except BaseException:
+                if depth == 0 and conn.in_transaction:
+                    conn.rollback()
+                raise
+            else:
+                if depth == 0 and conn.in_transaction:
+                    conn.commit()
+        finally:
+            self._local.depth = depth
+            if depth == 0:
+                with self._lock:
+                    self._in_use -= 1
+                self._slots.release()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Явная транзакция записи (BEGIN IMMEDIATE).
+
+        Блокировку на запись берем сразу, а если база занята дольше
+        busy_timeout, повторяем попытку с экспоненциальной паузой.
+        """
+        with self.connection() as conn:
+            if conn.in_transaction:
+                # Уже внутри транзакции этого потока - просто присоединяемся к ней
+                yield conn
+                return
+            attempt = 0
+            while True:
+                try:
+                    conn.execute("BEGIN IMMEDIATE")
+                    break
+                except sqlite3.OperationalError as e:
+                    if not _is_lock_error(e) or attempt >= self.lock_retries:
+                        if _is_lock_error(e):
+                            with self._lock:
+                                self._lock_failures += 1
+                        raise
+                    attempt += 1
+                    with self._lock:
+                        self._lock_retries += 1
+                    logger.warning(f"⏳ База занята, повтор {attempt}/{self.lock_retries}")
+                    time.sleep(min(0.05 * 2 ** attempt, 1.0))
+            self._local.after_commit = []
+            try:
+                yield conn
+            except BaseException:
+                self._local.after_commit = None
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+                callbacks, self._local.after_commit = self._local.after_commit, None
+                for callback in callbacks:
+                    try:
+                        callback()
+                    except Exception as e:
+                        logger.error(f"⚠️ Ошибка в after_commit callback: {e}")
+
+    def after_commit(self, callback):
+        """
+        Вызывает callback после успешного коммита текущей транзакции потока
+        (при откате он отбрасывается). Вне транзакции вызывается сразу.
+        """
+        callbacks = getattr(self._local, "after_commit", None)
+        if callbacks is None:
+            callback()
+        else:
+            callbacks.append(callback)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "path": self.path,
+                "max_connections": self.max_connections,
+                "open_connections": len(self._connections),
+                "opened_total": self._opened,
+                "refused_total": self._refused,
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "wait_time_total_ms": round(self._wait_total * 1000, 3),
+                "wait_time_avg_ms": round(self._wait_total * 1000 / self._checkouts, 3) if self._checkouts else 0.0,
+                "wait_time_max_ms": round(self._wait_max * 1000, 3),
+                "lock_retries": self._lock_retries,
+                "lock_failures": self._lock_failures,
+            }
+
+    def close_all(self):
+        with self._lock:
+            connections, self._connections = list(self._connections.values()), {}
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self._local = threading.local()
+
+
+class AsyncDatabase:
+    """
+    Асинхронный доступ к базе поверх ConnectionPool.
+
+    Чтения выполняются параллельно в ограниченном пуле потоков, а все записи
+    идут через единственный поток-писатель, то есть сериализуются в очереди
+    и не конкурируют друг с другом за блокировку SQLite.
+    """
+
+    def __init__(self, pool, read_workers=DB_READ_WORKERS):
+        self.pool = pool
+        self.read_workers = read_workers
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._lock = threading.Lock()
+        self._pending = {"read": 0, "write": 0}
+        self._totals = {"read": 0, "write": 0}
+
+    def _run_read(self, fn, args, kwargs):
+        with self.pool.connection() as conn:
+            return fn(conn, *args, **kwargs)
+
+    def _run_write(self, fn, args, kwargs):
+        with self.pool.transaction() as conn:
+            return fn(conn, *args, **kwargs)
+
+    async def _submit(self, executor, runner, kind, fn, args, kwargs):
+        with self._lock:
+            self._pending[kind] += 1
+            self._totals[kind] += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, partial(runner, fn, args, kwargs))
+        finally:
+            with self._lock:
+                self._pending[kind] -= 1
+
+    async def read(self, fn, *args, **kwargs):
+        """Выполняет fn(conn, *args) в пуле чтения и возвращает результат"""
+        return await self._submit(self._readers, self._run_read, "read", fn, args, kwargs)
+
+    async def write(self, fn, *args, **kwargs):
+        """Выполняет fn(conn, *args) в одной транзакции в потоке-писателе"""
+        return await self._submit(self._writer, self._run_write, "write", fn, args, kwargs)
+
+    def write_blocking(self, fn, *args, **kwargs):
+        """
+        То же, что write(), для обычных потоков (фоновые задачи): ставит fn в
+        очередь потока-писателя и ждет результата. Из event loop не вызывать.
+        """
+        with self._lock:
+            self._pending["write"] += 1
+            self._totals["write"] += 1
+        try:
+            return self._writer.submit(self._run_write, fn, args, kwargs).result()
+        finally:
+            with self._lock:
+                self._pending["write"] -= 1
+
+    async def fetch_all(self, sql, params=()):
+        return await self.read(lambda conn: [dict(row) for row in conn.execute(sql, params).fetchall()])
+
+    async def fetch_one(self, sql, params=()):
+        def _fetch(conn):
+            row = conn.execute(sql, params).fetchone()
+            return dict(row) if row is not None else None
+        return await self.read(_fetch)
+
+    async def execute(self, sql, params=()):
+        """Выполняет одиночную запись, возвращает (lastrowid, rowcount)"""
+        def _execute(conn):
+            cursor = conn.execute(sql, params)
+            return cursor.lastrowid, cursor.rowcount
+        return await self.write(_execute)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "read_workers": self.read_workers,
+                "reads_pending": self._pending["read"],
+                "writes_pending": self._pending["write"],
+                "reads_total": self._totals["read"],
+                "writes_total": self._totals["write"],
+            }
+
+    def shutdown(self):
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+
+
+pool = ConnectionPool()
+adb = AsyncDatabase(pool)
@@ -0,0 +1,168 @@
+"""
+Лента изменений заказов для админки (long-poll и Server-Sent Events).
+
+Каждое изменение заказа (создан, сменился статус) записывается в таблицу
+order_changes в той же транзакции, что и само изменение, и получает
+возрастающий номер seq - это курсор ленты: клиент спрашивает «что
+изменилось после seq N» и после переподключения или перезапуска сервера
+продолжает с того же места.
+
+После коммита шина внутри процесса будит ожидающих клиентов
+(asyncio.Event в цикле событий приложения). Между событиями открытые
+соединения просто ждут - запросы к базе идут только когда что-то
+изменилось (и раз в heartbeat, чтобы увидеть изменения, записанные другим
+процессом сервера).
+
+Порядок подписки важен: сначала subscribe(), потом чтение базы, потом
+wait() - тогда изменение, закоммиченное между чтением и ожиданием, не
+потеряется.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from db import pool
+
+logger = logging.getLogger(__name__)
+
+CHANGES_PAGE = 200
+CHANGES_RETENTION_DAYS = int(os.getenv("ORDER_CHANGES_RETENTION_DAYS", "7"))
+# Комментарий-пинг в SSE, чтобы прокси не закрывали тихое соединение
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))
+# Поток SSE закрывается сервером через это время, браузер переподключается
+# с Last-Event-ID: зависшие соединения не копятся и не держат остановку сервера
+SSE_MAX_AGE = float(os.getenv("SSE_MAX_AGE", "300"))
+
+CREATED, STATUS = "created", "status"
+
+ORDER_FIELDS = ("id", "name", "phone", "city", "warehouse", "total", "totalPrice", "status",
+                "payment_method", "date")
+
+
+class OrderChangeFeed:
+    def __init__(self, pool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self._loop = None
+        self._changed = None
+        self._closed = False
+        self._subscribers = 0
+        self._stats = {"recorded": 0, "notifications": 0, "served": 0}
+
+    def ensure_table(self, conn):
+        """Создает order_changes и чистит старые записи"""
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS order_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    status TEXT,
+                    created_at TEXT
+                )
+            ''')
+            cutoff = (datetime.now() - timedelta(days=CHANGES_RETENTION_DAYS)).isoformat(timespec="seconds")
+            conn.execute("DELETE FROM order_changes WHERE created_at < ?", (cutoff,))
+            conn.commit()
+            logger.info("✅ Таблица order_changes готова.")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка создания таблицы order_changes: {e}")
+
+    # --- Публикация ---
+
+    def record(self, conn, order_id, kind, status=None):
+        """Записывает изменение в текущей транзакции conn; клиенты узнают о нем после коммита"""
+        seq = conn.execute(
+            "INSERT INTO order_changes (order_id, kind, status, created_at) VALUES (?, ?, ?, ?)",
+            (order_id, kind, status, datetime.now().isoformat(timespec="seconds")),
+        ).lastrowid
+        self._stats["recorded"] += 1
+        self.pool.after_commit(self._notify)
+        return seq
+
+    def _notify(self):
+        # Вызывается из потока-писателя - будим ожидающих в цикле событий
+        with self._lock:
+            loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self._stats["notifications"] += 1
+        event, self._changed = self._changed, asyncio.Event()
+        if event is not None:
+            event.set()
+
+    # --- Чтение ---
+
+    def latest(self, conn):
+        """Текущий курсор ленты (seq последнего изменения)"""
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM order_changes").fetchone()[0]
+
+    def since(self, conn, cursor, limit=CHANGES_PAGE):
+        """
+        Изменения после cursor с текущим состоянием заказа (order = None, если
+        заказ удален). {"changes": [...], "cursor": int, "has_more": bool}
+        """
+        rows = conn.execute(f'''
+            SELECT c.seq, c.kind, c.order_id, c.status AS change_status, c.created_at,
+                   {", ".join(f"o.{field} AS o_{field}" for field in ORDER_FIELDS)}
+            FROM order_changes c LEFT JOIN orders o ON o.id = c.order_id
+            WHERE c.seq > ? ORDER BY c.seq LIMIT ?
+        ''', (cursor, limit + 1)).fetchall()
+        has_more = len(rows) > limit
+        changes = []
+        for row in rows[:limit]:
+            row = dict(row)
+            # Префикс o_, а не order_: o.id AS order_id совпал бы с c.order_id
+            order = {field: row.pop(f"o_{field}") for field in ORDER_FIELDS}
+            row["status"] = row.pop("change_status")
+            row["order"] = order if order["id"] is not None else None
+            changes.append(row)
+        self._stats["served"] += len(changes)
+        return {"changes": changes, "cursor": changes[-1]["seq"] if changes else cursor, "has_more": has_more}
+
+    def subscribe(self):
+        """Событие, которое сработает при следующем изменении (вызывать до чтения базы)"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._loop is not loop:
+                self._loop = loop
+                self._changed = asyncio.Event()
+        return self._changed
+
+    async def wait(self, event, timeout):
+        """Ждет изменения после subscribe(); False - по таймауту или при остановке сервера"""
+        if self._closed:
+            return False
+        self._subscribers += 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return not self._closed
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._subscribers -= 1
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def metrics(self):
+        return {"subscribers": self._subscribers, **self._stats}
+
+    def shutdown(self):
+        # Отпускаем открытые SSE / long-poll соединения, чтобы сервер не ждал их до таймаута
+        self._closed = True
+        self._notify()
+
+
+def format_sse(change):
+    """Изменение -> событие SSE (id = seq, по нему браузер продолжит после переподключения)"""
+    return f"id: {change['seq']}\nevent: order\ndata: {json.dumps(change, ensure_ascii=False)}\n\n"
+
+
+order_changes = OrderChangeFeed(pool)
@@ -0,0 +1,111 @@
+"""
+Потоковый экспорт заказов (xlsx, csv, ndjson) с постоянным расходом памяти.
+
+Заказы читаются пачками по EXPORT_CHUNK штук keyset-запросами
+orders.query_orders (по id, новые сверху) - каждая пачка в своем коротком
+чтении, без fetchall всей таблицы и без долгой транзакции. Позиции берутся
+из order_items, JSON не разбирается.
+
+- csv и ndjson отдаются клиенту по мере чтения пачек: первый байт уходит
+  сразу, в памяти одна пачка;
+- xlsx пишется openpyxl в режиме write_only: строки сбрасываются во
+  временный XML внутри книги, а не копятся в памяти, и файл собирается
+  на диске (для больших выгрузок - фоновой задачей).
+
+Фильтры - те же, что у /api/orders (период, статус, способ оплаты).
+"""
+import csv
+import io
+import json
+import logging
+
+from orders import query_orders
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK = 500
+
+# Формат -> (media type, имя файла)
+FORMATS = {
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "orders.xlsx"),
+    "csv": ("text/csv", "orders.csv"),
+    "ndjson": ("application/x-ndjson", "orders.ndjson"),
+}
+
+COLUMNS = ("id", "date", "name", "phone", "user_email", "city", "cityRef", "warehouse", "warehouseRef",
+           "items", "total", "totalPrice", "status", "payment_method", "payment_status", "invoiceId")
+
+
+def format_items(items):
+    """Позиции заказа одной строкой: "Название (вариант) x количество, ..." """
+    formatted = []
+    for item in items:
+        name = item.get("name") or "Товар"
+        if item.get("variant_info"):
+            formatted.append(f"{name} ({item['variant_info']}) x {item['quantity']}")
+        else:
+            formatted.append(f"{name} x {item['quantity']}")
+    return ", ".join(formatted)
+
+
+def iter_chunks(conn, **filters):
+    """Пачки заказов (списки dict с items) по EXPORT_CHUNK штук, новые сверху"""
+    cursor = None
+    while True:
+        orders, cursor = read_chunk(conn, cursor, **filters)
+        if orders:
+            yield orders
+        if cursor is None:
+            return
+
+
+def read_chunk(conn, cursor, **filters):
+    """Одна пачка для асинхронного экспорта: (заказы, курсор следующей пачки или None)"""
+    page = query_orders(conn, EXPORT_CHUNK, cursor=cursor, with_count=False, **filters)
+    return page["items"], page["next_cursor"]
+
+
+def _row(order):
+    return [format_items(order["items"]) if column == "items" else order.get(column) for column in COLUMNS]
+
+
+def _csv(rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+
+def csv_header():
+    # BOM - чтобы Excel открыл UTF-8 без мастера импорта
+    return "\ufeff" + _csv([COLUMNS])
+
+
+def csv_chunk(orders):
+    return _csv(_row(order) for order in orders)
+
+
+def ndjson_chunk(orders):
+    # Позиции в ndjson остаются структурой, а не строкой
+    return "".join(
+        json.dumps({**{column: order.get(column) for column in COLUMNS}, "items": order["items"]},
+                   ensure_ascii=False) + "\n"
+        for order in orders
+    )
+
+
+def write_xlsx(conn, path, progress=None, **filters):
+    """Пишет xlsx (openpyxl write_only) в path; возвращает число заказов"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Orders")
+    sheet.append(list(COLUMNS))
+    done = 0
+    for orders in iter_chunks(conn, **filters):
+        for order in orders:
+            sheet.append(_row(order))
+        done += len(orders)
+        if progress:
+            progress(done)
+    workbook.save(path)
+    return done
@@ -0,0 +1,268 @@
+"""
+Общие HTTP-клиенты для внешних сервисов (Новая Почта, Telegram, Monobank,
+скачивание XML прайсов).
+
+Для каждого сервиса (upstream) держится один httpx клиент со своим пулом
+соединений: keep-alive вместо нового TCP/TLS рукопожатия на каждый вызов,
+HTTP/2, если установлен пакет h2 (pip install httpx[http2]), и свои таймауты.
+Асинхронный клиент используется из обработчиков, синхронный - из фоновых
+потоков (обновление справочника, задачи импорта).
+
+Временные ошибки повторяются с экспоненциальной задержкой и случайным
+разбросом (full jitter). Ошибки соединения и 429 повторяются всегда - запрос
+до сервиса не дошел или отклонен до обработки; таймаут чтения и 502/503/504 -
+только для идемпотентных сервисов, чтобы не создать, например, два счета.
+По каждому сервису собираются метрики: число запросов, повторов, ошибок,
+коды ответов и задержки (среднее, p95, максимум).
+
+Асинхронный клиент привязан к циклу событий, в котором создан: при
+обращении из другого цикла создается новый, а прежний закрывается.
+Клиенты закрываются в обработчике shutdown (aclose / close).
+"""
+import asyncio
+import contextlib
+import importlib.util
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+RETRY_BASE_DELAY = 0.3
+RETRY_MAX_DELAY = 5.0
+# Сколько последних задержек хранится для p95
+LATENCY_WINDOW = 500
+
+# Ошибки, при которых запрос точно не обработан сервисом
+SAFE_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+# Ошибки, после которых запрос мог быть обработан (повтор - только для идемпотентных)
+UNSAFE_RETRY_ERRORS = (httpx.ReadTimeout, httpx.WriteTimeout, httpx.RemoteProtocolError, httpx.ReadError)
+UNSAFE_RETRY_STATUSES = {502, 503, 504}
+
+
+class Upstream:
+    """Настройки внешнего сервиса и его метрики"""
+
+    def __init__(self, name, timeout, retries=2, idempotent=False, max_connections=10):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.idempotent = idempotent
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                   keepalive_expiry=60)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._stats = {"requests": 0, "retries": 0, "errors": 0, "latency_total": 0.0, "latency_max": 0.0}
+        self._statuses = {}
+
+    def should_retry(self, attempt, response=None, error=None):
+        if attempt >= self.retries:
+            return False
+        if error is not None:
+            return isinstance(error, SAFE_RETRY_ERRORS) or (self.idempotent and isinstance(error, UNSAFE_RETRY_ERRORS))
+        return response.status_code == 429 or (self.idempotent and response.status_code in UNSAFE_RETRY_STATUSES)
+
+    @staticmethod
+    def retry_delay(attempt, response=None):
+        """Пауза перед повтором: Retry-After от сервиса или full jitter"""
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), RETRY_MAX_DELAY)
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    def record(self, elapsed, response=None, error=None, retried=False):
+        with self._lock:
+            stats = self._stats
+            stats["requests"] += 1
+            stats["latency_total"] += elapsed
+            stats["latency_max"] = max(stats["latency_max"], elapsed)
+            self._latencies.append(elapsed)
+            if retried:
+                stats["retries"] += 1
+            if error is not None:
+                stats["errors"] += 1
+                status = type(error).__name__
+            else:
+                status = f"{response.status_code // 100}xx"
+                if response.status_code >= 500:
+                    stats["errors"] += 1
+            self._statuses[status] = self._statuses.get(status, 0) + 1
+
+    def metrics(self):
+        with self._lock:
+            stats = self._stats
+            done = stats["requests"]
+            latencies = sorted(self._latencies)
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0
+            return {
+                "requests": done,
+                "retries": stats["retries"],
+                "errors": stats["errors"],
+                "statuses": dict(self._statuses),
+                "latency_avg_ms": round(stats["latency_total"] * 1000 / done, 1) if done else 0.0,
+                "latency_p95_ms": round(p95 * 1000, 1),
+                "latency_max_ms": round(stats["latency_max"] * 1000, 1),
+            }
+
+
+class HttpClients:
+    def __init__(self, upstreams):
+        self.upstreams = {upstream.name: upstream for upstream in upstreams}
+        self._lock = threading.Lock()
+        # name -> (event loop, AsyncClient): клиент привязан к циклу, в котором создан
+        self._async = {}
+        self._sync = {}
+        # Закрытие клиентов прежних циклов, запущенное в текущем цикле
+        self._closing = set()
+
+    def _client_kwargs(self, upstream):
+        return {"timeout": upstream.timeout, "limits": upstream.limits, "follow_redirects": True}
+
+    def client(self, name):
+        """Общий AsyncClient сервиса (создается при первом обращении)"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._async.get(name)
+            if entry is not None and entry[0] is loop:
+                return entry[1]
+            upstream = self.upstreams[name]
+            self._async[name] = (loop, httpx.AsyncClient(http2=HTTP2_AVAILABLE, **self._client_kwargs(upstream)))
+        if entry is not None:
+            # Клиент прежнего цикла больше не используется - закрываем его пул соединений
+            self._close_stale(*entry)
+        return self._async[name][1]
+
+    def _close_stale(self, loop, client):
+        """Закрывает AsyncClient другого цикла: в его цикле, если тот еще работает, иначе - в текущем"""
+        if loop.is_running() and not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._aclose_quietly(client), loop)
+            return
+        task = asyncio.get_running_loop().create_task(self._aclose_quietly(client))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _aclose_quietly(client):
+        # Соединения закрытого цикла уже не закрыть штатно - важно освободить пул
+        with contextlib.suppress(Exception):
+            await client.aclose()
+
+    def sync_client(self, name):
+        """Общий синхронный Client сервиса для фоновых потоков"""
+        with self._lock:
+            client = self._sync.get(name)
+            if client is None:
+                client = httpx.Client(http2=HTTP2_AVAILABLE, **self._client_kwargs(self.upstreams[name]))
+                self._sync[name] = client
+            return client
+
+    async def request(self, name, method, url, **kwargs):
+        """Запрос к сервису с повторами; возвращает httpx.Response (статус не проверяется)"""
+        upstream = self.upstreams[name]
+        client = self.client(name)
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                retry = upstream.should_retry(attempt, error=e)
+                upstream.record(time.perf_counter() - started, error=e, retried=retry)
+                if not retry:
+                    raise
+                await asyncio.sleep(upstream.retry_delay(attempt))
+            else:
+                retry = upstream.should_retry(attempt, response=response)
+                upstream.record(time.perf_counter() - started, response=response, retried=retry)
+                if not retry:
+                    return response
+                await response.aclose()
+                await asyncio.sleep(upstream.retry_delay(attempt, response))
+            attempt += 1
+            logger.warning(f"⚠️ {name}: повтор {attempt}/{upstream.retries} {method} {httpx.URL(url).host}")
+
+    def request_blocking(self, name, method, url, **kwargs):
+        """То же, что request, для фоновых потоков"""
+        upstream = self.upstreams[name]
+        client = self.sync_client(name)
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = client.request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                retry = upstream.should_retry(attempt, error=e)
+                upstream.record(time.perf_counter() - started, error=e, retried=retry)
+                if not retry:
+                    raise
+                time.sleep(upstream.retry_delay(attempt))
+            else:
+                retry = upstream.should_retry(attempt, response=response)
+                upstream.record(time.perf_counter() - started, response=response, retried=retry)
+                if not retry:
+                    return response
+                response.close()
+                time.sleep(upstream.retry_delay(attempt, response))
+            attempt += 1
+            logger.warning(f"⚠️ {name}: повтор {attempt}/{upstream.retries} {method} {httpx.URL(url).host}")
+
+    @contextlib.contextmanager
+    def stream_blocking(self, name, method, url, **kwargs):
+        """Потоковый ответ (большие файлы) без повторов; в метрики идет время до заголовков"""
+        upstream = self.upstreams[name]
+        started = time.perf_counter()
+        try:
+            stream = self.sync_client(name).stream(method, url, **kwargs)
+            response = stream.__enter__()
+        except httpx.HTTPError as e:
+            upstream.record(time.perf_counter() - started, error=e)
+            raise
+        upstream.record(time.perf_counter() - started, response=response)
+        with contextlib.ExitStack() as stack:
+            stack.push(stream)
+            yield response
+
+    def metrics(self):
+        return {
+            name: {**upstream.metrics(), "http2": HTTP2_AVAILABLE}
+            for name, upstream in self.upstreams.items()
+        }
+
+    async def aclose(self):
+        current = asyncio.get_running_loop()
+        with self._lock:
+            entries = list(self._async.values())
+            self._async.clear()
+        for loop, client in entries:
+            if loop is current:
+                await self._aclose_quietly(client)
+            else:
+                self._close_stale(loop, client)
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for client in self._sync.values():
+                client.close()
+            self._sync.clear()
+
+
+http_clients = HttpClients([
+    # Справочник и поиск городов: запросы только на чтение, повторять безопасно
+    Upstream("novaposhta", httpx.Timeout(15.0, connect=5.0), retries=2, idempotent=True),
+    # Уведомления: повтор только если сообщение точно не доставлено (иначе будет дубль)
+    Upstream("telegram", httpx.Timeout(10.0, connect=5.0), retries=2),
+    # Создание счета: неидемпотентно, повторы только до отправки запроса
+    Upstream("monobank", httpx.Timeout(20.0, connect=5.0), retries=2),
+    # Скачивание XML прайсов по ссылке (большие файлы)
+    Upstream("downloads", httpx.Timeout(60.0, connect=10.0), retries=0, idempotent=True, max_connections=4),
+])
@@ -0,0 +1,162 @@
+"""
+Дисковый кэш производных изображений (ресайзы /image/{filename}).
+
+Каждый вариант адресуется ключом из пути оригинала, его mtime и размера и
+параметров преобразования (w, h, q, формат). Изменение оригинала меняет
+ключ, поэтому старые варианты никогда не отдаются, а просто вытесняются.
+
+Файлы пишутся атомарно (временный файл + os.replace), так что читатель
+никогда не увидит недописанный вариант. Общий размер кэша ограничен
+IMAGE_CACHE_MAX_BYTES: при переполнении удаляются давно не запрошенные
+варианты (LRU по времени последнего обращения, переживает перезапуск).
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# mtime файла обновляется при попадании не чаще раза в интервал (для LRU после перезапуска)
+IMAGE_CACHE_TOUCH_INTERVAL = 60
+# Временные файлы старше этого считаются брошенными (прерванная запись); более свежие
+# может дописывать другой процесс (воркер) прямо сейчас - их не трогаем
+IMAGE_CACHE_TMP_GRACE = 3600
+
+
+class ImageCache:
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # путь -> размер; порядок - от давно запрошенных к недавним
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._loaded = False
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def key(source_path, stat, **params):
+        """Ключ варианта: оригинал (путь, mtime, размер) + параметры преобразования"""
+        parts = [os.path.abspath(source_path), str(stat.st_mtime_ns), str(stat.st_size)]
+        parts += [f"{name}={params[name]}" for name in sorted(params)]
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key[:2], f"{key}.{extension}")
+
+    def _load(self):
+        """Один раз читает содержимое каталога кэша (порядок LRU - по mtime файлов)"""
+        if self._loaded:
+            return
+        found = []
+        now = time.time()
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.startswith("."):
+                    # Временный файл: удаляем, только если он давно брошен прерванной записью
+                    try:
+                        if now - os.stat(path).st_mtime > IMAGE_CACHE_TMP_GRACE:
+                            os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(found):
+            self._entries[path] = size
+            self._bytes += size
+        self._loaded = True
+        if found:
+            logger.info(f"✅ Кэш изображений: {len(found)} файлов, {self._bytes / (1024 * 1024):.1f} MB")
+
+    def contains(self, key, extension):
+        """Есть ли вариант в кэше (без учета в статистике и LRU)"""
+        with self._lock:
+            self._load()
+            return self._path(key, extension) in self._entries
+
+    def get(self, key, extension):
+        """Путь к готовому варианту или None"""
+        path = self._path(key, extension)
+        with self._lock:
+            self._load()
+            size = self._entries.get(path)
+            if size is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self._hits += 1
+        try:
+            if time.time() - os.stat(path).st_mtime > IMAGE_CACHE_TOUCH_INTERVAL:
+                os.utime(path)
+        except OSError:
+            # Файл удалили снаружи - забываем его
+            with self._lock:
+                if self._entries.pop(path, None) is not None:
+                    self._bytes -= size
+                self._hits -= 1
+                self._misses += 1
+            return None
+        return path
+
+    def put(self, key, extension, data):
+        """Атомарно сохраняет вариант и вытесняет старые при переполнении; возвращает путь"""
+        path = self._path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        evicted = []
+        with self._lock:
+            self._load()
+            previous = self._entries.pop(path, None)
+            if previous is not None:
+                self._bytes -= previous
+            self._entries[path] = len(data)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old_path, old_size = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self._evictions += 1
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+        return path
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+
+image_cache = ImageCache()
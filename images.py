@@ -0,0 +1,408 @@
+"""
+Преобразования изображений (ресайз/перекодирование Pillow) вне event loop.
+
+Декодирование, ресайз и кодирование выполняются в ограниченном пуле
+процессов (ImageProcessor), поэтому тяжелая фотография не блокирует
+ни event loop, ни GIL основного процесса. Одинаковые одновременные
+запросы (тот же ключ варианта) объединяются: преобразование выполняется
+один раз, результат получают все ожидающие. Если уникальных задач в работе
+больше IMAGE_MAX_PENDING, новые отклоняются (ImageQueueFull -> 503).
+
+RenditionWorker заранее готовит варианты по профилю (IMAGE_RENDITION_WIDTHS x
+IMAGE_RENDITION_FORMATS) после загрузки картинки или импорта каталога и
+кладет их в дисковый кэш под теми же ключами, что использует /image, так что
+первый покупатель получает уже готовый файл. rendition_srcset() строит для
+товара карту этих вариантов.
+
+Если формат в /image не задан, negotiate_format() выбирает AVIF/WebP по
+заголовку Accept клиента (AVIF - только при установленном pillow-avif-plugin
+или Pillow со встроенной поддержкой).
+
+Модуль не зависит от main и импортируется процессами пула (spawn).
+"""
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image as PILImage
+
+try:
+    # Необязательный плагин AVIF для Pillow (pip install pillow-avif-plugin)
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+from image_cache import image_cache
+
+logger = logging.getLogger(__name__)
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+IMAGE_MAX_PENDING = int(os.getenv("IMAGE_MAX_PENDING", "32"))
+
+# Профиль заранее готовых вариантов (renditions): ширины и форматы
+RENDITION_WIDTHS = [int(w) for w in os.getenv("IMAGE_RENDITION_WIDTHS", "150,300,600,1200").split(",") if w.strip()]
+RENDITION_FORMATS = [f.strip().lower() for f in os.getenv("IMAGE_RENDITION_FORMATS", "webp,jpg").split(",") if f.strip()]
+
+# Уменьшение при декодировании JPEG (draft) оставляет не меньше чем
+# OVERSAMPLE x целевого размера; 0 - отключить. REDUCING_GAP - см. Image.resize
+IMAGE_DRAFT_OVERSAMPLE = int(os.getenv("IMAGE_DRAFT_OVERSAMPLE", "2"))
+IMAGE_REDUCING_GAP = float(os.getenv("IMAGE_REDUCING_GAP", "3.0")) or None
+
+# Форматы вывода: расширение файла в кэше и Content-Type
+OUTPUT_FORMATS = {"JPEG": ("jpg", "image/jpeg"), "PNG": ("png", "image/png"), "WEBP": ("webp", "image/webp")}
+PILImage.init()
+if "AVIF" in PILImage.SAVE:
+    OUTPUT_FORMATS["AVIF"] = ("avif", "image/avif")
+IMAGE_AVIF_QUALITY_OFFSET = int(os.getenv("IMAGE_AVIF_QUALITY_OFFSET", "35"))
+# Форматы, которые /image выбирает сам по заголовку Accept (по убыванию предпочтения)
+NEGOTIATED_FORMATS = [
+    f.strip().upper() for f in os.getenv("IMAGE_NEGOTIATE_FORMATS", "avif,webp").split(",")
+    if f.strip() and f.strip().upper() in OUTPUT_FORMATS
+]
+# Формат оригинала по расширению (чтобы найти вариант в кэше, не открывая файл)
+EXTENSION_FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG", ".webp": "WEBP"}
+
+
+class ImageQueueFull(Exception):
+    """Очередь преобразований переполнена"""
+
+
+def variant_key(file_path, w, h, quality, output_format):
+    """Ключ варианта в дисковом кэше (общий для /image и фоновой генерации)"""
+    return image_cache.key(file_path, os.stat(file_path), w=w, h=h, q=quality, fmt=output_format)
+
+
+def rendition_srcset(image_url):
+    """
+    Карта готовых вариантов для картинки из /uploads: {"webp": {"150": url, ...}, "jpg": {...}}.
+    Для внешних ссылок и пустых значений - None.
+    """
+    if not image_url or not image_url.startswith("/uploads/"):
+        return None
+    filename = image_url[len("/uploads/"):]
+    return {
+        fmt: {str(w): f"/image/{filename}?w={w}&format={fmt}" for w in RENDITION_WIDTHS}
+        for fmt in RENDITION_FORMATS
+    }
+
+
+def negotiate_format(accept):
+    """
+    Лучший из NEGOTIATED_FORMATS, который клиент явно перечислил в Accept
+    (image/avif, image/webp с q > 0), или None - тогда формат оригинала.
+    Маски вроде image/* не учитываются: их шлют и клиенты без поддержки WebP.
+    """
+    if not accept:
+        return None
+    accepted = set()
+    for part in accept.lower().split(","):
+        media_type, _, params = part.strip().partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if weight > 0:
+            accepted.add(media_type.strip())
+    for output_format in NEGOTIATED_FORMATS:
+        if OUTPUT_FORMATS[output_format][1] in accepted:
+            return output_format
+    return None
+
+
+def resolve_output(file_path, q, format):
+    """Итоговые формат и качество для запроса /image (по умолчанию - формат оригинала, q=85)"""
+    output_format = format.upper() if format else EXTENSION_FORMATS.get(os.path.splitext(file_path)[1].lower(), 'JPEG')
+    if output_format not in OUTPUT_FORMATS:
+        output_format = 'JPEG'
+    quality = q if q and 1 <= q <= 100 else 85
+    # PNG сжимается без потерь, качество на результат не влияет
+    return output_format, (quality if output_format != 'PNG' else None)
+
+
+def target_size(size, w, h):
+    """Итоговый размер для запроса w/h с сохранением пропорций"""
+    width, height = size
+    if w and h:
+        # Если указаны оба размера, используем их (может обрезать)
+        return (w, h)
+    if w:
+        # Только ширина
+        return (w, max(1, int(height * w / width)))
+    # Только высота
+    return (max(1, int(width * h / height)), h)
+
+
+def draft_for(img, size):
+    """
+    Уменьшение JPEG прямо при декодировании (в DCT, масштабы 1/2, 1/4, 1/8).
+    Декодер отдает картинку не меньше IMAGE_DRAFT_OVERSAMPLE x size, так что
+    финальный LANCZOS по-прежнему работает с запасом по разрешению.
+    Вызывать до загрузки пикселей; для других форматов ничего не делает.
+    """
+    if IMAGE_DRAFT_OVERSAMPLE <= 0:
+        return
+    img.draft(None, (size[0] * IMAGE_DRAFT_OVERSAMPLE, size[1] * IMAGE_DRAFT_OVERSAMPLE))
+
+
+def _transform(img, w, h, quality, output_format):
+    """Ресайз и кодирование открытого изображения; возвращает bytes"""
+    # Ресайз с сохранением пропорций
+    if w or h:
+        new_size = target_size(img.size, w, h)
+        # При сильном уменьшении сначала быстрое целочисленное сжатие (reduce),
+        # затем LANCZOS на оставшийся зазор - почти без потери качества
+        img = img.resize(new_size, PILImage.Resampling.LANCZOS, reducing_gap=IMAGE_REDUCING_GAP)
+
+    # Конвертируем в RGB если нужно (для JPEG, WebP и AVIF)
+    if output_format in ['JPEG', 'WEBP', 'AVIF'] and img.mode in ('RGBA', 'LA', 'P'):
+        # Создаем белый фон для прозрачных изображений
+        background = PILImage.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+        img = background
+    elif output_format == 'PNG' and img.mode != 'RGBA':
+        img = img.convert('RGBA')
+
+    # Сохраняем в буфер
+    output_buffer = io.BytesIO()
+
+    if output_format == 'WEBP':
+        img.save(output_buffer, format='WEBP', quality=quality, method=6)
+    elif output_format == 'AVIF':
+        # Шкала качества AVIF строже: q-35 по PSNR соответствует WebP того же q
+        img.save(output_buffer, format='AVIF', quality=max(1, quality - IMAGE_AVIF_QUALITY_OFFSET))
+    elif output_format == 'PNG':
+        img.save(output_buffer, format='PNG', optimize=True)
+    else:
+        img.save(output_buffer, format='JPEG', quality=quality, optimize=True)
+
+    return output_buffer.getvalue()
+
+
+def render_image(file_path, w, h, quality, output_format):
+    """Ресайз и перекодирование изображения (блокирующая, нагружает CPU); возвращает bytes"""
+    with PILImage.open(file_path) as img:
+        if w or h:
+            draft_for(img, target_size(img.size, w, h))
+        return _transform(img, w, h, quality, output_format)
+
+
+def render_renditions(file_path, specs):
+    """Все варианты профиля из одного декодирования оригинала: specs - [(w, quality, format)]"""
+    with PILImage.open(file_path) as img:
+        # Декодирование одно на все варианты - масштаб по самому большому из них
+        widest = max((w for w, _, _ in specs), default=None)
+        if widest:
+            draft_for(img, target_size(img.size, widest, None))
+        img.load()
+        return [_transform(img, w, None, quality, output_format) for w, quality, output_format in specs]
+
+
+def _render_timed(*args):
+    """Выполняется в процессе пула: результат и чистое время преобразования"""
+    started = time.perf_counter()
+    data = render_image(*args)
+    return data, time.perf_counter() - started
+
+
+class ImageProcessor:
+    def __init__(self, workers=IMAGE_WORKERS, max_pending=IMAGE_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # ключ варианта -> задача, которую ждут все одинаковые запросы
+        self._inflight = {}
+        self._stats = {
+            "transforms": 0, "failures": 0, "coalesced": 0, "rejected": 0,
+            "transform_time_total": 0.0, "transform_time_max": 0.0,
+            "wait_time_total": 0.0, "wait_time_max": 0.0,
+        }
+
+    def _get_executor(self):
+        # Пул создается при первом преобразовании; spawn - потому что fork процесса
+        # с потоками (пул БД, uvicorn) может унаследовать захваченные блокировки.
+        # Процесс spawn заново импортирует главный модуль (main как __mp_main__
+        # при запуске python main.py), поэтому в main при импорте нет работы
+        # с базой и фоновых потоков - все это в startup-обработчиках
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                )
+                logger.info(f"✅ Пул обработки изображений: {self.workers} процессов")
+            return self._executor
+
+    def run_blocking(self, fn, *args):
+        """Выполняет fn(*args) в пуле процессов и ждет результата (для фоновых потоков)"""
+        try:
+            return self._get_executor().submit(fn, *args).result()
+        except BrokenProcessPool:
+            with self._executor_lock:
+                self._executor = None
+            raise
+
+    async def transform(self, key, file_path, w, h, quality, output_format, store=None):
+        """
+        Возвращает bytes варианта. Одинаковые одновременные запросы (key)
+        ждут одно преобразование; store(data) (блокирующая, например запись
+        в кэш) вызывается один раз. ImageQueueFull, если очередь заполнена.
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self._stats["coalesced"] += 1
+        else:
+            if len(self._inflight) >= self.max_pending:
+                self._stats["rejected"] += 1
+                raise ImageQueueFull(f"Too many image transforms in progress ({len(self._inflight)})")
+            # Отдельная задача: отключившийся клиент не отменяет работу для остальных ожидающих
+            task = asyncio.ensure_future(self._run(file_path, w, h, quality, output_format, store))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _run(self, file_path, w, h, quality, output_format, store):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            data, transform_time = await loop.run_in_executor(
+                self._get_executor(), _render_timed, file_path, w, h, quality, output_format,
+            )
+        except BrokenProcessPool:
+            # Процесс пула упал (например, OOM) - следующий запрос создаст пул заново
+            with self._executor_lock:
+                self._executor = None
+            self._stats["failures"] += 1
+            raise
+        except Exception:
+            self._stats["failures"] += 1
+            raise
+        wait_time = time.perf_counter() - started - transform_time
+        stats = self._stats
+        stats["transforms"] += 1
+        stats["transform_time_total"] += transform_time
+        stats["transform_time_max"] = max(stats["transform_time_max"], transform_time)
+        stats["wait_time_total"] += wait_time
+        stats["wait_time_max"] = max(stats["wait_time_max"], wait_time)
+        if store is not None:
+            await loop.run_in_executor(None, store, data)
+        return data
+
+    def metrics(self):
+        stats = self._stats
+        done = stats["transforms"]
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "in_flight": len(self._inflight),
+            "transforms": done,
+            "failures": stats["failures"],
+            "coalesced": stats["coalesced"],
+            "rejected": stats["rejected"],
+            "transform_time_avg_ms": round(stats["transform_time_total"] * 1000 / done, 3) if done else 0.0,
+            "transform_time_max_ms": round(stats["transform_time_max"] * 1000, 3),
+            "queue_wait_avg_ms": round(stats["wait_time_total"] * 1000 / done, 3) if done else 0.0,
+            "queue_wait_max_ms": round(stats["wait_time_max"] * 1000, 3),
+        }
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+
+class RenditionWorker:
+    """
+    Фоновая генерация вариантов по профилю (RENDITION_WIDTHS x RENDITION_FORMATS)
+    для загруженных картинок. Один поток, по одной картинке за раз, чтобы не
+    занимать весь пул процессов, нужный запросам /image. Уже готовые варианты
+    пропускаются, так что повторная постановка в очередь почти ничего не стоит.
+    Процессы пула только декодируют и кодируют картинки - к базе они не
+    подключаются (см. ConnectionPool.bind_process, scripts/check_image_workers.py).
+    """
+
+    def __init__(self, processor, cache):
+        self.processor = processor
+        self.cache = cache
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._generated = 0
+        self._failures = 0
+
+    def enqueue(self, file_paths):
+        """Ставит картинки (пути к файлам в uploads) в очередь; можно вызывать из любого потока"""
+        with self._lock:
+            for path in file_paths:
+                if path not in self._queued:
+                    self._queued.add(path)
+                    self._queue.put(path)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="image-renditions", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                return
+            try:
+                self._generate(path)
+            except Exception as e:
+                self._failures += 1
+                logger.error(f"❌ Не удалось подготовить варианты {path}: {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(path)
+
+    def _generate(self, path):
+        if not os.path.isfile(path):
+            return
+        missing = []
+        for fmt in RENDITION_FORMATS:
+            output_format, quality = resolve_output(path, None, fmt)
+            extension = OUTPUT_FORMATS[output_format][0]
+            for width in RENDITION_WIDTHS:
+                key = variant_key(path, width, None, quality, output_format)
+                if not self.cache.contains(key, extension):
+                    missing.append((key, extension, (width, quality, output_format)))
+        if not missing:
+            return
+        started = time.perf_counter()
+        results = self.processor.run_blocking(render_renditions, path, [spec for _, _, spec in missing])
+        for (key, extension, _), data in zip(missing, results):
+            self.cache.put(key, extension, data)
+        self._generated += len(missing)
+        logger.info(f"🖼 Варианты {os.path.basename(path)}: {len(missing)} шт. за {time.perf_counter() - started:.2f}с")
+
+    def metrics(self):
+        return {
+            "queued": self._queue.qsize(),
+            "generated": self._generated,
+            "failures": self._failures,
+            "widths": RENDITION_WIDTHS,
+            "formats": RENDITION_FORMATS,
+        }
+
+    def shutdown(self):
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+
+processor = ImageProcessor()
+renditions = RenditionWorker(processor, image_cache)
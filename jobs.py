@@ -0,0 +1,223 @@
+"""
+Фоновые задачи админки (импорт каталога, экспорт заказов).
+
+Эндпоинт ставит задачу в очередь и сразу возвращает ее id, а работа идет в
+пуле потоков JobManager. Клиент опрашивает GET /jobs/{id}: статус, прогресс,
+предупреждения, результат и ссылку на файл-артефакт (например, xlsx).
+
+Задачи хранятся в таблице jobs, так что завершенные результаты переживают
+перезапуск сервера. Прогресс выполняющейся задачи держится в памяти (чтобы
+не писать в базу на каждую пачку строк), а в таблицу попадают смены статуса.
+Записи в базу из потоков задач идут через поток-писатель AsyncDatabase.
+"""
+import json
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from db import pool, adb
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_ARTIFACTS_DIR = os.getenv("JOB_ARTIFACTS_DIR", "job_artifacts")
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "7"))
+JOB_MAX_WARNINGS = 100
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class Job:
+    """Контекст выполняющейся задачи, передается в функцию задачи"""
+
+    def __init__(self, manager, job_id):
+        self._manager = manager
+        self.id = job_id
+
+    def progress(self, done, total=None):
+        """Сколько строк/товаров обработано (total - если известно заранее)"""
+        self._manager._update_live(self.id, progress=done, total=total)
+
+    def warn(self, message):
+        self._manager._add_warning(self.id, message)
+
+    def artifact_path(self, filename):
+        """Путь для файла-результата; после успеха он отдается через /jobs/{id}/artifact"""
+        os.makedirs(JOB_ARTIFACTS_DIR, exist_ok=True)
+        path = os.path.join(JOB_ARTIFACTS_DIR, f"{self.id}_{filename}")
+        self._manager._update_live(self.id, artifact=path)
+        return path
+
+
+class JobManager:
+    def __init__(self, pool, adb, workers=JOB_WORKERS):
+        self.pool = pool
+        self.adb = adb
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        # job_id -> состояние выполняющейся задачи (progress/total/warnings/artifact)
+        self._live = {}
+
+    def ensure_table(self, conn):
+        """Создает таблицу jobs, закрывает задачи, прерванные перезапуском, и чистит старые"""
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    params TEXT,
+                    progress INTEGER DEFAULT 0,
+                    total INTEGER,
+                    result TEXT,
+                    warnings TEXT,
+                    error TEXT,
+                    artifact TEXT,
+                    created_at TEXT,
+                    started_at TEXT,
+                    finished_at TEXT
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs (created_at)")
+            interrupted = conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status IN (?, ?)",
+                (FAILED, "Interrupted by server restart", _now(), QUEUED, RUNNING),
+            ).rowcount
+            if interrupted:
+                logger.warning(f"⚠️ Задач, прерванных перезапуском: {interrupted}")
+
+            cutoff = (datetime.now() - timedelta(days=JOB_RETENTION_DAYS)).isoformat(timespec="seconds")
+            expired = conn.execute("SELECT id, artifact FROM jobs WHERE created_at < ?", (cutoff,)).fetchall()
+            for row in expired:
+                if row["artifact"] and os.path.exists(row["artifact"]):
+                    os.remove(row["artifact"])
+            conn.execute("DELETE FROM jobs WHERE created_at < ?", (cutoff,))
+            conn.commit()
+            logger.info("✅ Таблица jobs готова.")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка создания таблицы jobs: {e}")
+
+    async def submit(self, kind, fn, params=None):
+        """
+        Ставит fn(job) в очередь и возвращает запись задачи. Результат fn
+        (dict) сохраняется в result, исключение - в error.
+        """
+        job_id = uuid.uuid4().hex
+        await self.adb.execute(
+            "INSERT INTO jobs (id, kind, status, params, created_at) VALUES (?, ?, ?, ?, ?)",
+            (job_id, kind, QUEUED, json.dumps(params or {}, ensure_ascii=False), _now()),
+        )
+        with self._lock:
+            self._live[job_id] = {"status": QUEUED, "progress": 0, "total": None, "warnings": [], "artifact": None}
+        self._executor.submit(self._run, job_id, kind, fn)
+        logger.info(f"🕒 Задача {kind} поставлена в очередь: {job_id}")
+        return await self.get(job_id)
+
+    def _update_live(self, job_id, **fields):
+        with self._lock:
+            state = self._live.get(job_id)
+            if state is not None:
+                state.update({k: v for k, v in fields.items() if v is not None})
+
+    def _add_warning(self, job_id, message):
+        with self._lock:
+            state = self._live.get(job_id)
+            if state is not None and len(state["warnings"]) < JOB_MAX_WARNINGS:
+                state["warnings"].append(str(message))
+
+    def _run(self, job_id, kind, fn):
+        self._update_live(job_id, status=RUNNING)
+        self.adb.write_blocking(lambda conn: conn.execute(
+            "UPDATE jobs SET status = ?, started_at = ? WHERE id = ?", (RUNNING, _now(), job_id)
+        ))
+        status, result, error = DONE, None, None
+        try:
+            result = fn(Job(self, job_id))
+            logger.info(f"✅ Задача {kind} {job_id} выполнена")
+        except Exception as e:
+            status, error = FAILED, getattr(e, "detail", None) or str(e)
+            logger.error(f"❌ Задача {kind} {job_id} завершилась ошибкой: {error}")
+
+        with self._lock:
+            state = self._live.get(job_id, {})
+            state["status"] = status
+        artifact = state.get("artifact") if status == DONE else None
+
+        def _finish(conn):
+            conn.execute('''
+                UPDATE jobs
+                SET status = ?, progress = ?, total = ?, result = ?, warnings = ?, error = ?,
+                    artifact = ?, finished_at = ?
+                WHERE id = ?
+            ''', (
+                status, state.get("progress", 0), state.get("total"),
+                json.dumps(result, ensure_ascii=False, default=str) if result is not None else None,
+                json.dumps(state.get("warnings") or [], ensure_ascii=False),
+                error, artifact, _now(), job_id,
+            ))
+
+        try:
+            self.adb.write_blocking(_finish)
+        except Exception as e:
+            logger.error(f"❌ Не удалось сохранить результат задачи {job_id}: {e}")
+        finally:
+            with self._lock:
+                self._live.pop(job_id, None)
+
+    @staticmethod
+    def _to_dict(row):
+        job = dict(row)
+        for key in ("params", "result", "warnings"):
+            if job.get(key):
+                try:
+                    job[key] = json.loads(job[key])
+                except ValueError:
+                    pass
+        job["warnings"] = job.get("warnings") or []
+        job["artifact_url"] = f"/jobs/{job['id']}/artifact" if job.pop("artifact", None) else None
+        return job
+
+    def _with_live_state(self, row):
+        with self._lock:
+            state = self._live.get(row["id"])
+            if state is not None:
+                row.update(status=state["status"], progress=state["progress"], total=state["total"],
+                           warnings=json.dumps(state["warnings"], ensure_ascii=False))
+        return self._to_dict(row)
+
+    async def get(self, job_id):
+        """Задача по id (с живым прогрессом, если она выполняется) или None"""
+        row = await self.adb.fetch_one("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self._with_live_state(row) if row is not None else None
+
+    async def recent(self, limit=50):
+        rows = await self.adb.fetch_all("SELECT * FROM jobs ORDER BY created_at DESC, rowid DESC LIMIT ?", (limit,))
+        return [self._with_live_state(row) for row in rows]
+
+    async def artifact(self, job_id):
+        """Путь к файлу-результату завершенной задачи или None"""
+        row = await self.adb.fetch_one("SELECT artifact FROM jobs WHERE id = ? AND status = ?", (job_id, DONE))
+        if row is None or not row["artifact"] or not os.path.exists(row["artifact"]):
+            return None
+        return row["artifact"]
+
+    def metrics(self):
+        with self._lock:
+            running = sum(1 for s in self._live.values() if s["status"] == RUNNING)
+            return {"workers": self.workers, "running": running, "queued": len(self._live) - running}
+
+    def shutdown(self):
+        # Задачи из очереди отменяются (при старте они будут помечены прерванными),
+        # выполняющиеся дорабатывают
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+jobs = JobManager(pool, adb)
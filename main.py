@@ -1,31 +1,52 @@
-from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, Query, Header
 from fastapi import Request
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, RedirectResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, RedirectResponse, StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional, Union, Any
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, TypeAdapter
+from typing import List, Optional, Union, Any, Dict
 import sqlite3
 import json
+import html
 import os
 import shutil
 import httpx
 import xml.etree.ElementTree as ET
 from datetime import datetime
-import requests
 import csv
 import io
 import pandas as pd
 import uuid
+import tempfile
+import time
 from openai import OpenAI
 from dotenv import load_dotenv
-from PIL import Image as PILImage
 import io
 from typing import Optional
 import logging
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
+from db import pool, adb
+from catalog import catalog, query_products
+import search
+import importers
+from jobs import jobs
+from image_cache import image_cache
+import images
+import uploads
+import novaposhta
+from http_clients import http_clients
+from notifications import outbox
+import payments
+import webhooks
+import order_items
+from orders import query_orders, phone_key, ensure_order_indexes
+from events import order_changes
+import events
+import exports
 
 # Настройка логирования
 logging.basicConfig(
@@ -44,6 +65,7 @@ IS_PRODUCTION = ENVIRONMENT == "production"
 # --- PYDANTIC MODELS ---
 class XMLImportRequest(BaseModel):
     url: str
+    mode: str = importers.DEFAULT_IMPORT_MODE  # insert | upsert | sync
 
 # --- РУЧНАЯ ЗАГРУЗКА .ENV ---
 # Читаем файл как текст, чтобы не зависеть от библиотек
@@ -71,44 +93,44 @@ MY_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 MONOBANK_API_TOKEN = os.getenv("MONOBANK_API_TOKEN")
 
 # --- DATABASE REPAIR ---
-def reset_orders_table():
-    import sqlite3
+# Сносить заказы при старте - только по явному флагу (отладка); по умолчанию заказы сохраняются
+RESET_ORDERS_ON_START = os.getenv("RESET_ORDERS_ON_START", "0") == "1"
+
+def ensure_orders_table():
     try:
-        conn = sqlite3.connect('shop.db')
-        cursor = conn.cursor()
-        
-        # 1. Удаляем старую таблицу (Сносим всё старое)
-        cursor.execute("DROP TABLE IF EXISTS orders")
-        logger.info("🗑️ Старая таблица orders удалена.")
-
-        # 2. Создаем новую ЧИСТУЮ таблицу ровно под наши нужды
-        cursor.execute("""
-            CREATE TABLE orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_email TEXT,
-                name TEXT,
-                phone TEXT,
-                city TEXT,
-                cityRef TEXT,
-                warehouse TEXT,
-                warehouseRef TEXT,
-                items TEXT,
-                total REAL,
-                totalPrice REAL,
-                status TEXT,
-                payment_method TEXT,
-                invoiceId TEXT,
-                date TEXT DEFAULT (datetime('now', 'localtime'))
-            )
-        """)
-        conn.commit()
-        conn.close()
-        logger.info("✨ Новая таблица orders создана с нуля!")
+        with pool.connection() as conn:
+            cursor = conn.cursor()
+            
+            # 1. Удаляем старую таблицу (только с RESET_ORDERS_ON_START=1)
+            if RESET_ORDERS_ON_START:
+                cursor.execute("DROP TABLE IF EXISTS orders")
+                logger.warning("🗑️ Таблица orders удалена (RESET_ORDERS_ON_START=1).")
+
+            # 2. Создаем таблицу, если ее еще нет
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_email TEXT,
+                    name TEXT,
+                    phone TEXT,
+                    city TEXT,
+                    cityRef TEXT,
+                    warehouse TEXT,
+                    warehouseRef TEXT,
+                    items TEXT,
+                    total REAL,
+                    totalPrice REAL,
+                    status TEXT,
+                    payment_method TEXT,
+                    invoiceId TEXT,
+                    date TEXT DEFAULT (datetime('now', 'localtime'))
+                )
+            """)
+            conn.commit()
+        logger.info("✅ Таблица orders готова.")
     except Exception as e:
-        logger.error(f"⚠️ Ошибка сброса БД: {e}")
+        logger.error(f"⚠️ Ошибка подготовки таблицы orders: {e}")
 
-# Вызываем один раз, чтобы починить базу
-reset_orders_table()
 # -----------------------
 
 app = FastAPI()
@@ -118,6 +140,10 @@ limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+# Слишком большие загрузки отклоняются по Content-Length до разбора формы
+# (добавлен до CORS, чтобы ответ 413 тоже получал CORS заголовки)
+app.add_middleware(uploads.UploadSizeLimit, paths=("/upload",))
+
 # Настройка CORS в зависимости от окружения
 if IS_PRODUCTION:
     # В продакшене разрешаем только конкретные домены
@@ -161,242 +187,284 @@ except Exception as e:
 DB_NAME = 'shop.db'
 
 def fix_db():
-    import sqlite3
-    conn = sqlite3.connect('shop.db')
-    cursor = conn.cursor()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
     
-    # Добавляем колонку payment_method
-    try:
-        cursor.execute("ALTER TABLE orders ADD COLUMN payment_method TEXT DEFAULT 'cash'")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка payment_method добавлена.")
-    except Exception:
-        pass
+        # Добавляем колонку payment_method
+        try:
+            cursor.execute("ALTER TABLE orders ADD COLUMN payment_method TEXT DEFAULT 'cash'")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка payment_method добавлена.")
+        except Exception:
+            pass
     
-    # Добавляем колонку invoice_id для связи с Monobank
-    try:
-        cursor.execute("ALTER TABLE orders ADD COLUMN invoice_id TEXT")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка invoice_id добавлена.")
-    except Exception:
-        pass
+        # Добавляем колонку invoice_id для связи с Monobank
+        try:
+            cursor.execute("ALTER TABLE orders ADD COLUMN invoice_id TEXT")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка invoice_id добавлена.")
+        except Exception:
+            pass
     
-    # Добавляем колонку status для отслеживания статуса оплаты
-    try:
-        cursor.execute("ALTER TABLE orders ADD COLUMN status TEXT DEFAULT 'Pending'")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка status добавлена.")
-    except Exception:
-        pass
+        # Добавляем колонку status для отслеживания статуса оплаты
+        try:
+            cursor.execute("ALTER TABLE orders ADD COLUMN status TEXT DEFAULT 'Pending'")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка status добавлена.")
+        except Exception:
+            pass
     
-    # Создаем таблицу products (если не существует)
-    try:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS products (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                price INTEGER NOT NULL,
-                image TEXT,
-                description TEXT,
-                weight TEXT,
-                ingredients TEXT,
-                category TEXT,
-                composition TEXT,
-                usage TEXT,
-                pack_sizes TEXT,
-                old_price REAL,
-                unit TEXT DEFAULT 'шт',
-                variants TEXT
-            )
-        ''')
-        conn.commit()
-        logger.info("✅ Таблица products создана.")
-    except Exception as e:
-        logger.error(f"⚠️ Ошибка создания таблицы products: {e}")
+        # Создаем таблицу products (если не существует)
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS products (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    price INTEGER NOT NULL,
+                    image TEXT,
+                    description TEXT,
+                    weight TEXT,
+                    ingredients TEXT,
+                    category TEXT,
+                    composition TEXT,
+                    usage TEXT,
+                    pack_sizes TEXT,
+                    old_price REAL,
+                    unit TEXT DEFAULT 'шт',
+                    variants TEXT
+                )
+            ''')
+            conn.commit()
+            logger.info("✅ Таблица products создана.")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка создания таблицы products: {e}")
     
-    # Добавляем колонки в таблицу products (если они еще не существуют)
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN weight TEXT")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка weight добавлена в products.")
-    except Exception:
-        pass
+        # Добавляем колонки в таблицу products (если они еще не существуют)
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN weight TEXT")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка weight добавлена в products.")
+        except Exception:
+            pass
     
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN ingredients TEXT")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка ingredients добавлена в products.")
-    except Exception:
-        pass
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN ingredients TEXT")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка ingredients добавлена в products.")
+        except Exception:
+            pass
     
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN category TEXT")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка category добавлена в products.")
-    except Exception:
-        pass
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN category TEXT")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка category добавлена в products.")
+        except Exception:
+            pass
     
-    # Добавляем новые колонки для добавок (Supplements)
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN composition TEXT")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка composition добавлена в products.")
-    except Exception:
-        pass
+        # Добавляем новые колонки для добавок (Supplements)
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN composition TEXT")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка composition добавлена в products.")
+        except Exception:
+            pass
     
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN usage TEXT")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка usage добавлена в products.")
-    except Exception:
-        pass
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN usage TEXT")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка usage добавлена в products.")
+        except Exception:
+            pass
     
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN pack_sizes TEXT")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка pack_sizes добавлена в products.")
-    except Exception:
-        pass
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN pack_sizes TEXT")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка pack_sizes добавлена в products.")
+        except Exception:
+            pass
     
-    # Добавляем новые колонки для цены и единиц измерения
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN old_price REAL")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка old_price добавлена в products.")
-    except Exception:
-        pass
+        # Добавляем новые колонки для цены и единиц измерения
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN old_price REAL")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка old_price добавлена в products.")
+        except Exception:
+            pass
     
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN unit TEXT DEFAULT 'шт'")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка unit добавлена в products.")
-    except Exception:
-        pass
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN unit TEXT DEFAULT 'шт'")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка unit добавлена в products.")
+        except Exception:
+            pass
     
-    # Добавляем колонку variants для вариантов фасовки с ценами
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN variants TEXT")
-        conn.commit()
-        logger.info("✅ База обновлена: колонка variants добавлена в products.")
-    except Exception:
-        pass
+        # Добавляем колонку variants для вариантов фасовки с ценами
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN variants TEXT")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка variants добавлена в products.")
+        except Exception:
+            pass
     
-    # Миграция таблицы orders - добавляем новые поля если их нет
-    try:
-        cursor.execute("PRAGMA table_info(orders)")
-        columns = [row[1] for row in cursor.fetchall()]
-        
-        if 'name' not in columns:
-            cursor.execute("ALTER TABLE orders ADD COLUMN name TEXT")
-            logger.info("✅ Добавлена колонка name в orders")
-        if 'phone' not in columns:
-            cursor.execute("ALTER TABLE orders ADD COLUMN phone TEXT")
-            logger.info("✅ Добавлена колонка phone в orders")
-        if 'city' not in columns:
-            cursor.execute("ALTER TABLE orders ADD COLUMN city TEXT")
-            logger.info("✅ Добавлена колонка city в orders")
-        if 'cityRef' not in columns:
-            cursor.execute("ALTER TABLE orders ADD COLUMN cityRef TEXT")
-            logger.info("✅ Добавлена колонка cityRef в orders")
-        if 'warehouse' not in columns:
-            cursor.execute("ALTER TABLE orders ADD COLUMN warehouse TEXT")
-            logger.info("✅ Добавлена колонка warehouse в orders")
-        if 'warehouseRef' not in columns:
-            cursor.execute("ALTER TABLE orders ADD COLUMN warehouseRef TEXT")
-            logger.info("✅ Добавлена колонка warehouseRef в orders")
-        if 'totalPrice' not in columns:
-            cursor.execute("ALTER TABLE orders ADD COLUMN totalPrice REAL")
-            logger.info("✅ Добавлена колонка totalPrice в orders")
-        if 'date' not in columns:
-            cursor.execute("ALTER TABLE orders ADD COLUMN date TEXT DEFAULT (datetime('now', 'localtime'))")
-            logger.info("✅ Добавлена колонка date в orders")
-        
-        conn.commit()
-    except Exception as e:
-        logger.error(f"⚠️ Ошибка миграции таблицы orders: {e}")
+        # Ключ товара у поставщика (offer id / SKU) для повторных импортов без дублей
+        try:
+            cursor.execute("ALTER TABLE products ADD COLUMN external_id TEXT")
+            conn.commit()
+            logger.info("✅ База обновлена: колонка external_id добавлена в products.")
+        except Exception:
+            pass
     
-    # Создаем таблицу categories
-    try:
-        cursor.execute('CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE)')
-        conn.commit()
-        logger.info("✅ Таблица categories создана.")
-    except Exception as e:
-        logger.error(f"⚠️ Ошибка создания таблицы categories: {e}")
+        # Миграция таблицы orders - добавляем новые поля если их нет
+        try:
+            cursor.execute("PRAGMA table_info(orders)")
+            columns = [row[1] for row in cursor.fetchall()]
+        
+            if 'name' not in columns:
+                cursor.execute("ALTER TABLE orders ADD COLUMN name TEXT")
+                logger.info("✅ Добавлена колонка name в orders")
+            if 'phone' not in columns:
+                cursor.execute("ALTER TABLE orders ADD COLUMN phone TEXT")
+                logger.info("✅ Добавлена колонка phone в orders")
+            if 'city' not in columns:
+                cursor.execute("ALTER TABLE orders ADD COLUMN city TEXT")
+                logger.info("✅ Добавлена колонка city в orders")
+            if 'cityRef' not in columns:
+                cursor.execute("ALTER TABLE orders ADD COLUMN cityRef TEXT")
+                logger.info("✅ Добавлена колонка cityRef в orders")
+            if 'warehouse' not in columns:
+                cursor.execute("ALTER TABLE orders ADD COLUMN warehouse TEXT")
+                logger.info("✅ Добавлена колонка warehouse в orders")
+            if 'warehouseRef' not in columns:
+                cursor.execute("ALTER TABLE orders ADD COLUMN warehouseRef TEXT")
+                logger.info("✅ Добавлена колонка warehouseRef в orders")
+            if 'totalPrice' not in columns:
+                cursor.execute("ALTER TABLE orders ADD COLUMN totalPrice REAL")
+                logger.info("✅ Добавлена колонка totalPrice в orders")
+            if 'date' not in columns:
+                cursor.execute("ALTER TABLE orders ADD COLUMN date TEXT DEFAULT (datetime('now', 'localtime'))")
+                logger.info("✅ Добавлена колонка date в orders")
+        
+            conn.commit()
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка миграции таблицы orders: {e}")
     
-    # Создаем таблицу banners
-    try:
-        cursor.execute('CREATE TABLE IF NOT EXISTS banners (id INTEGER PRIMARY KEY AUTOINCREMENT, image_url TEXT)')
-        conn.commit()
-        logger.info("✅ Таблица banners создана.")
-    except Exception as e:
-        logger.error(f"⚠️ Ошибка создания таблицы banners: {e}")
+        # Создаем таблицу categories
+        try:
+            cursor.execute('CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE)')
+            conn.commit()
+            logger.info("✅ Таблица categories создана.")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка создания таблицы categories: {e}")
     
-    # Автоматическая миграция категорий из существующих продуктов
-    try:
-        cursor.execute("""
-            INSERT OR IGNORE INTO categories (name) 
-            SELECT DISTINCT category FROM products 
-            WHERE category IS NOT NULL AND category != ''
-        """)
-        conn.commit()
-        # Подсчитываем количество добавленных категорий
-        cursor.execute("SELECT COUNT(*) FROM categories")
-        count = cursor.fetchone()[0]
-        logger.info(f"✅ Автоматическая миграция категорий выполнена. Всего категорий: {count}")
-    except Exception as e:
-        logger.error(f"⚠️ Ошибка автоматической миграции категорий: {e}")
+        # Создаем таблицу banners
+        try:
+            cursor.execute('CREATE TABLE IF NOT EXISTS banners (id INTEGER PRIMARY KEY AUTOINCREMENT, image_url TEXT)')
+            conn.commit()
+            logger.info("✅ Таблица banners создана.")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка создания таблицы banners: {e}")
     
-    # Вставляем дефолтные категории, если таблица пустая
-    try:
-        cursor.execute("SELECT COUNT(*) FROM categories")
-        count = cursor.fetchone()[0]
-        
-        if count == 0:
-            default_categories = ["Пицца", "Напитки", "Роллы"]
-            for cat_name in default_categories:
-                try:
-                    cursor.execute("INSERT INTO categories (name) VALUES (?)", (cat_name,))
-                except Exception:
-                    pass  # Игнорируем дубликаты
+        # Индексы для постраничной выдачи каталога (фильтр по категории, сортировка по цене/названию)
+        try:
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_category_price ON products (category, price)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_category_name ON products (category, name)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_price ON products (price)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_name ON products (name)")
+            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_external_id ON products (external_id)")
             conn.commit()
-            logger.info(f"✅ Добавлены дефолтные категории: {', '.join(default_categories)}")
-    except Exception as e:
-        logger.error(f"⚠️ Ошибка добавления дефолтных категорий: {e}")
+            logger.info("✅ Индексы products созданы.")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка создания индексов products: {e}")
+    
+        # Полнотекстовый поиск по товарам (FTS5 + триггеры синхронизации)
+        search.ensure_search_index(conn)
+    
+        # Фоновые задачи админки (импорт/экспорт)
+        jobs.ensure_table(conn)
+    
+        # Локальный справочник городов и отделений Новой Почты
+        novaposhta.directory.ensure_tables(conn)
     
-    conn.close()
+        # Очередь уведомлений в Telegram
+        outbox.ensure_table(conn)
+    
+        # Этапы оплаты заказа (создание счета Monobank)
+        payments.ensure_columns(conn)
+    
+        # Вебхуки Monobank и индекс orders.invoiceId
+        webhooks.inbox.ensure_tables(conn)
+    
+        # Позиции заказов (и перенос из orders.items для старых заказов)
+        order_items.ensure_table(conn)
+    
+        # Индексы фильтров списка заказов в админке
+        ensure_order_indexes(conn)
+    
+        # Лента изменений заказов для админки
+        order_changes.ensure_table(conn)
+    
+        # Автоматическая миграция категорий из существующих продуктов
+        try:
+            cursor.execute("""
+                INSERT OR IGNORE INTO categories (name) 
+                SELECT DISTINCT category FROM products 
+                WHERE category IS NOT NULL AND category != ''
+            """)
+            conn.commit()
+            # Подсчитываем количество добавленных категорий
+            cursor.execute("SELECT COUNT(*) FROM categories")
+            count = cursor.fetchone()[0]
+            logger.info(f"✅ Автоматическая миграция категорий выполнена. Всего категорий: {count}")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка автоматической миграции категорий: {e}")
+    
+        # Вставляем дефолтные категории, если таблица пустая
+        try:
+            cursor.execute("SELECT COUNT(*) FROM categories")
+            count = cursor.fetchone()[0]
+        
+            if count == 0:
+                default_categories = ["Пицца", "Напитки", "Роллы"]
+                for cat_name in default_categories:
+                    try:
+                        cursor.execute("INSERT INTO categories (name) VALUES (?)", (cat_name,))
+                    except Exception:
+                        pass  # Игнорируем дубликаты
+                conn.commit()
+                logger.info(f"✅ Добавлены дефолтные категории: {', '.join(default_categories)}")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка добавления дефолтных категорий: {e}")
     logger.info("ℹ️ Проверка структуры базы завершена.")
 
-fix_db()
+@app.on_event("startup")
+def prepare_database():
+    # Только при старте сервера, не при импорте: процессы пула изображений (spawn)
+    # заново импортируют main как __mp_main__ и не должны трогать базу
+    pool.bind_process()
+    ensure_orders_table()
+    fix_db()
 
 # API ключи из переменных окружения
 NP_API_KEY = os.getenv("NOVA_POSHTA_API_KEY", "")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 MY_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
-def get_db_connection():
-    conn = sqlite3.connect('shop.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
 @app.get("/", response_class=HTMLResponse)
 def read_root():
-    conn = get_db_connection()
-    
-    # Получаем товары
-    items = conn.execute('SELECT * FROM products').fetchall()
-    
-    # Получаем заказы, отсортированные по дате создания (DESC)
-    try:
-        orders = conn.execute('''
-            SELECT id, name, phone, city, warehouse, total_price, created_at 
-            FROM orders 
-            ORDER BY created_at DESC
-        ''').fetchall()
-    except sqlite3.OperationalError:
-        # Таблица orders может не существовать
-        orders = []
-    
-    conn.close()
+    with pool.connection() as conn:
+        # Получаем товары
+        items = conn.execute('SELECT * FROM products').fetchall()
+        
+        # Получаем заказы, отсортированные по дате создания (DESC)
+        try:
+            orders = conn.execute('''
+                SELECT id, name, phone, city, warehouse, total_price, created_at 
+                FROM orders 
+                ORDER BY created_at DESC
+            ''').fetchall()
+        except sqlite3.OperationalError:
+            # Таблица orders может не существовать
+            orders = []
     
     html_content = """
     <html>
@@ -423,6 +491,11 @@ def read_root():
                     <h3>Массовый импорт XML</h3>
                     <form action="/upload_xml" method="post" enctype="multipart/form-data">
                         <input type="file" name="file" accept=".xml">
+                        <select name="mode">
+                            <option value="upsert" selected>Добавить новые и обновить существующие</option>
+                            <option value="insert">Только добавить новые</option>
+                            <option value="sync">Синхронизировать (удалить отсутствующие в фиде)</option>
+                        </select>
                         <button type="submit">Загрузить товары</button>
                     </form>
                 </div>
@@ -460,8 +533,9 @@ def read_root():
             <script>
                 async function loadOrders() {
                     try {
-                        const response = await fetch('/api/orders');
-                        const orders = await response.json();
+                        // Только последняя страница заказов - опрос не растет вместе с историей
+                        const response = await fetch('/api/orders?limit=50&count=false');
+                        const orders = (await response.json()).items || [];
                         const tbody = document.getElementById('ordersBody');
                         
                         if (orders.length === 0) {
@@ -512,94 +586,152 @@ def read_root():
                 // Load orders when page loads
                 loadOrders();
                 
-                // Refresh every 30 seconds
-                setInterval(loadOrders, 30000);
+                // Обновляем список только когда заказ создан или сменил статус:
+                // сервер присылает события по SSE, между ними запросов нет
+                let reloadTimer = null;
+                const changes = new EventSource('/api/orders/changes/stream');
+                changes.addEventListener('order', () => {
+                    // Всплеск изменений - одна перезагрузка страницы заказов
+                    clearTimeout(reloadTimer);
+                    reloadTimer = setTimeout(loadOrders, 300);
+                });
             </script>
         </body>
     </html>
     """
     return html_content
 
+def after_catalog_import(conn, result):
+    """
+    После импорта (в транзакции записи): сбросить кэш каталога и поставить в очередь
+    подготовку вариантов локальных картинок - только если что-то изменилось
+    """
+    if not result["changed"]:
+        return
+    catalog.invalidate_after_commit()
+    local_images = [
+        os.path.join(UPLOADS_DIR, row["image"][len("/uploads/"):])
+        for row in conn.execute("SELECT DISTINCT image FROM products WHERE image LIKE '/uploads/%'")
+    ]
+    if local_images:
+        pool.after_commit(lambda: images.renditions.enqueue(local_images))
+
+def run_catalog_import(import_fn, *args, **kwargs):
+    """
+    Пачечный импорт (import_fn(conn, *args, write=adb.write_blocking, ...)) и
+    after_catalog_import. Если импорт упал после записи части пачек
+    (PartialImportError), кэш каталога все равно сбрасывается, чтобы записанные
+    пачки не прятались за старым снимком и ETag, и ошибка пробрасывается дальше.
+    """
+    result = None
+    try:
+        with pool.connection() as conn:
+            result = import_fn(conn, *args, write=adb.write_blocking, **kwargs)
+    except importers.PartialImportError as e:
+        result = e.written
+        raise
+    finally:
+        if result is not None:
+            adb.write_blocking(after_catalog_import, result)
+    return result
+
+# Ошибки в данных фида/прайса (прерванный импорт с такой причиной - тоже ответ 400)
+IMPORT_CLIENT_ERRORS = (ValueError, ET.ParseError, csv.Error, pd.errors.ParserError, pd.errors.EmptyDataError)
+
+def import_error_status(e):
+    """HTTP статус ошибки прерванного импорта: 400 - плохие данные, 500 - сбой сервера"""
+    return 400 if isinstance(e.cause, IMPORT_CLIENT_ERRORS) else 500
+
+def import_xml_file(source, mode, progress=None):
+    """
+    Импорт XML фида: разбор - в текущем потоке, каждая пачка изменений - отдельная
+    транзакция потока-писателя, так что между пачками проходят записи заказов и
+    вебхуков. Блокирующая: из обработчиков вызывать через run_in_threadpool.
+    """
+    return run_catalog_import(importers.import_xml, source, mode=mode, progress=progress)
+
+def import_csv_text(csv_text, delimiter, mode, progress=None):
+    """Импорт CSV прайса пачками, как import_xml_file (блокирующая)"""
+    return run_catalog_import(importers.import_csv, io.StringIO(csv_text), delimiter, mode=mode,
+                              progress=progress)
+
+def job_accepted(job):
+    """Ответ 202 на постановку фоновой задачи"""
+    return JSONResponse(status_code=202, content={
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/jobs/{job['id']}",
+    })
+
 @app.post("/upload_xml")
-async def upload_xml(file: UploadFile = File(...)):
+async def upload_xml(file: UploadFile = File(...), mode: str = Form(importers.DEFAULT_IMPORT_MODE)):
     try:
-        content = await file.read()
-        # Пробуем декодировать содержимое (важно для кириллицы)
-        xml_text = content.decode('utf-8')
-        tree = ET.fromstring(xml_text)
-        
-        conn = get_db_connection()
-        count = 0
-        
-        for item in tree.findall('.//product'):
-            # Используем .get() чтобы сервер не падал, если тега нет
-            name = item.findtext('name', default='Без названия')
-            price_text = item.findtext('price', default='0')
-            price = int(''.join(filter(str.isdigit, price_text))) # Оставляем только цифры
-            image = item.findtext('image', default='')
-            desc = item.findtext('description', default='')
-            
-            conn.execute("INSERT INTO products (name, price, image, description) VALUES (?, ?, ?, ?)",
-                         (name, price, image, desc))
-            count += 1
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Успешно загружено товаров: {count}")
+        # Файл разбирается потоково прямо из временного файла загрузки
+        result = await run_in_threadpool(import_xml_file, file.file, mode)
+        logger.info(f"Успешно загружено товаров: {result['count']} (добавлено {result['inserted']}, обновлено {result['updated']}, удалено {result['deleted']})")
         return RedirectResponse(url="/", status_code=303)
         
+    except importers.PartialImportError as e:
+        return HTMLResponse(content=f"<h1>Импорт прерван:</h1><p>{str(e)}</p><a href='/'>Назад</a>", status_code=import_error_status(e))
+    except ValueError as e:
+        return HTMLResponse(content=f"<h1>Ошибка импорта:</h1><p>{str(e)}</p><a href='/'>Назад</a>", status_code=400)
     except Exception as e:
         return HTMLResponse(content=f"<h1>Ошибка при чтении XML:</h1><p>{str(e)}</p><a href='/'>Назад</a>", status_code=500)
 
+XML_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def download_to_tempfile(url):
+    """
+    Скачивает файл потоково во временный файл (не держит ответ в памяти).
+    Блокирующая: из обработчиков вызывать через run_in_threadpool.
+    """
+    tmp = tempfile.TemporaryFile()
+    try:
+        with http_clients.stream_blocking("downloads", "GET", url) as response:
+            response.raise_for_status()
+            for chunk in response.iter_bytes(XML_DOWNLOAD_CHUNK_SIZE):
+                tmp.write(chunk)
+        tmp.seek(0)
+        return tmp
+    except BaseException:
+        tmp.close()
+        raise
+
 @app.post("/api/import_xml")
-async def import_xml_from_url(request: XMLImportRequest):
-    import sqlite3
+async def import_xml_from_url(request: XMLImportRequest, background: bool = Query(False)):
+    if request.mode not in importers.IMPORT_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown import mode: {request.mode}. Allowed: {', '.join(importers.IMPORT_MODES)}")
+    
+    if background:
+        # Скачивание и импорт идут в фоновой задаче, клиент опрашивает /jobs/{id}
+        def _run(job):
+            xml_file = download_to_tempfile(request.url)
+            try:
+                return import_xml_file(xml_file, request.mode, job.progress)
+            finally:
+                xml_file.close()
+        
+        job = await jobs.submit("import_xml", _run, params={"url": request.url, "mode": request.mode})
+        return job_accepted(job)
+    
     try:
         # Fetch XML from URL
-        response = requests.get(request.url, timeout=30)
-        response.raise_for_status()
-        xml_text = response.text
+        xml_file = await run_in_threadpool(download_to_tempfile, request.url)
         
         # Parse XML
-        tree = ET.fromstring(xml_text)
-        conn = sqlite3.connect('shop.db')
-        cursor = conn.cursor()
-        count = 0
-        
-        # Try to find products in different possible tags
-        items = tree.findall('.//product') + tree.findall('.//offer') + tree.findall('.//item')
-        
-        for item in items:
-            try:
-                # Extract fields with fallbacks
-                name = item.findtext('name', default='') or item.findtext('title', default='') or 'Без названия'
-                price_text = item.findtext('price', default='0') or item.findtext('cost', default='0')
-                price = int(''.join(filter(str.isdigit, price_text))) if price_text else 0
-                image = item.findtext('image', default='') or item.findtext('picture', default='') or item.findtext('url', default='')
-                description = item.findtext('description', default='') or item.findtext('desc', default='')
-                weight = item.findtext('weight', default='') or item.findtext('mass', default='') or None
-                ingredients = item.findtext('ingredients', default='') or None
-                category = item.findtext('categoryId', default='') or item.findtext('category', default='') or item.findtext('category_id', default='') or None
-                # New fields for supplements
-                composition = item.findtext('composition', default='') or item.findtext('склад', default='') or None
-                usage = item.findtext('usage', default='') or item.findtext('прийом', default='') or item.findtext('прием', default='') or None
-                pack_sizes = item.findtext('pack_sizes', default='') or item.findtext('фасування', default='') or item.findtext('packaging', default='') or None
-                
-                # Insert into database
-                cursor.execute("""
-                    INSERT INTO products (name, price, image, description, weight, ingredients, category, composition, usage, pack_sizes)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (name, price, image, description, weight, ingredients, category, composition, usage, pack_sizes))
-                count += 1
-            except Exception as e:
-                logger.error(f"Error processing item: {e}")
-                continue
-        
-        conn.commit()
-        conn.close()
-        return {"message": f"Successfully imported {count} products", "count": count}
-        
-    except requests.exceptions.RequestException as e:
+        try:
+            result = await run_in_threadpool(import_xml_file, xml_file, request.mode)
+        finally:
+            xml_file.close()
+        
+        count = result["count"]
+        return {"message": f"Successfully imported {count} products", **result}
+        
+    except importers.PartialImportError as e:
+        raise HTTPException(status_code=import_error_status(e), detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=400, detail=f"Failed to fetch XML from URL: {str(e)}")
     except ET.ParseError as e:
         raise HTTPException(status_code=400, detail=f"Failed to parse XML: {str(e)}")
@@ -607,10 +739,6 @@ async def import_xml_from_url(request: XMLImportRequest):
         logger.error(f"Error importing XML: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# Максимальный размер файла (10 MB)
-MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB
-ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
-
 @app.post("/upload")
 @limiter.limit("10/minute")
 async def upload_image(request: Request, file: UploadFile = File(...)):
@@ -622,38 +750,27 @@ async def upload_image(request: Request, file: UploadFile = File(...)):
         
         # Validate file extension
         file_extension = os.path.splitext(file.filename)[1].lower() if file.filename else ''
-        if file_extension not in ALLOWED_EXTENSIONS:
+        if file_extension not in uploads.ALLOWED_EXTENSIONS:
             raise HTTPException(
                 status_code=400, 
-                detail=f"File extension not allowed. Allowed: {', '.join(ALLOWED_EXTENSIONS)}"
-            )
-        
-        # Read file content
-        content = await file.read()
-        
-        # Validate file size
-        file_size = len(content)
-        if file_size > MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=400,
-                detail=f"File too large. Maximum size: {MAX_FILE_SIZE / (1024 * 1024):.1f} MB"
+                detail=f"File extension not allowed. Allowed: {', '.join(uploads.ALLOWED_EXTENSIONS)}"
             )
         
-        if file_size == 0:
-            raise HTTPException(status_code=400, detail="File is empty")
-        
-        # Generate unique filename
-        unique_filename = f"{uuid.uuid4().hex}{file_extension}"
-        file_path = os.path.join(UPLOADS_DIR, unique_filename)
-        
-        # Save file
-        with open(file_path, "wb") as buffer:
-            buffer.write(content)
+        # Файл пишется на диск по частям с проверкой размера, сигнатуры и
+        # размеров картинки, затем атомарно переносится в uploads
+        try:
+            saved = await uploads.save_image_upload(file, UPLOADS_DIR, uuid.uuid4().hex, file_extension)
+        except uploads.InvalidUpload as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
+        unique_filename = saved["filename"]
         # Return relative path (client will prepend API_URL)
         file_path_relative = f"/uploads/{unique_filename}"
         
-        logger.info(f"✅ File uploaded: {unique_filename} ({file_size / 1024:.1f} KB) -> {file_path_relative}")
+        # Варианты разных размеров готовятся в фоне, до первого просмотра
+        images.renditions.enqueue([saved["path"]])
+        
+        logger.info(f"✅ File uploaded: {unique_filename} ({saved['size'] / 1024:.1f} KB, {saved['width']}x{saved['height']}) -> {file_path_relative}")
         return {"url": file_path_relative, "filename": unique_filename}
         
     except HTTPException:
@@ -663,12 +780,15 @@ async def upload_image(request: Request, file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
 
 @app.post("/upload_csv")
-async def upload_csv(file: UploadFile = File(...)):
+async def upload_csv(file: UploadFile = File(...), mode: str = Form(importers.DEFAULT_IMPORT_MODE),
+                     background: bool = Query(False)):
     """
     Import products from CSV file.
     Expected columns: name, price, category, image_url, description, unit, pack_sizes
+    Optional supplier key column (sku / external_id / ...) makes re-imports idempotent.
+    mode: insert | upsert | sync (see importers.IMPORT_MODES)
+    background=true: import runs as a job, poll /jobs/{id}
     """
-    import sqlite3
     try:
         # Read file content
         content = await file.read()
@@ -693,12 +813,9 @@ async def upload_csv(file: UploadFile = File(...)):
         if ';' in first_line and first_line.count(';') > first_line.count(','):
             delimiter = ';'
         
-        # Parse CSV
-        csv_reader = csv.DictReader(io.StringIO(csv_text), delimiter=delimiter)
-        
         # Validate required columns
         required_columns = ['name', 'price']
-        fieldnames = csv_reader.fieldnames or []
+        fieldnames = importers.csv_columns(io.StringIO(csv_text), delimiter)
         missing_columns = [col for col in required_columns if col not in fieldnames]
         if missing_columns:
             raise HTTPException(
@@ -706,74 +823,107 @@ async def upload_csv(file: UploadFile = File(...)):
                 detail=f"Missing required columns: {', '.join(missing_columns)}. Found columns: {', '.join(fieldnames)}"
             )
         
-        conn = sqlite3.connect('shop.db')
-        cursor = conn.cursor()
-        count = 0
-        errors = []
+        if mode not in importers.IMPORT_MODES:
+            raise HTTPException(status_code=400, detail=f"Unknown import mode: {mode}. Allowed: {', '.join(importers.IMPORT_MODES)}")
         
-        for row_num, row in enumerate(csv_reader, start=2):  # Start at 2 (1 is header)
-            try:
-                # Extract fields with defaults
-                name = row.get('name', '').strip() or 'Без названия'
-                
-                # Parse price (handle various formats)
-                price_text = str(row.get('price', '0')).strip()
-                price = int(''.join(filter(str.isdigit, price_text))) if price_text else 0
-                
-                # Map image_url to image (database column name)
-                image = row.get('image_url', '').strip() or row.get('image', '').strip() or ''
-                
-                description = row.get('description', '').strip() or ''
-                category = row.get('category', '').strip() or None
-                unit = row.get('unit', '').strip() or 'шт'
-                pack_sizes = row.get('pack_sizes', '').strip() or None
-                
-                # Optional fields (for consistency with XML import)
-                weight = row.get('weight', '').strip() or None
-                ingredients = row.get('ingredients', '').strip() or None
-                composition = row.get('composition', '').strip() or None
-                usage = row.get('usage', '').strip() or None
-                
-                # Insert into database using the same logic as XML import
-                cursor.execute("""
-                    INSERT INTO products (name, price, image, description, weight, ingredients, category, composition, usage, pack_sizes, unit)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (name, price, image, description, weight, ingredients, category, composition, usage, pack_sizes, unit))
-                count += 1
-                
-            except Exception as e:
-                error_msg = f"Error processing row {row_num}: {str(e)}"
-                errors.append(error_msg)
-                logger.error(error_msg)
-                continue
+        if background:
+            def _run(job):
+                result = import_csv_text(csv_text, delimiter, mode, job.progress)
+                for warning in result.pop("warnings"):
+                    job.warn(warning)
+                return result
+            
+            job = await jobs.submit("import_csv", _run, params={"filename": file.filename, "mode": mode})
+            return job_accepted(job)
         
-        conn.commit()
-        conn.close()
+        # CSV разбирается пачками (pandas) в пуле потоков, каждая пачка пишется своей транзакцией
+        result = await run_in_threadpool(import_csv_text, csv_text, delimiter, mode)
+        warnings = result.pop("warnings")
         
-        result = {
-            "message": f"Successfully imported {count} products",
-            "count": count
-        }
+        result["message"] = f"Successfully imported {result['count']} products ({result['rows_per_sec']} rows/sec)"
         
-        if errors:
-            result["warnings"] = errors[:10]  # Limit to first 10 errors
-            result["error_count"] = len(errors)
+        if warnings:
+            result["warnings"] = warnings[:10]  # Limit to first 10 errors
+            result["error_count"] = len(warnings)
         
         return JSONResponse(content=result)
         
     except HTTPException:
         raise
-    except csv.Error as e:
+    except importers.PartialImportError as e:
+        raise HTTPException(status_code=import_error_status(e), detail=str(e))
+    except (csv.Error, pd.errors.ParserError, pd.errors.EmptyDataError) as e:
         raise HTTPException(status_code=400, detail=f"CSV parsing error: {str(e)}")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error importing CSV: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/jobs")
+async def list_jobs(limit: int = Query(50, ge=1, le=200)):
+    """Последние фоновые задачи"""
+    return await jobs.recent(limit)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Статус фоновой задачи: progress, total, warnings, result, artifact_url"""
+    job = await jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs/{job_id}/artifact")
+async def get_job_artifact(job_id: str):
+    """Файл-результат завершенной задачи (например, xlsx экспорта)"""
+    path = await jobs.artifact(job_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    return FileResponse(path, filename=os.path.basename(path).split("_", 1)[-1])
+
 @app.get("/health")
 def health_check():
     """Проверка доступности сервера"""
     return JSONResponse(content={"status": "ok", "message": "Server is running"})
 
+@app.get("/metrics")
+def get_metrics():
+    """Метрики сервера (пул соединений SQLite, исполнитель запросов, фоновые задачи, кэш изображений)"""
+    return {"db": pool.metrics(), "db_executor": adb.metrics(), "jobs": jobs.metrics(),
+            "image_cache": image_cache.metrics(), "images": images.processor.metrics(),
+            "image_renditions": images.renditions.metrics(), "novaposhta": novaposhta.directory.metrics(),
+            "upstreams": http_clients.metrics(), "notifications": outbox.metrics(),
+            "payments": payments.reconciler.metrics(), "webhooks": webhooks.inbox.metrics(),
+            "order_changes": order_changes.metrics()}
+
+@app.on_event("startup")
+def start_background_refresh():
+    # Справочник Новой Почты скачивается сразу, если пуст или устарел, дальше - по расписанию
+    novaposhta.directory.start()
+    # Доставка уведомлений, оставшихся в очереди с прошлого запуска
+    outbox.start()
+    # Повтор создания счетов, не удавшегося при оформлении
+    payments.reconciler.start()
+    # Вебхуки, сохраненные, но не обработанные до перезапуска
+    webhooks.inbox.start()
+
+@app.on_event("shutdown")
+def close_db_pool():
+    order_changes.shutdown()
+    novaposhta.directory.shutdown()
+    outbox.shutdown()
+    payments.reconciler.shutdown()
+    webhooks.inbox.shutdown()
+    images.renditions.shutdown()
+    images.processor.shutdown()
+    jobs.shutdown()
+    adb.shutdown()
+    pool.close_all()
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await http_clients.aclose()
+
 @app.get("/admin")
 async def read_admin():
     return FileResponse('admin.html')
@@ -792,55 +942,36 @@ async def payment_success():
 
 @app.post("/monobank-webhook")
 async def monobank_webhook(request: Request):
+    # Проверяем подпись X-Sign, только сохраняем уведомление и сразу отвечаем банку; смена статуса заказа
+    # и уведомление в Telegram - в фоновом обработчике (webhooks.inbox)
     try:
-        data = await request.json()
-        logger.info(f"🔔 Webhook received: {data}")
-        
-        # Monobank sends 'status': 'success' when paid
-        if data.get('status') == 'success':
-            invoice_id = data.get('invoiceId')
-            
-            # Find order in DB
-            conn = sqlite3.connect('shop.db')
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, total, items, user_email FROM orders WHERE invoiceId = ?", (invoice_id,))
-            order = cursor.fetchone()
-            
-            if order:
-                # Update status to Paid
-                cursor.execute("UPDATE orders SET status = 'Paid' WHERE invoiceId = ?", (invoice_id,))
-                conn.commit()
-                
-                # Send Telegram Notification
-                order_id, total, items_json, user_email = order
-                msg = f"✅ <b>ОПЛАТА ПРОШЛА!</b>\n\n💰 Сумма: {total} грн\n📧 Клиент: {user_email}\n📦 Заказ #{order_id}"
-                
-                # Send to TG
-                token = os.getenv("TELEGRAM_BOT_TOKEN")
-                chat_id = os.getenv("TELEGRAM_CHAT_ID")
-                if token and chat_id:
-                    url = f"https://api.telegram.org/bot{token}/sendMessage"
-                    async with httpx.AsyncClient() as client:
-                        await client.post(url, json={"chat_id": chat_id, "text": msg, "parse_mode": "HTML"})
-                        logger.info("✈️ Telegram sent!")
-                else:
-                    logger.warning("⚠️ Telegram token or chat_id not configured")
-            
-            conn.close()
-            
-        return {"status": "ok"}
-        
+        event, is_new = await webhooks.inbox.receive(await request.body(), request.headers.get("X-Sign"))
+    except webhooks.SignatureError as e:
+        logger.warning(f"⚠️ Webhook rejected: {e}")
+        return JSONResponse(status_code=403, content={"status": "invalid signature"})
+    except ValueError as e:
+        logger.warning(f"⚠️ Webhook ignored: {e}")
+        return {"status": "ignored"}
     except Exception as e:
+        # Уведомление не сохранено - банк повторит его
         logger.error(f"❌ Webhook error: {e}")
-        return {"status": "error"}
+        return JSONResponse(status_code=500, content={"status": "error"})
+    logger.info(f"🔔 Webhook received: {event['invoice_id']} {event['status']}" + ("" if is_new else " (повтор)"))
+    return {"status": "ok"}
 
 @app.get("/get_cities")
 async def get_cities(search: str = ""):
-    import requests
-    
     if not search or len(search) < 2:
         return JSONResponse(content={"success": False, "data": [], "message": "Search query too short"})
     
+    # Основной путь - локальный справочник (обновляется в фоне), без запроса к Новой Почте
+    if novaposhta.directory.ready:
+        cities = await novaposhta.directory.search_cities(search)
+        if cities:
+            return JSONResponse(content={"success": True, "data": cities})
+        return JSONResponse(content={"success": False, "data": [], "message": "No cities found"})
+    
+    # Справочник еще не загружен - спрашиваем Новую Почту напрямую
     url = "https://api.novaposhta.ua/v2.0/json/"
     api_key = NP_API_KEY
     
@@ -863,7 +994,7 @@ async def get_cities(search: str = ""):
     }
 
     try:
-        response = requests.post(url, json=data_search, headers=headers, timeout=20)
+        response = await http_clients.request("novaposhta", "POST", url, json=data_search, headers=headers)
         logger.debug(f"DEBUG Request URL: {url}, Search: '{search}'")
         logger.debug(f"DEBUG Request status: {response.status_code}")
         
@@ -917,34 +1048,8 @@ async def get_cities(search: str = ""):
             else:
                 logger.debug(f"DEBUG No data in response or success=False")
         
-        # Метод 2: getCities (если searchSettlements не сработал)
-        logger.warning("Trying getCities as fallback...")
-        data_cities = {
-            "apiKey": api_key,
-            "modelName": "Address",
-            "calledMethod": "getCities",
-            "methodProperties": {}
-        }
-        
-        response2 = requests.post(url, json=data_cities, headers=headers, timeout=20)
-        if response2.status_code == 200:
-            res_json2 = response2.json()
-            if res_json2.get('success') and res_json2.get('data'):
-                # Фильтруем города по поисковому запросу
-                search_lower = search.lower()
-                filtered_cities = []
-                for city in res_json2['data']:
-                    description = city.get('Description', '')
-                    if search_lower in description.lower():
-                        filtered_cities.append({
-                            "Ref": city.get('Ref', ''),
-                            "Description": description
-                        })
-                
-                logger.debug(f"DEBUG getCities fallback found {len(filtered_cities)} cities")
-                if filtered_cities:
-                    result = {"success": True, "data": filtered_cities[:50]}
-                    return JSONResponse(content=result)
+        # Полный список городов (getCities) здесь больше не скачивается: этим
+        # занимается фоновое обновление справочника novaposhta
                     
     except Exception as e:
         logger.error(f"🔥 NP Error (Cities): {e}")
@@ -957,12 +1062,16 @@ async def get_cities(search: str = ""):
 
 @app.post("/get_warehouses")
 async def get_warehouses(request: Request):
-    import requests
     try:
         body = await request.json()
         city_ref = body.get('cityRef')
         if not city_ref:
             return []
+        
+        # Отделения из локального справочника; если города там нет - запрос к Новой Почте
+        warehouses = await novaposhta.directory.warehouses(city_ref)
+        if warehouses:
+            return warehouses
 
         url = "https://api.novaposhta.ua/v2.0/json/"
         headers = {
@@ -979,7 +1088,7 @@ async def get_warehouses(request: Request):
             }
         }
 
-        response = requests.post(url, json=data, headers=headers, timeout=15)
+        response = await http_clients.request("novaposhta", "POST", url, json=data, headers=headers)
         if response.status_code == 200:
             res_json = response.json()
             if res_json.get('success'):
@@ -996,17 +1105,14 @@ async def get_warehouses(request: Request):
 
     return []
 
-def send_telegram_notification(order_data):
-    """Отправляет уведомление о новом заказе в Telegram"""
-    if not TELEGRAM_TOKEN or not MY_CHAT_ID:
-        logger.warning("⚠️ TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID not configured. Skipping notification.")
-        return
-    
+def build_order_notification(order_data):
+    """Текст уведомления о новом заказе для Telegram"""
     # Безопасное извлечение данных с проверкой на None
-    name = order_data.get('name') or 'Не указано'
-    phone = order_data.get('phone') or 'Не указано'
-    city = order_data.get('city') or 'Не указано'
-    warehouse = order_data.get('warehouse') or 'Не указано'
+    # (пользовательский ввод экранируется: сообщение уходит с parse_mode=HTML)
+    name = html.escape(order_data.get('name') or 'Не указано')
+    phone = html.escape(order_data.get('phone') or 'Не указано')
+    city = html.escape(order_data.get('city') or 'Не указано')
+    warehouse = html.escape(order_data.get('warehouse') or 'Не указано')
     total = order_data.get('total') or 0
     order_id = order_data.get('order_id', 'N/A')
     payment_method = order_data.get('payment_method', 'card')
@@ -1019,7 +1125,7 @@ def send_telegram_notification(order_data):
     if items:
         items_list.append("🛒 ЗАКАЗ:")
         for item in items:
-            product_name = item.get('name', 'Товар')
+            product_name = html.escape(str(item.get('name', 'Товар')))
             quantity = item.get('quantity', 1)
             unit = item.get('unit') or ''
             pack_size = item.get('packSize') or item.get('pack_size') or ''
@@ -1045,22 +1151,7 @@ def send_telegram_notification(order_data):
 💰 Сумма: {total} грн
 {payment_method_text}"""
     
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": MY_CHAT_ID,
-        "text": message,
-        "parse_mode": "HTML"
-    }
-    
-    try:
-        response = requests.post(url, json=payload, timeout=10)
-        response.raise_for_status()
-        logger.info(f"✅ Telegram notification sent successfully for order {order_id}")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"❌ Failed to send Telegram notification: {str(e)}")
-        # Не пробрасываем исключение дальше, чтобы не сломать создание заказа
-    except Exception as e:
-        logger.error(f"❌ Unexpected error in Telegram notification: {str(e)}")
+    return message
 
 class Item(BaseModel):
     id: Any             # Accept string or int
@@ -1116,6 +1207,7 @@ class Product(BaseModel):
     old_price: Optional[float] = None  # For discount logic
     unit: Optional[str] = "шт"  # Measurement unit (e.g., "г", "мл")
     variants: Optional[Any] = None  # Variants with prices: [{"size": "10 шт", "price": 100}, ...]
+    srcset: Optional[Dict[str, Dict[str, str]]] = None  # {"webp": {"300": "/image/...?w=300&format=webp"}, "jpg": {...}}
 
     class Config:
         from_attributes = True
@@ -1171,95 +1263,96 @@ class Banner(BaseModel):
 class DeleteBatchRequest(BaseModel):
     ids: List[int]
 
-@app.get("/products", response_model=List[Product])
-async def get_products():
-    try:
-        conn = get_db_connection()
-        conn.row_factory = sqlite3.Row # Allow accessing columns by name
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT * FROM products")
-        rows = cursor.fetchall()
+_products_adapter = TypeAdapter(List[Product])
 
-        results = []
-        for row in rows:
-            item = dict(row)
-
-            # Handle image fields: ensure picture always has a value if image_url exists
-            # CSV imports save to 'image' column (mapped from image_url), XML may use 'picture' column
-            image_value = item.get("image") or ""
-            picture_value = item.get("picture") or ""
-            image_url_value = item.get("image_url") or ""
-            
-            # First, set image_url from database 'image' column if image_url is empty
-            # (CSV imports save image_url to 'image' column in DB)
-            if not image_url_value:
-                item["image_url"] = image_value
-            
-            # Critical: If picture is None/empty AND image_url has a value, assign picture = image_url
-            # This ensures the frontend (which expects 'picture') always gets a valid URL for CSV-imported items
-            if not picture_value and item.get("image_url"):
-                item["picture"] = item["image_url"]
-            # Fallback: if picture is empty but 'image' column has value, use it
-            elif not picture_value and image_value:
-                item["picture"] = image_value
-                if not item.get("image_url"):
-                    item["image_url"] = image_value
-
-            # Safe Pack Sizes
-            pack_sizes_val = item.get("pack_sizes")
-            if pack_sizes_val and isinstance(pack_sizes_val, str):
-                item["pack_sizes"] = [x.strip() for x in pack_sizes_val.split(",") if x.strip()]
-            else:
-                item["pack_sizes"] = []
-
-            # Safe Unit
-            if not item.get("unit"):
-                item["unit"] = "шт"
-            
-            # Parse variants JSON if exists - CRITICAL: Always include variants field
-            variants_val = item.get("variants")
-            if variants_val and isinstance(variants_val, str):
-                try:
-                    parsed = json.loads(variants_val)
-                    item["variants"] = parsed if parsed else None
-                    logger.debug(f"✅ Product {item.get('id')} ({item.get('name')}): variants parsed = {parsed}")
-                except Exception as e:
-                    logger.warning(f"⚠️ Error parsing variants for product {item.get('id')}: {e}")
-                    item["variants"] = None
-            else:
-                # Keep original value (could be None, empty string, or already parsed)
-                item["variants"] = variants_val if variants_val else None
-                if variants_val:
-                    logger.debug(f"✅ Product {item.get('id')} ({item.get('name')}): variants (not string) = {variants_val}")
-                else:
-                    logger.debug(f"⚠️ Product {item.get('id')} ({item.get('name')}): variants is None/empty")
+def serialize_products(products):
+    """Сериализует каталог так же, как это сделал бы response_model=List[Product]"""
+    return _products_adapter.dump_json(_products_adapter.validate_python(products))
 
-            # CRITICAL: Ensure variants field is always present in the dict
-            if "variants" not in item:
-                item["variants"] = None
-                logger.warning(f"🔴 CRITICAL: Product {item.get('id')} missing variants field! Adding None.")
+PRODUCTS_PAGE_DEFAULT = 20
+PRODUCTS_PAGE_MAX = 100
 
-            results.append(item)
+@app.get("/products", response_model=List[Product])
+async def get_products(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=PRODUCTS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[int] = None,
+    max_price: Optional[int] = None,
+    sort: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    """
+    Без параметров - весь каталог одним списком (режим совместимости, из кэша).
+    С любым из параметров - страница {"items": [...], "next_cursor": ...}:
+    - limit: размер страницы (по умолчанию 20, максимум 100)
+    - cursor: next_cursor из предыдущей страницы
+    - category, min_price, max_price: фильтры
+    - sort: id, -id, price, -price, name, -name
+    - fields: список полей через запятую, например fields=id,name,price,picture,category
+    """
+    if any(v is not None for v in (limit, cursor, category, min_price, max_price, sort, fields)):
+        try:
+            page = await adb.read(
+                query_products,
+                limit or PRODUCTS_PAGE_DEFAULT,
+                cursor=cursor,
+                category=category,
+                min_price=min_price,
+                max_price=max_price,
+                sort=sort or "id",
+                fields=fields,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return JSONResponse(content=page)
 
-        conn.close()
-        
-        # Debug: Log first product to verify variants field
-        if results and len(results) > 0:
-            first_product = results[0]
-            logger.debug(f"🔍 DEBUG GET /products: First product has variants field: {'variants' in first_product}")
-            logger.debug(f"🔍 DEBUG GET /products: First product variants value: {first_product.get('variants')}")
-            logger.debug(f"🔍 DEBUG GET /products: First product variants type: {type(first_product.get('variants'))}")
-        
-        return results
+    try:
+        # Снимок каталога в памяти; при промахе (старт/сброс) читаем базу один раз
+        snapshot = catalog.current() or await adb.read(catalog.load)
+        # Тело ответа и его сжатые варианты собираются один раз на версию каталога
+        if not snapshot.is_encoded:
+            await run_in_threadpool(snapshot.encoded, serialize_products)
+        payload = snapshot.encoded(serialize_products)
+        
+        encoding = payload.choose(request.headers.get("accept-encoding"))
+        headers = {
+            "ETag": payload.etags[encoding],
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        if payload.matches(request.headers.get("if-none-match")):
+            return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=payload.bodies[encoding], media_type="application/json", headers=headers)
     except Exception as e:
         logger.error(f"CRITICAL ERROR in GET /products: {e}")
-        return [] # Return empty list instead of crashing
+        return JSONResponse(content=[]) # Return empty list instead of crashing
+
+@app.get("/products/search")
+async def search_products(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=50),
+    prefix: bool = True,
+    fields: Optional[str] = None,
+):
+    """
+    Полнотекстовый поиск по названию, описанию, составу, приему и категории.
+    Результаты отсортированы по релевантности (BM25); prefix=true ищет
+    последнее слово по началу (для автодополнения).
+    """
+    if not search.available:
+        raise HTTPException(status_code=503, detail="Search is not available")
+    try:
+        items = await adb.read(search.search_products, q, limit, prefix=prefix, fields=fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={"items": items})
 
 @app.post("/products")
 async def create_product(product: ProductCreate):
-    conn = get_db_connection()
-    cursor = conn.cursor()
     try:
         # Handle pack_sizes: convert array to comma-separated string if needed
         pack_sizes_str = ", ".join(str(x) for x in product.pack_sizes) if isinstance(product.pack_sizes, list) else (product.pack_sizes or "")
@@ -1272,56 +1365,24 @@ async def create_product(product: ProductCreate):
             elif isinstance(product.variants, str):
                 variants_str = product.variants
         
-        cursor.execute('''
-            INSERT INTO products (name, price, description, category, image, composition, usage, weight, pack_sizes, old_price, unit, variants) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (product.name, product.price, product.description, product.category, product.image, product.composition, product.usage, product.weight, pack_sizes_str, product.old_price, product.unit, variants_str))
-        conn.commit()
-        product_id = cursor.lastrowid
-        conn.close()
+        def _insert(conn):
+            cursor = conn.execute('''
+                INSERT INTO products (name, price, description, category, image, composition, usage, weight, pack_sizes, old_price, unit, variants) 
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (product.name, product.price, product.description, product.category, product.image, product.composition, product.usage, product.weight, pack_sizes_str, product.old_price, product.unit, variants_str))
+            catalog.patch_after_commit(conn, [cursor.lastrowid])
+            return cursor.lastrowid
+        
+        product_id = await adb.write(_insert)
         return {"id": product_id, "message": "Product created successfully"}
     except Exception as e:
-        conn.close()
         logger.error(f"Error creating product: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 # --- UPDATE PRODUCT ---
 @app.put("/products/{product_id}")
 async def update_product(product_id: int, product: ProductUpdate):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Ensure database schema columns exist
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN pack_sizes TEXT")
-        conn.commit()
-    except Exception:
-        pass
-    
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN old_price REAL")
-        conn.commit()
-    except Exception:
-        pass
-    
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN unit TEXT DEFAULT 'шт'")
-        conn.commit()
-    except Exception:
-        pass
-    
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN variants TEXT")
-        conn.commit()
-    except Exception:
-        pass
-    
-    try:
-        cursor.execute("ALTER TABLE products ADD COLUMN usage TEXT")
-        conn.commit()
-    except Exception:
-        pass
-    
+    # Колонки pack_sizes/old_price/unit/variants/usage создаются в fix_db() при старте
     # 2. Prepare other fields
     unit_val = product.unit if product.unit else "шт"
     old_price_val = product.old_price
@@ -1341,85 +1402,76 @@ async def update_product(product_id: int, product: ProductUpdate):
 
     try:
         # 3. Execute SQL with EXPLICIT fields
-        cursor.execute("""
-            UPDATE products 
-            SET name=?, price=?, description=?, category=?, image=?, composition=?, usage=?, weight=?, pack_sizes=?, old_price=?, unit=?, variants=? 
-            WHERE id=?
-        """, (
-            product.name, 
-            product.price, 
-            product.description, 
-            product.category, 
-            product.image, 
-            product.composition, 
-            product.usage, 
-            product.weight, 
-            safe_pack_sizes,  # <--- Explicitly use the converted string variable
-            old_price_val, 
-            unit_val,
-            variants_str,
-            product_id
-        ))
-        conn.commit()
+        def _update(conn):
+            conn.execute("""
+                UPDATE products 
+                SET name=?, price=?, description=?, category=?, image=?, composition=?, usage=?, weight=?, pack_sizes=?, old_price=?, unit=?, variants=? 
+                WHERE id=?
+            """, (
+                product.name, 
+                product.price, 
+                product.description, 
+                product.category, 
+                product.image, 
+                product.composition, 
+                product.usage, 
+                product.weight, 
+                safe_pack_sizes,  # <--- Explicitly use the converted string variable
+                old_price_val, 
+                unit_val,
+                variants_str,
+                product_id
+            ))
+            catalog.patch_after_commit(conn, [product_id])
+        
+        await adb.write(_update)
     except Exception as e:
         logger.error(f"CRITICAL SQL ERROR: {e}")
-        conn.rollback()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
         
     return {"message": "Product updated successfully"}
 
 @app.delete("/products/{product_id}")
 async def delete_product(product_id: int):
-    import sqlite3
-    conn = sqlite3.connect('shop.db')
-    cursor = conn.cursor()
     try:
-        cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-        conn.commit()
+        def _delete(conn):
+            deleted = conn.execute("DELETE FROM products WHERE id = ?", (product_id,)).rowcount
+            catalog.patch_after_commit(conn, deleted_ids=[product_id])
+            return deleted
         
-        if cursor.rowcount == 0:
-            conn.close()
+        deleted = await adb.write(_delete)
+        
+        if deleted == 0:
             raise HTTPException(status_code=404, detail="Product not found")
         
-        conn.close()
         return {"message": "Product deleted successfully"}
     except HTTPException:
         raise
     except Exception as e:
-        conn.close()
         logger.error(f"Error deleting product: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/all-categories")
 def get_categories():
-    conn = sqlite3.connect('shop.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    # Ensure table exists just in case
-    c.execute('CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE)')
-    
-    # Auto-migrate if empty
-    c.execute('SELECT count(*) FROM categories')
-    if c.fetchone()[0] == 0:
-        c.execute("INSERT OR IGNORE INTO categories (name) SELECT DISTINCT category FROM products WHERE category IS NOT NULL AND category != ''")
-        conn.commit()
-
-    c.execute('SELECT * FROM categories')
-    rows = c.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        c = conn.cursor()
+        # Ensure table exists just in case
+        c.execute('CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE)')
+        
+        # Auto-migrate if empty
+        c.execute('SELECT count(*) FROM categories')
+        if c.fetchone()[0] == 0:
+            c.execute("INSERT OR IGNORE INTO categories (name) SELECT DISTINCT category FROM products WHERE category IS NOT NULL AND category != ''")
+            conn.commit()
+
+        c.execute('SELECT * FROM categories')
+        rows = c.fetchall()
     return [dict(row) for row in rows]
 
 @app.post("/categories")
-def create_category(category: CategoryCreate):
+async def create_category(category: CategoryCreate):
     try:
-        conn = sqlite3.connect('shop.db')
-        c = conn.cursor()
-        c.execute('INSERT INTO categories (name) VALUES (?)', (category.name,))
-        conn.commit()
-        id = c.lastrowid
-        conn.close()
+        id, _ = await adb.execute('INSERT INTO categories (name) VALUES (?)', (category.name,))
         return {"id": id, "name": category.name}
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Category already exists")
@@ -1427,16 +1479,13 @@ def create_category(category: CategoryCreate):
 # --- UPDATE CATEGORY ---
 @app.put("/categories/{category_id}")
 async def update_category(category_id: int, category: CategoryUpdate):
-    import sqlite3
-    conn = sqlite3.connect('shop.db')
-    cursor = conn.cursor()
-    try:
+    def _rename(conn):
+        cursor = conn.cursor()
         # Check if category exists
         cursor.execute("SELECT name FROM categories WHERE id=?", (category_id,))
         result = cursor.fetchone()
         
         if not result:
-            conn.close()
             raise HTTPException(status_code=404, detail="Category not found")
         
         old_name = result[0]
@@ -1447,86 +1496,151 @@ async def update_category(category_id: int, category: CategoryUpdate):
             
             # Update all products that had the old category name
             cursor.execute("UPDATE products SET category=? WHERE category=?", (category.name, old_name))
-            
-            conn.commit()
-            conn.close()
-            return {"id": category_id, "message": "Category updated successfully"}
+            catalog.invalidate_after_commit()
         except sqlite3.IntegrityError:
-            conn.close()
             raise HTTPException(status_code=400, detail="Category with this name already exists")
+
+    try:
+        await adb.write(_rename)
+        return {"id": category_id, "message": "Category updated successfully"}
     except HTTPException:
         raise
     except Exception as e:
-        conn.close()
         logger.error(f"Error updating category: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/categories/{category_id}")
-def delete_category(category_id: int):
-    conn = sqlite3.connect('shop.db')
-    c = conn.cursor()
-    # Uncategorize products linked to this category
-    c.execute('SELECT name FROM categories WHERE id = ?', (category_id,))
-    cat = c.fetchone()
-    if cat:
-        c.execute('UPDATE products SET category = NULL WHERE category = ?', (cat[0],))
-    
-    c.execute('DELETE FROM categories WHERE id = ?', (category_id,))
-    conn.commit()
-    conn.close()
+async def delete_category(category_id: int):
+    def _delete(conn):
+        c = conn.cursor()
+        # Uncategorize products linked to this category
+        c.execute('SELECT name FROM categories WHERE id = ?', (category_id,))
+        cat = c.fetchone()
+        if cat:
+            c.execute('UPDATE products SET category = NULL WHERE category = ?', (cat[0],))
+            catalog.invalidate_after_commit()
+        
+        c.execute('DELETE FROM categories WHERE id = ?', (category_id,))
+
+    await adb.write(_delete)
     return {"message": "Deleted"}
 
 @app.get("/banners")
 def get_banners():
-    conn = sqlite3.connect('shop.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM banners')
-    rows = c.fetchall()
-    conn.close()
+    with pool.connection() as conn:
+        rows = conn.execute('SELECT * FROM banners').fetchall()
     return [dict(row) for row in rows]
 
 @app.post("/banners")
-def create_banner(banner: Banner):
-    conn = sqlite3.connect('shop.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO banners (image_url) VALUES (?)', (banner.image_url,))
-    conn.commit()
-    banner_id = c.lastrowid
-    conn.close()
+async def create_banner(banner: Banner):
+    banner_id, _ = await adb.execute('INSERT INTO banners (image_url) VALUES (?)', (banner.image_url,))
     return {"id": banner_id, "image_url": banner.image_url}
 
 @app.delete("/banners/{banner_id}")
-def delete_banner(banner_id: int):
-    conn = sqlite3.connect('shop.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM banners WHERE id = ?', (banner_id,))
-    conn.commit()
-    conn.close()
+async def delete_banner(banner_id: int):
+    await adb.execute('DELETE FROM banners WHERE id = ?', (banner_id,))
     return {"message": "Banner deleted"}
 
+ORDERS_PAGE_DEFAULT = 50
+ORDERS_PAGE_MAX = 200
+
 @app.get("/api/orders") # Ensure this matches what admin.html calls
-async def get_orders():
-    import sqlite3
-    conn = sqlite3.connect('shop.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+async def get_orders(
+    limit: int = Query(ORDERS_PAGE_DEFAULT, ge=1, le=ORDERS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    phone: Optional[str] = None,
+    sort: str = "-id",
+    count: bool = True,
+):
+    """
+    Страница заказов {"items": [...], "next_cursor": ..., "total": ...}:
+    - limit: размер страницы (по умолчанию 50, максимум 200)
+    - cursor: next_cursor из предыдущей страницы
+    - status, payment_method, phone (по окончанию номера), date_from, date_to ('YYYY-MM-DD'): фильтры
+    - sort: -id (новые сверху), id, -date, date
+    - count: считать total (только для первой страницы)
+    """
     try:
-        # Order by newest first
-        cursor.execute("SELECT * FROM orders ORDER BY id DESC")
-        return [dict(row) for row in cursor.fetchall()]
-    except Exception as e:
-        logger.error(f"Error orders: {e}")
-        return []
-    finally:
-        conn.close()
+        return await adb.read(
+            query_orders,
+            limit,
+            cursor=cursor,
+            sort=sort,
+            with_count=count,
+            status=status,
+            payment_method=payment_method,
+            date_from=date_from,
+            date_to=date_to,
+            phone=phone,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/stats/products")
+async def get_product_sales(date_from: Optional[str] = None, date_to: Optional[str] = None,
+                            status: Optional[str] = None, limit: int = Query(100, ge=1, le=1000)):
+    """Продажи по товарам за период (даты 'YYYY-MM-DD'): заказы, количество, выручка"""
+    return await adb.read(order_items.product_sales, date_from, date_to, status, limit)
+
+@app.get("/api/stats/products/{product_id}/variants")
+async def get_variant_sales(product_id: int, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                            status: Optional[str] = None):
+    """Продажи товара по вариантам (фасовкам) за период"""
+    return await adb.read(order_items.variant_sales, product_id, date_from, date_to, status)
+
+@app.get("/api/orders/changes")
+async def get_order_changes(since: Optional[int] = None, timeout: float = Query(25, ge=0, le=60)):
+    """
+    Long-poll ленты изменений заказов: изменения после курсора since, а если
+    их нет - ждет до timeout секунд первого изменения.
+    {"changes": [...], "cursor": ..., "has_more": ...}; без since - только текущий курсор.
+    """
+    if since is None:
+        return {"changes": [], "cursor": await adb.read(order_changes.latest), "has_more": False}
+    event = order_changes.subscribe()
+    page = await adb.read(order_changes.since, since)
+    if page["changes"] or timeout == 0:
+        return page
+    if await order_changes.wait(event, timeout):
+        page = await adb.read(order_changes.since, since)
+    return page
+
+@app.get("/api/orders/changes/stream")
+async def stream_order_changes(since: Optional[int] = None,
+                               last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")):
+    """
+    Та же лента как Server-Sent Events (event: order, id = курсор). Браузер
+    при переподключении сам пришлет Last-Event-ID и продолжит с него.
+    """
+    cursor = int(last_event_id) if last_event_id and last_event_id.isdigit() else since
+    if cursor is None:
+        cursor = await adb.read(order_changes.latest)
+
+    async def _events():
+        nonlocal cursor
+        yield "retry: 3000\n\n"
+        deadline = time.monotonic() + events.SSE_MAX_AGE
+        while not order_changes.closed and time.monotonic() < deadline:
+            event = order_changes.subscribe()
+            page = await adb.read(order_changes.since, cursor)
+            for change in page["changes"]:
+                yield events.format_sse(change)
+            cursor = page["cursor"]
+            if page["has_more"]:
+                continue
+            if not await order_changes.wait(event, events.SSE_HEARTBEAT):
+                yield ": ping\n\n"
+
+    return StreamingResponse(_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.put("/orders/{order_id}/status")
 async def update_order_status(order_id: int, request: Request):
     """Update the status of an order by ID"""
-    import sqlite3
-    import json
-    
     try:
         # Get new_status from JSON body
         data = await request.json()
@@ -1535,21 +1649,21 @@ async def update_order_status(order_id: int, request: Request):
         if not new_status:
             raise HTTPException(status_code=400, detail="new_status is required in request body")
         
-        conn = sqlite3.connect('shop.db')
-        cursor = conn.cursor()
-        
-        # Check if order exists
-        cursor.execute("SELECT id FROM orders WHERE id = ?", (order_id,))
-        order = cursor.fetchone()
-        
-        if not order:
-            conn.close()
-            raise HTTPException(status_code=404, detail=f"Order with id {order_id} not found")
+        def _update(conn):
+            cursor = conn.cursor()
+            
+            # Check if order exists
+            cursor.execute("SELECT id FROM orders WHERE id = ?", (order_id,))
+            order = cursor.fetchone()
+            
+            if not order:
+                raise HTTPException(status_code=404, detail=f"Order with id {order_id} not found")
+            
+            # Update the status
+            cursor.execute("UPDATE orders SET status = ? WHERE id = ?", (new_status, order_id))
+            order_changes.record(conn, order_id, events.STATUS, new_status)
         
-        # Update the status
-        cursor.execute("UPDATE orders SET status = ? WHERE id = ?", (new_status, order_id))
-        conn.commit()
-        conn.close()
+        await adb.write(_update)
         
         return {
             "message": "Order status updated successfully",
@@ -1560,159 +1674,107 @@ async def update_order_status(order_id: int, request: Request):
     except HTTPException:
         raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         logger.error(f"Error updating order status: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/orders/{order_id}")
 async def delete_order(order_id: int):
     """Delete an order by ID"""
-    import sqlite3
-    
     try:
-        conn = sqlite3.connect('shop.db')
-        cursor = conn.cursor()
-        
-        # Check if order exists
-        cursor.execute("SELECT id FROM orders WHERE id = ?", (order_id,))
-        order = cursor.fetchone()
-        
-        if not order:
-            conn.close()
-            raise HTTPException(status_code=404, detail=f"Order with ID {order_id} not found")
+        def _delete(conn):
+            cursor = conn.cursor()
+            
+            # Check if order exists
+            cursor.execute("SELECT id FROM orders WHERE id = ?", (order_id,))
+            order = cursor.fetchone()
+            
+            if not order:
+                raise HTTPException(status_code=404, detail=f"Order with ID {order_id} not found")
+            
+            # Delete the order
+            cursor.execute("DELETE FROM orders WHERE id = ?", (order_id,))
         
-        # Delete the order
-        cursor.execute("DELETE FROM orders WHERE id = ?", (order_id,))
-        conn.commit()
-        conn.close()
+        await adb.write(_delete)
         
         return {"message": f"Order {order_id} deleted successfully"}
         
     except HTTPException:
         raise
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         logger.error(f"Error deleting order: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/orders/export")
-async def export_orders_to_excel():
-    """Export all orders to Excel file"""
-    import sqlite3
-    import json
+async def export_orders_to_excel(
+    format: str = Query("xlsx"),
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    status: Optional[str] = None,
+    payment_method: Optional[str] = None,
+    background: bool = Query(False),
+):
+    """
+    Экспорт заказов (потоково, пачками по exports.EXPORT_CHUNK):
+    - format: xlsx (по умолчанию), csv или ndjson - csv/ndjson отдаются по мере чтения
+    - date_from, date_to ('YYYY-MM-DD'), status, payment_method: фильтры
+    - background=true (xlsx): собрать файл фоновой задачей, скачать из /jobs/{id}/artifact
+    """
+    if format not in exports.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {format}. Allowed: {', '.join(exports.FORMATS)}")
+    filters = {"date_from": date_from, "date_to": date_to, "status": status, "payment_method": payment_method}
+    media_type, filename = exports.FORMATS[format]
     
-    try:
-        conn = sqlite3.connect('shop.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        # Get all orders
-        cursor.execute("SELECT * FROM orders ORDER BY id DESC")
-        rows = cursor.fetchall()
-        conn.close()
-        
-        if not rows:
-            raise HTTPException(status_code=404, detail="No orders found")
-        
-        # Convert rows to list of dictionaries
-        orders_data = []
-        for row in rows:
-            order_dict = dict(row)
-            # Parse items JSON if it exists
-            if order_dict.get('items'):
-                try:
-                    order_dict['items'] = json.loads(order_dict['items'])
-                except:
-                    order_dict['items'] = []
-            orders_data.append(order_dict)
-        
-        # Create DataFrame
-        df = pd.DataFrame(orders_data)
-        
-        # Format items column for Excel display
-        if 'items' in df.columns:
-            def format_items_for_excel(items):
-                """Format items list as readable string with variant_info support"""
-                if not items:
-                    return ""
-                if isinstance(items, str):
-                    try:
-                        items = json.loads(items)
-                    except:
-                        return items
-                
-                if not isinstance(items, list):
-                    return str(items)
-                
-                formatted_items = []
-                for item in items:
-                    if isinstance(item, dict):
-                        name = item.get('name', 'Товар')
-                        quantity = item.get('quantity', 1)
-                        variant_info = item.get('variant_info')
-                        
-                        if variant_info:
-                            # Format: "Название (вариант) x количество"
-                            formatted_items.append(f"{name} ({variant_info}) x {quantity}")
-                        else:
-                            # Format: "Название x количество"
-                            formatted_items.append(f"{name} x {quantity}")
-                    else:
-                        formatted_items.append(str(item))
-                
-                return ", ".join(formatted_items)
+    if format == "xlsx":
+        if background:
+            def _run(job):
+                path = job.artifact_path(filename)
+                with pool.connection() as conn:
+                    count = exports.write_xlsx(conn, path, progress=job.progress, **filters)
+                return {"filename": filename, "orders": count, "size": os.path.getsize(path)}
             
-            # Convert items to formatted string representation for Excel
-            df['items'] = df['items'].apply(format_items_for_excel)
-        
-        # Create Excel file in memory
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Orders')
-        
-        output.seek(0)
-        
-        # Return file as StreamingResponse
-        return StreamingResponse(
-            output,
-            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            headers={
-                "Content-Disposition": "attachment; filename=orders.xlsx"
-            }
-        )
+            job = await jobs.submit("export_orders", _run, filters)
+            return job_accepted(job)
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        if 'conn' in locals():
-            conn.close()
-        logger.error(f"Error exporting orders: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        # Книга write_only собирается во временном файле вне event loop и удаляется после отправки
+        fd, path = tempfile.mkstemp(suffix=".xlsx")
+        os.close(fd)
+        try:
+            await adb.read(exports.write_xlsx, path, **filters)
+        except Exception as e:
+            os.remove(path)
+            logger.error(f"Error exporting orders: {e}")
+            raise HTTPException(status_code=500, detail=str(e))
+        return FileResponse(path, media_type=media_type, filename=filename, background=BackgroundTask(os.remove, path))
+    
+    header = exports.csv_header() if format == "csv" else ""
+    encode_chunk = exports.csv_chunk if format == "csv" else exports.ndjson_chunk
+    
+    async def _stream():
+        if header:
+            yield header
+        cursor = None
+        while True:
+            orders, cursor = await adb.read(exports.read_chunk, cursor, **filters)
+            yield encode_chunk(orders)
+            if cursor is None:
+                return
+    
+    return StreamingResponse(_stream(), media_type=media_type,
+                             headers={"Content-Disposition": f"attachment; filename={filename}"})
 
 @app.post("/orders/delete-batch")
 async def delete_orders_batch(request: DeleteBatchRequest):
     """Delete multiple orders by IDs"""
-    import sqlite3
-    
     if not request.ids or len(request.ids) == 0:
         raise HTTPException(status_code=400, detail="No order IDs provided")
     
     try:
-        conn = sqlite3.connect('shop.db')
-        cursor = conn.cursor()
-        
         # Create placeholders for IN clause (безопасный способ)
         placeholders = ','.join('?' * len(request.ids))
         
         # Delete orders (используем параметризованный запрос)
         query = f"DELETE FROM orders WHERE id IN ({placeholders})"
-        cursor.execute(query, request.ids)
-        deleted_count = cursor.rowcount
-        
-        conn.commit()
-        conn.close()
+        _, deleted_count = await adb.execute(query, request.ids)
         
         return {
             "message": f"Successfully deleted {deleted_count} order(s)",
@@ -1720,55 +1782,61 @@ async def delete_orders_batch(request: DeleteBatchRequest):
         }
         
     except Exception as e:
-        if 'conn' in locals():
-            conn.close()
         logger.error(f"Error deleting orders batch: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/create_order")
-async def create_order(order_data: OrderRequest):
-    import sqlite3, json, os, httpx
-    from datetime import datetime
-    
+async def create_order(order_data: OrderRequest,
+                       idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """
+    Оформление заказа по этапам: заказ и уведомление сохраняются одной
+    транзакцией, затем (для оплаты картой) создается счет Monobank.
+    Если банк не ответил, заказ остается в этапе awaiting_invoice и счет
+    создаст фоновая сверка (payments.reconciler); повтор запроса с тем же
+    Idempotency-Key вернет тот же заказ и попробует создать счет сразу.
+    """
     logger.info(f"📥 Получены данные от приложения: {order_data.dict()}")
 
-    # Настройка Webhook (ТВОЙ NGROK)
-    CURRENT_NGROK = "https://farrah-unenlightening-oversorrowfully.ngrok-free.dev"
-    WEBHOOK_URL = f"{CURRENT_NGROK}/monobank-webhook"
-
     try:
-        # Конвертируем totalPrice в копейки для Monobank (умножаем на 100)
-        amount = order_data.totalPrice * 100
-        
-        conn = sqlite3.connect('shop.db')
-        cursor = conn.cursor()
-        
-        # Сохраняем ВСЕ поля из OrderRequest
-        cursor.execute("""
-            INSERT INTO orders (
-                name, phone, city, cityRef, warehouse, warehouseRef,
-                items, total, totalPrice, status, payment_method, date
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            order_data.name,
-            order_data.phone,
-            order_data.city,
-            order_data.cityRef,
-            order_data.warehouse,
-            order_data.warehouseRef,
-            json.dumps([item.dict() for item in order_data.items]),
-            order_data.totalPrice,  # total для совместимости
-            order_data.totalPrice,  # totalPrice
-            "New",
-            order_data.payment_method,
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ))
-        order_id = cursor.lastrowid
-        conn.commit()
-        
-        # Отправляем Telegram уведомление (с обработкой ошибок)
-        try:
-            send_telegram_notification({
+        # Повтор того же оформления (двойное нажатие, повтор после ошибки сети)
+        if idempotency_key:
+            existing = await adb.read(payments.find_by_idempotency_key, idempotency_key)
+            if existing:
+                logger.info(f"♻️ Повтор оформления заказа #{existing['id']} (Idempotency-Key)")
+                return await payment_response(existing["id"], existing["payment_method"], existing["payment_url"])
+        
+        # Сохраняем ВСЕ поля из OrderRequest; уведомление в Telegram ставится в очередь
+        # в той же транзакции и уходит в фоне (оформление не ждет Telegram)
+        items = [item.dict() for item in order_data.items]
+        order_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        
+        def _create(conn):
+            order_id = conn.execute("""
+                INSERT INTO orders (
+                    name, phone, city, cityRef, warehouse, warehouseRef,
+                    items, total, totalPrice, status, payment_method, date,
+                    idempotency_key, payment_stage, phone_key
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                order_data.name,
+                order_data.phone,
+                order_data.city,
+                order_data.cityRef,
+                order_data.warehouse,
+                order_data.warehouseRef,
+                json.dumps(items),
+                order_data.totalPrice,  # total для совместимости
+                order_data.totalPrice,  # totalPrice
+                "New",
+                order_data.payment_method,
+                order_date,
+                idempotency_key,
+                payments.initial_stage(order_data.payment_method),
+                phone_key(order_data.phone),
+            )).lastrowid
+            order_items.insert_items(conn, order_id, items, order_date)
+            order_changes.record(conn, order_id, events.CREATED, "New")
+            outbox.enqueue(conn, "new_order", build_order_notification({
                 'name': order_data.name,
                 'phone': order_data.phone,
                 'city': order_data.city,
@@ -1776,60 +1844,57 @@ async def create_order(order_data: OrderRequest):
                 'total': order_data.totalPrice,
                 'payment_method': order_data.payment_method,
                 'order_id': order_id,
-                'items': [item.dict() for item in order_data.items]
-            })
-        except Exception as tg_error:
-            logger.warning(f"⚠️ Ошибка отправки Telegram уведомления: {tg_error}")
-            # Не прерываем выполнение, если Telegram не работает
-        
-        # Логика оплаты
-        if order_data.payment_method == "card":
-            payload = {
-                "amount": amount,
-                "ccy": 980,
-                "merchantPaymInfo": {
-                    "reference": str(order_id),
-                    "destination": "Test Purchase"
-                },
-                "redirectUrl": "https://google.com",
-                "webHookUrl": WEBHOOK_URL
-            }
-            
-            token = os.getenv("MONOBANK_API_TOKEN")
-            if not token: 
-                # Пробуем найти вручную, если env не сработал
-                try:
-                     with open('.env', 'r') as f:
-                        for line in f:
-                            if "MONOBANK_API_TOKEN" in line:
-                                token = line.split('=')[1].strip()
-                except: pass
-
-            if not token:
-                logger.error("❌ Нет токена!")
-                return {"error": "No token"}
-
-            async with httpx.AsyncClient() as client:
-                resp = await client.post("https://api.monobank.ua/api/merchant/invoice/create", 
-                                         headers={'X-Token': token}, 
-                                         json=payload)
-                
-                if resp.status_code == 200:
-                    res_json = resp.json()
-                    cursor.execute("UPDATE orders SET invoiceId = ? WHERE id = ?", (res_json['invoiceId'], order_id))
-                    conn.commit()
-                    conn.close()
-                    return {"payment_url": res_json['pageUrl']}
-                else:
-                    logger.error(f"❌ Ошибка банка: {resp.text}")
+                'items': items
+            }))
+            return order_id
         
-        conn.close()
-        return {"message": "Created", "order_id": order_id}
+        try:
+            order_id = await adb.write(_create)
+        except sqlite3.IntegrityError as e:
+            # Одновременный повтор с тем же ключом успел создать заказ первым
+            existing = await adb.read(payments.find_by_idempotency_key, idempotency_key) if idempotency_key else None
+            if existing is None:
+                # Нарушено другое ограничение - это не повтор, заказ не сохранен
+                logger.error(f"🔥 Заказ не сохранен: {e}")
+                return JSONResponse(status_code=500, content={"error": "Order could not be saved"})
+            return await payment_response(existing["id"], existing["payment_method"], existing["payment_url"])
+        
+        return await payment_response(order_id, order_data.payment_method)
 
     except Exception as e:
         logger.error(f"🔥 ОШИБКА: {e}")
         return {"error": str(e)}
 
+async def payment_response(order_id, payment_method, payment_url=None):
+    """Ответ /create_order: ссылка на оплату (этап создания счета выполняется сейчас, если нужен)"""
+    if payment_method != "card":
+        return {"message": "Created", "order_id": order_id}
+    if not payment_url:
+        try:
+            payment_url = await payments.create_invoice(order_id)
+        except payments.InvoiceError:
+            payment_url = None
+        if payment_url is None:
+            # Счет создает другой обработчик или он не удался - смотрим текущее состояние
+            state = await adb.read(payments.payment_state, order_id)
+            payment_url = state and state["payment_url"]
+    if payment_url:
+        return {"payment_url": payment_url, "order_id": order_id}
+    return {
+        "error": "Платіжний сервіс тимчасово недоступний, спробуйте ще раз",
+        "order_id": order_id,
+        "payment_stage": payments.AWAITING_INVOICE,
+        "payment_status_url": f"/orders/{order_id}/payment",
+    }
+
+@app.get("/orders/{order_id}/payment")
+async def get_order_payment(order_id: int):
+    """Этап оплаты заказа и ссылка на оплату, когда счет создан"""
+    state = await adb.read(payments.payment_state, order_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return state
+
 # --- CHAT ENDPOINT WITH GPT ---
 class ChatRequest(BaseModel):
     messages: List[dict]
@@ -1843,24 +1908,18 @@ async def chat_with_gpt(request: Request, chat_data: ChatRequest):
         if not openai_api_key:
             return {"error": "OpenAI API key not found in environment variables"}
         
-        # Загружаем список товаров
-        conn = get_db_connection()
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, price, description, category, unit FROM products")
-        rows = cursor.fetchall()
-        conn.close()
+        # Загружаем список товаров (из кэша каталога)
+        snapshot = catalog.current() or await adb.read(catalog.load)
         
         # Формируем список товаров для промпта
         products_list = []
-        for row in rows:
-            product = dict(row)
+        for product in snapshot.products:
             # Формируем краткое описание товара
             product_info = {
                 "id": product.get("id"),
                 "name": product.get("name", ""),
                 "price": product.get("price", 0),
-                "description": product.get("description", "")[:200],  # Ограничиваем длину
+                "description": (product.get("description") or "")[:200],  # Ограничиваем длину
                 "category": product.get("category", ""),
                 "unit": product.get("unit", "шт")
             }
@@ -1962,42 +2021,13 @@ async def chat_with_gpt(request: Request, chat_data: ChatRequest):
         # Получаем полные объекты рекомендованных товаров
         recommended_products = []
         if recommended_ids:
-            conn = get_db_connection()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            # Безопасный параметризованный запрос
-            placeholders = ",".join("?" * len(recommended_ids))
-            query = f"SELECT * FROM products WHERE id IN ({placeholders})"
-            cursor.execute(query, recommended_ids)
-            rows = cursor.fetchall()
-            conn.close()
-            
-            for row in rows:
-                item = dict(row)
-                # Парсим variants если есть
-                variants_val = item.get("variants")
-                if variants_val and isinstance(variants_val, str):
-                    try:
-                        item["variants"] = json.loads(variants_val)
-                    except:
-                        item["variants"] = None
-                else:
-                    item["variants"] = variants_val if variants_val else None
-                
-                # Обрабатываем изображения
-                image_value = item.get("image") or ""
-                picture_value = item.get("picture") or ""
-                image_url_value = item.get("image_url") or ""
-                if not image_url_value:
-                    item["image_url"] = image_value
-                if not picture_value and item.get("image_url"):
-                    item["picture"] = item["image_url"]
-                elif not picture_value and image_value:
-                    item["picture"] = image_value
-                    if not item.get("image_url"):
-                        item["image_url"] = image_value
-                
-                recommended_products.append(item)
+            for product_id in recommended_ids:
+                try:
+                    item = snapshot.by_id.get(int(product_id))
+                except (TypeError, ValueError):
+                    item = None
+                if item:
+                    recommended_products.append(item)
         
         return {
             "text": reply_text,
@@ -2012,6 +2042,7 @@ async def chat_with_gpt(request: Request, chat_data: ChatRequest):
 
 @app.get("/image/{filename:path}")
 async def get_optimized_image(
+    request: Request,
     filename: str,
     w: Optional[int] = None,
     h: Optional[int] = None,
@@ -2025,90 +2056,72 @@ async def get_optimized_image(
     - w: ширина (опционально)
     - h: высота (опционально)
     - q: качество (1-100, по умолчанию 85)
-    - format: формат (webp, jpg, png, по умолчанию - оригинальный или webp если поддерживается)
+    - format: формат (webp, jpg, png, avif; по умолчанию - лучший из Accept клиента, иначе оригинальный)
     
     Примеры:
     - /image/product.jpg?w=300 - ресайз до ширины 300px
     - /image/product.jpg?w=300&h=300 - ресайз до 300x300px
     - /image/product.jpg?w=300&q=80 - ресайз с качеством 80%
     - /image/product.jpg?w=300&format=webp - ресайз в WebP
+    
+    Без format формат выбирается по заголовку Accept (AVIF/WebP), ответ
+    помечается Vary: Accept, а выбранный формат входит в ключ кэша.
+    
+    Готовые варианты хранятся в дисковом кэше (image_cache), повторный
+    запрос отдает файл без обращения к Pillow. Преобразование выполняется
+    в пуле процессов (images.processor), при переполненной очереди - 503.
     """
     try:
         # Путь к оригинальному файлу
         file_path = os.path.join(UPLOADS_DIR, filename)
         
+        # Не даем выйти за пределы uploads через ../
+        if not os.path.realpath(file_path).startswith(os.path.realpath(UPLOADS_DIR) + os.sep):
+            raise HTTPException(status_code=404, detail="Image not found")
+        
         # Проверяем существование файла
-        if not os.path.exists(file_path):
+        if not os.path.isfile(file_path):
             raise HTTPException(status_code=404, detail="Image not found")
         
         # Если параметры не указаны, отдаем оригинал
         if w is None and h is None and q is None and format is None:
             return FileResponse(file_path)
         
-        # Открываем изображение
-        with PILImage.open(file_path) as img:
-            original_format = img.format or 'JPEG'
-            
-            # Ресайз с сохранением пропорций
-            if w or h:
-                # Вычисляем размеры с сохранением пропорций
-                if w and h:
-                    # Если указаны оба размера, используем их (может обрезать)
-                    new_size = (w, h)
-                elif w:
-                    # Только ширина
-                    ratio = w / img.width
-                    new_size = (w, int(img.height * ratio))
-                else:
-                    # Только высота
-                    ratio = h / img.height
-                    new_size = (int(img.width * ratio), h)
-                
-                # Ресайз с высоким качеством
-                img = img.resize(new_size, PILImage.Resampling.LANCZOS)
-            
-            # Определяем формат вывода
-            output_format = format.upper() if format else original_format
-            if output_format not in ['JPEG', 'PNG', 'WEBP']:
-                output_format = 'JPEG'
-            
-            # Конвертируем в RGB если нужно (для JPEG и WebP)
-            if output_format in ['JPEG', 'WEBP'] and img.mode in ('RGBA', 'LA', 'P'):
-                # Создаем белый фон для прозрачных изображений
-                background = PILImage.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            elif output_format == 'PNG' and img.mode != 'RGBA':
-                img = img.convert('RGBA')
-            
-            # Качество сжатия
-            quality = q if q and 1 <= q <= 100 else 85
-            
-            # Сохраняем в буфер
-            output_buffer = io.BytesIO()
-            
-            if output_format == 'WEBP':
-                img.save(output_buffer, format='WEBP', quality=quality, method=6)
-                media_type = 'image/webp'
-            elif output_format == 'PNG':
-                img.save(output_buffer, format='PNG', optimize=True)
-                media_type = 'image/png'
-            else:
-                img.save(output_buffer, format='JPEG', quality=quality, optimize=True)
-                media_type = 'image/jpeg'
-            
-            output_buffer.seek(0)
-            
-            # Возвращаем оптимизированное изображение
-            return StreamingResponse(
-                output_buffer,
-                media_type=media_type,
-                headers={
-                    "Cache-Control": "public, max-age=31536000",  # Кэш на 1 год
-                }
+        # Формат не задан явно - выбираем по Accept (клиенту без WebP/AVIF - оригинальный)
+        negotiated = format is None
+        if negotiated:
+            format = images.negotiate_format(request.headers.get("accept"))
+        
+        output_format, quality = images.resolve_output(file_path, q, format)
+        extension, media_type = images.OUTPUT_FORMATS[output_format]
+        key = images.variant_key(file_path, w, h, quality, output_format)
+        headers = {
+            "Cache-Control": "public, max-age=31536000",  # Кэш на 1 год
+            "ETag": f'"{key[:32]}"',
+        }
+        if negotiated:
+            # Прокси и CDN должны хранить варианты отдельно для разных Accept
+            headers["Vary"] = "Accept"
+        
+        if headers["ETag"] in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers=headers)
+        
+        cached_path = await run_in_threadpool(image_cache.get, key, extension)
+        if cached_path:
+            return FileResponse(cached_path, media_type=media_type, headers=headers)
+        
+        # Ресайз в пуле процессов; одинаковые одновременные запросы ждут одно преобразование
+        try:
+            data = await images.processor.transform(
+                key, file_path, w, h, quality, output_format,
+                store=lambda data: image_cache.put(key, extension, data),
             )
+        except images.ImageQueueFull:
+            raise HTTPException(status_code=503, detail="Image processing queue is full, retry later",
+                                headers={"Retry-After": "1"})
+        
+        # Возвращаем оптимизированное изображение
+        return Response(content=data, media_type=media_type, headers=headers)
             
     except HTTPException:
         raise
@@ -2130,4 +2143,5 @@ if __name__ == "__main__":
     import uvicorn
     # Используем 0.0.0.0 чтобы слушать на всех интерфейсах
     # Это позволит подключаться и по localhost, и по IP адресу
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    # Открытые SSE-потоки ленты заказов не должны задерживать остановку
+    uvicorn.run(app, host="0.0.0.0", port=8001, timeout_graceful_shutdown=10)
@@ -0,0 +1,284 @@
+"""
+Очередь уведомлений в Telegram (outbox).
+
+Оформление заказа не ждет Telegram: текст уведомления записывается в
+таблицу notification_outbox в той же транзакции, что и сам заказ (или смена
+статуса оплаты), и отправляется фоновым потоком. Уведомление не теряется,
+если Telegram недоступен или сервер перезапустился: строка остается pending,
+пока не будет доставлена.
+
+Отправка:
+- короткое окно TELEGRAM_BATCH_WINDOW собирает всплеск уведомлений, и
+  несколько сообщений в один чат уходят одной сводкой (digest), разбитой
+  по лимиту длины сообщения Telegram;
+- между сообщениями в один чат - не меньше TELEGRAM_MIN_INTERVAL секунд
+  (ограничения Bot API), ответ 429 ставит отправку на паузу на retry_after;
+- ошибки повторяются с растущей паузой (с разбросом), после
+  TELEGRAM_MAX_ATTEMPTS попыток уведомление помечается failed.
+
+Записи в базу идут через поток-писатель AsyncDatabase.
+"""
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import httpx
+
+from db import pool, adb
+from http_clients import http_clients
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BATCH_WINDOW = float(os.getenv("TELEGRAM_BATCH_WINDOW", "2"))
+TELEGRAM_MIN_INTERVAL = float(os.getenv("TELEGRAM_MIN_INTERVAL", "1"))
+TELEGRAM_MAX_ATTEMPTS = int(os.getenv("TELEGRAM_MAX_ATTEMPTS", "10"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+# Лимит длины сообщения Bot API
+TELEGRAM_MAX_LENGTH = 4096
+OUTBOX_BATCH = 50
+RETRY_MAX_DELAY = 600
+DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+PENDING, SENT, FAILED = "pending", "sent", "failed"
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def build_digests(texts, limit=TELEGRAM_MAX_LENGTH):
+    """Склеивает сообщения в сводки не длиннее limit; [(текст, сколько сообщений внутри)]"""
+    if len(texts) == 1:
+        return [(texts[0][:limit], 1)]
+    chunks, current = [], []
+    for text in texts:
+        text = text[:limit - 100]
+        if current and len(DIGEST_SEPARATOR.join(current + [text])) > limit - 100:
+            chunks.append(current)
+            current = []
+        current.append(text)
+    if current:
+        chunks.append(current)
+    return [(f"📬 Сводка: {len(chunk)} уведомл.\n\n" + DIGEST_SEPARATOR.join(chunk), len(chunk))
+            if len(chunk) > 1 else (chunk[0], 1) for chunk in chunks]
+
+
+class TelegramOutbox:
+    def __init__(self, pool, adb):
+        self.pool = pool
+        self.adb = adb
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        # chat_id -> время последней отправки (time.monotonic)
+        self._last_sent = {}
+        self._paused_until = 0.0
+        self._stats = {"sent": 0, "digests": 0, "failed": 0, "retries": 0, "rate_limited": 0, "last_error": None}
+
+    def ensure_table(self, conn):
+        """Создает таблицу outbox и чистит старые доставленные уведомления"""
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS notification_outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    chat_id TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    parse_mode TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    error TEXT,
+                    created_at TEXT,
+                    sent_at TEXT
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON notification_outbox (status, next_attempt_at)")
+            cutoff = (datetime.now() - timedelta(days=OUTBOX_RETENTION_DAYS)).isoformat(timespec="seconds")
+            conn.execute("DELETE FROM notification_outbox WHERE status != ? AND created_at < ?", (PENDING, cutoff))
+            conn.commit()
+            logger.info("✅ Таблица notification_outbox готова.")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка создания таблицы notification_outbox: {e}")
+
+    def enqueue(self, conn, kind, text, parse_mode="HTML", chat_id=None):
+        """
+        Ставит уведомление в очередь в текущей транзакции conn; отправка
+        начнется после коммита. Без TELEGRAM_BOT_TOKEN / TELEGRAM_CHAT_ID
+        уведомление не создается. Возвращает id или None.
+        """
+        chat_id = chat_id or os.getenv("TELEGRAM_CHAT_ID")
+        if not os.getenv("TELEGRAM_BOT_TOKEN") or not chat_id:
+            logger.warning("⚠️ TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID not configured. Skipping notification.")
+            return None
+        notification_id = conn.execute(
+            "INSERT INTO notification_outbox (kind, chat_id, text, parse_mode, created_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, str(chat_id), text, parse_mode, _now()),
+        ).lastrowid
+        self.pool.after_commit(self.wake)
+        return notification_id
+
+    def wake(self):
+        """Будит поток отправки (и запускает его, если он еще не работает)"""
+        self.start()
+        self._wake.set()
+
+    def start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._loop, name="telegram-outbox", daemon=True)
+                self._thread.start()
+
+    # --- Отправка ---
+
+    def _due(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT id, chat_id, text, parse_mode, attempts FROM notification_outbox
+                WHERE status = ? AND next_attempt_at <= ?
+                ORDER BY id LIMIT ?
+            ''', (PENDING, time.time(), OUTBOX_BATCH)).fetchall()
+            next_at = None
+            if not rows:
+                next_at = conn.execute(
+                    "SELECT MIN(next_attempt_at) FROM notification_outbox WHERE status = ?", (PENDING,)
+                ).fetchone()[0]
+        return [dict(row) for row in rows], next_at
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                rows, next_at = self._due()
+            except Exception as e:
+                logger.error(f"❌ Очередь уведомлений недоступна: {e}")
+                rows, next_at = [], time.time() + 30
+            if not rows:
+                timeout = None if next_at is None else max(0.0, next_at - time.time())
+                self._wake.wait(timeout)
+                self._wake.clear()
+                if not self._stop.is_set():
+                    # Даем всплеску уведомлений собраться в одну сводку
+                    self._stop.wait(TELEGRAM_BATCH_WINDOW)
+                continue
+            try:
+                self._dispatch(rows)
+            except Exception as e:
+                logger.error(f"❌ Ошибка отправки уведомлений: {e}")
+                self._stop.wait(5)
+
+    def _dispatch(self, rows):
+        by_chat = {}
+        for row in rows:
+            by_chat.setdefault(row["chat_id"], []).append(row)
+        for chat_id, chat_rows in by_chat.items():
+            # Сводка собирается из сообщений с одинаковой разметкой
+            by_mode = {}
+            for row in chat_rows:
+                by_mode.setdefault(row["parse_mode"], []).append(row)
+            for parse_mode, mode_rows in by_mode.items():
+                offset = 0
+                for text, count in build_digests([row["text"] for row in mode_rows]):
+                    batch = mode_rows[offset:offset + count]
+                    offset += count
+                    if not self._send_batch(chat_id, text, parse_mode, batch):
+                        return
+
+    def _throttle(self, chat_id):
+        wait = max(self._paused_until - time.monotonic(),
+                   self._last_sent.get(chat_id, 0.0) + TELEGRAM_MIN_INTERVAL - time.monotonic())
+        if wait > 0:
+            self._stop.wait(wait)
+
+    def _send_batch(self, chat_id, text, parse_mode, batch):
+        """Отправляет сообщение за batch строк; False - прервать текущий проход (429)"""
+        token = os.getenv("TELEGRAM_BOT_TOKEN")
+        ids = [row["id"] for row in batch]
+        if not token:
+            self._mark_failed(batch, "TELEGRAM_BOT_TOKEN not configured", final=True)
+            return True
+        self._throttle(chat_id)
+        payload = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        try:
+            response = http_clients.request_blocking(
+                "telegram", "POST", f"https://api.telegram.org/bot{token}/sendMessage", json=payload,
+            )
+        except httpx.HTTPError as e:
+            self._mark_failed(batch, f"{type(e).__name__}: {e}")
+            return True
+        finally:
+            self._last_sent[chat_id] = time.monotonic()
+
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.json().get("parameters", {}).get("retry_after", 5))
+            except ValueError:
+                retry_after = 5.0
+            self._stats["rate_limited"] += 1
+            self._paused_until = time.monotonic() + retry_after
+            logger.warning(f"⏳ Telegram ограничил отправку, пауза {retry_after:.0f}с")
+            return False
+        if response.status_code != 200:
+            # 4xx (кроме 429) не исправится повтором: неверный чат, токен или разметка
+            self._mark_failed(batch, f"HTTP {response.status_code}: {response.text[:200]}",
+                              final=400 <= response.status_code < 500)
+            return True
+
+        def _mark_sent(conn):
+            conn.executemany(
+                "UPDATE notification_outbox SET status = ?, sent_at = ?, error = NULL WHERE id = ?",
+                [(SENT, _now(), notification_id) for notification_id in ids],
+            )
+        self.adb.write_blocking(_mark_sent)
+        self._stats["sent"] += len(ids)
+        if len(ids) > 1:
+            self._stats["digests"] += 1
+        logger.info(f"✈️ Telegram: отправлено уведомлений {len(ids)}" + (" (сводка)" if len(ids) > 1 else ""))
+        return True
+
+    def _mark_failed(self, batch, error, final=False):
+        self._stats["last_error"] = error
+        updates = []
+        for row in batch:
+            attempts = row["attempts"] + 1
+            if final or attempts >= TELEGRAM_MAX_ATTEMPTS:
+                status, next_at = FAILED, 0
+                self._stats["failed"] += 1
+            else:
+                status = PENDING
+                next_at = time.time() + random.uniform(0.5, 1.0) * min(RETRY_MAX_DELAY, 5 * 2 ** attempts)
+                self._stats["retries"] += 1
+            updates.append((status, attempts, next_at, error, row["id"]))
+
+        def _update(conn):
+            conn.executemany(
+                "UPDATE notification_outbox SET status = ?, attempts = ?, next_attempt_at = ?, error = ? WHERE id = ?",
+                updates,
+            )
+        self.adb.write_blocking(_update)
+        logger.error(f"❌ Не удалось отправить уведомление в Telegram: {error}")
+
+    def metrics(self):
+        try:
+            with self.pool.connection() as conn:
+                pending = conn.execute(
+                    "SELECT COUNT(*) FROM notification_outbox WHERE status = ?", (PENDING,)
+                ).fetchone()[0]
+        except Exception:
+            pending = None
+        return {"pending": pending, **self._stats}
+
+    def shutdown(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+
+outbox = TelegramOutbox(pool, adb)
@@ -0,0 +1,331 @@
+"""
+Локальный справочник Новой Почты (города и отделения) в SQLite.
+
+Автодополнение в оформлении заказа не ходит в API Новой Почты на каждое
+нажатие клавиши: города и отделения раз в NP_REFRESH_HOURS скачиваются
+фоновым потоком постранично (Address.getCities / Address.getWarehouses) и
+хранятся в таблицах np_cities и np_warehouses.
+
+Поиск города - по нормализованному ключу (normalize_name: регистр,
+апострофы, ґ/ї/ё, латинская i, префиксы «м.», «с.»): сначала префикс по
+индексу (украинское и русское название), затем, для запросов от 3 символов,
+подстрока по триграммному индексу FTS5. Выше - города с большим числом
+отделений. Отделения - выборка по индексу city_ref.
+
+Обновление не трогает старые данные, пока не скачано все: строки
+помечаются временем обновления, а устаревшие удаляются последней
+транзакцией. Если Новая Почта недоступна, справочник продолжает отвечать
+последней удачной версией. Записи идут через поток-писатель AsyncDatabase.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+from db import adb
+from http_clients import http_clients
+
+logger = logging.getLogger(__name__)
+
+NP_API_URL = "https://api.novaposhta.ua/v2.0/json/"
+NP_REFRESH_HOURS = float(os.getenv("NP_REFRESH_HOURS", "24"))
+# Пауза перед повтором после неудачного обновления
+NP_RETRY_MINUTES = float(os.getenv("NP_RETRY_MINUTES", "15"))
+NP_PAGE_SIZE = 500
+NP_SEARCH_LIMIT = 50
+
+# Сокращения типа населенного пункта для подписи «м. Київ, Київська обл.»
+SETTLEMENT_PREFIXES = {
+    "місто": "м.",
+    "село": "с.",
+    "селище": "с-ще",
+    "селище міського типу": "смт",
+}
+
+_FOLD = str.maketrans({
+    "ґ": "г", "ї": "і", "ё": "е", "ъ": None,
+    # Латинская i вместо украинской і (раскладка без украинских букв)
+    "i": "і",
+    "'": None, "’": None, "ʼ": None, "`": None, "‘": None, "\"": None,
+    "-": " ", ".": " ", ",": " ", "(": " ", ")": " ",
+})
+_SETTLEMENT_PREFIX_RE = re.compile(r"^(м|с|смт|с ще|селище|село|місто|город|г|пгт)\s+")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_name(text):
+    """Ключ поиска для названия города или запроса пользователя"""
+    key = _SPACES_RE.sub(" ", (text or "").lower().translate(_FOLD)).strip()
+    return _SETTLEMENT_PREFIX_RE.sub("", key)
+
+
+def city_label(city):
+    """Подпись как у searchSettlements: «м. Київ, Київська обл.»"""
+    prefix = SETTLEMENT_PREFIXES.get((city.get("SettlementTypeDescription") or "").lower())
+    label = f"{prefix} {city['Description']}" if prefix else city["Description"]
+    area = city.get("AreaDescription")
+    return f"{label}, {area} обл." if area else label
+
+
+def _warehouse_number(item):
+    try:
+        return int(item.get("Number") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class NovaPoshtaDirectory:
+    def __init__(self, adb, api_key=None, refresh_hours=NP_REFRESH_HOURS):
+        self.adb = adb
+        # None - ключ NOVA_POSHTA_API_KEY читается при каждом обновлении
+        # (main загружает .env уже после импорта модуля)
+        self.api_key = api_key
+        self.refresh_interval = timedelta(hours=refresh_hours)
+        self.fts_available = True
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._state = {
+            "cities": 0, "warehouses": 0, "refreshed_at": None, "refreshing": False,
+            "last_duration_s": None, "last_error": None,
+        }
+
+    @property
+    def ready(self):
+        """Справочник уже загружен хотя бы раз"""
+        return self._state["cities"] > 0
+
+    def ensure_tables(self, conn):
+        """Создает таблицы справочника и индексы поиска"""
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS np_cities (
+                    ref TEXT PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    description_ru TEXT,
+                    label TEXT NOT NULL,
+                    search_key TEXT NOT NULL,
+                    search_key_ru TEXT,
+                    warehouses INTEGER DEFAULT 0,
+                    refreshed_at TEXT
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_np_cities_key ON np_cities (search_key)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_np_cities_key_ru ON np_cities (search_key_ru)")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS np_warehouses (
+                    ref TEXT PRIMARY KEY,
+                    city_ref TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    number INTEGER DEFAULT 0,
+                    refreshed_at TEXT
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_np_warehouses_city ON np_warehouses (city_ref, number)")
+            try:
+                # Подстрока в названии («церква» -> «Біла Церква»); индекс перестраивается после обновления
+                conn.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS np_cities_fts USING fts5(
+                        search_key, search_key_ru,
+                        content='np_cities',
+                        tokenize='trigram'
+                    )
+                ''')
+            except Exception as e:
+                self.fts_available = False
+                logger.warning(f"⚠️ Триграммный поиск городов недоступен (нужен SQLite >= 3.34): {e}")
+            conn.commit()
+            self._load_state(conn)
+            logger.info(f"✅ Справочник Новой Почты: {self._state['cities']} городов, {self._state['warehouses']} отделений")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка создания таблиц справочника Новой Почты: {e}")
+
+    def _load_state(self, conn):
+        cities, refreshed_at = conn.execute("SELECT COUNT(*), MAX(refreshed_at) FROM np_cities").fetchone()
+        warehouses = conn.execute("SELECT COUNT(*) FROM np_warehouses").fetchone()[0]
+        with self._lock:
+            self._state.update(cities=cities, warehouses=warehouses, refreshed_at=refreshed_at)
+
+    # --- Поиск ---
+
+    def _search_cities(self, conn, query, limit):
+        key = normalize_name(query)
+        if len(key) < 2:
+            return []
+        upper = key + "\uffff"
+        rows = conn.execute('''
+            SELECT ref, label FROM np_cities
+            WHERE (search_key >= ? AND search_key < ?) OR (search_key_ru >= ? AND search_key_ru < ?)
+            ORDER BY (search_key = ? OR search_key_ru = ?) DESC, warehouses DESC, length(search_key)
+            LIMIT ?
+        ''', (key, upper, key, upper, key, key, limit)).fetchall()
+        cities = [{"Ref": row["ref"], "Description": row["label"]} for row in rows]
+
+        if len(cities) < limit and len(key) >= 3 and self.fts_available:
+            seen = {city["Ref"] for city in cities}
+            match = '"' + key.replace('"', '""') + '"'
+            rows = conn.execute('''
+                SELECT c.ref, c.label FROM np_cities_fts
+                JOIN np_cities c ON c.rowid = np_cities_fts.rowid
+                WHERE np_cities_fts MATCH ?
+                ORDER BY c.warehouses DESC, length(c.search_key)
+                LIMIT ?
+            ''', (match, limit)).fetchall()
+            for row in rows:
+                if row["ref"] not in seen and len(cities) < limit:
+                    cities.append({"Ref": row["ref"], "Description": row["label"]})
+        return cities
+
+    async def search_cities(self, query, limit=NP_SEARCH_LIMIT):
+        """Города по началу или части названия: [{"Ref", "Description"}]"""
+        return await self.adb.read(self._search_cities, query, limit)
+
+    async def warehouses(self, city_ref):
+        """Отделения города по номеру: [{"Ref", "Description"}]"""
+        rows = await self.adb.fetch_all(
+            "SELECT ref, description FROM np_warehouses WHERE city_ref = ? ORDER BY number, description",
+            (city_ref,),
+        )
+        return [{"Ref": row["ref"], "Description": row["description"]} for row in rows]
+
+    # --- Обновление ---
+
+    def _fetch_pages(self, method, api_key):
+        """Постранично выгружает справочник (генератор страниц)"""
+        page = 1
+        while True:
+            response = http_clients.request_blocking("novaposhta", "POST", NP_API_URL, json={
+                "apiKey": api_key,
+                "modelName": "Address",
+                "calledMethod": method,
+                "methodProperties": {"Page": str(page), "Limit": str(NP_PAGE_SIZE)},
+            })
+            response.raise_for_status()
+            payload = response.json()
+            if not payload.get("success"):
+                raise RuntimeError(f"{method}: {payload.get('errors') or payload.get('warnings')}")
+            data = payload.get("data") or []
+            if not data:
+                return
+            yield data
+            if len(data) < NP_PAGE_SIZE:
+                return
+            page += 1
+
+    @staticmethod
+    def _write_cities(conn, cities, stamp):
+        conn.executemany('''
+            INSERT INTO np_cities (ref, description, description_ru, label, search_key, search_key_ru, refreshed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(ref) DO UPDATE SET
+                description = excluded.description, description_ru = excluded.description_ru,
+                label = excluded.label, search_key = excluded.search_key,
+                search_key_ru = excluded.search_key_ru, refreshed_at = excluded.refreshed_at
+        ''', [
+            (c["Ref"], c["Description"], c.get("DescriptionRu"), city_label(c),
+             normalize_name(c["Description"]), normalize_name(c.get("DescriptionRu")) or None, stamp)
+            for c in cities if c.get("Ref") and c.get("Description")
+        ])
+
+    @staticmethod
+    def _write_warehouses(conn, warehouses, stamp):
+        conn.executemany('''
+            INSERT INTO np_warehouses (ref, city_ref, description, number, refreshed_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(ref) DO UPDATE SET
+                city_ref = excluded.city_ref, description = excluded.description,
+                number = excluded.number, refreshed_at = excluded.refreshed_at
+        ''', [
+            (w["Ref"], w["CityRef"], w["Description"], _warehouse_number(w), stamp)
+            for w in warehouses if w.get("Ref") and w.get("CityRef") and w.get("Description")
+        ])
+
+    def _finish_refresh(self, conn, stamp):
+        """Удаляет то, чего больше нет у Новой Почты, и пересчитывает ранжирование"""
+        removed = conn.execute("DELETE FROM np_warehouses WHERE refreshed_at < ?", (stamp,)).rowcount
+        removed += conn.execute("DELETE FROM np_cities WHERE refreshed_at < ?", (stamp,)).rowcount
+        conn.execute('''
+            UPDATE np_cities SET warehouses = (
+                SELECT COUNT(*) FROM np_warehouses w WHERE w.city_ref = np_cities.ref
+            )
+        ''')
+        if self.fts_available:
+            conn.execute("INSERT INTO np_cities_fts(np_cities_fts) VALUES ('rebuild')")
+        self._load_state(conn)
+        return removed
+
+    def refresh(self):
+        """Полное обновление справочника (блокирующая, выполняется в фоновом потоке)"""
+        started = time.perf_counter()
+        stamp = datetime.now().isoformat(timespec="microseconds")
+        api_key = self.api_key or os.getenv("NOVA_POSHTA_API_KEY", "")
+        with self._lock:
+            self._state["refreshing"] = True
+        try:
+            cities = warehouses = 0
+            for page in self._fetch_pages("getCities", api_key):
+                self.adb.write_blocking(self._write_cities, page, stamp)
+                cities += len(page)
+            for page in self._fetch_pages("getWarehouses", api_key):
+                self.adb.write_blocking(self._write_warehouses, page, stamp)
+                warehouses += len(page)
+            if not cities:
+                raise RuntimeError("getCities returned no cities")
+            removed = self.adb.write_blocking(self._finish_refresh, stamp)
+            duration = time.perf_counter() - started
+            with self._lock:
+                self._state.update(last_duration_s=round(duration, 1), last_error=None)
+            logger.info(f"✅ Справочник Новой Почты обновлен: {cities} городов, {warehouses} отделений, "
+                        f"удалено {removed}, {duration:.1f}с")
+        except Exception as e:
+            with self._lock:
+                self._state["last_error"] = str(e)
+            raise
+        finally:
+            with self._lock:
+                self._state["refreshing"] = False
+
+    def _next_refresh_delay(self):
+        refreshed_at = self._state["refreshed_at"]
+        if not refreshed_at:
+            return 0
+        due = datetime.fromisoformat(refreshed_at) + self.refresh_interval
+        return max(0.0, (due - datetime.now()).total_seconds())
+
+    def _loop(self):
+        while not self._stop.is_set():
+            delay = self._next_refresh_delay()
+            if delay > 0:
+                self._wake.wait(delay)
+                self._wake.clear()
+                if self._stop.is_set():
+                    return
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"❌ Не удалось обновить справочник Новой Почты: {e}")
+                self._wake.wait(NP_RETRY_MINUTES * 60)
+                self._wake.clear()
+
+    def start(self):
+        """Запускает фоновое обновление (сразу, если справочник пуст или устарел)"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="np-directory", daemon=True)
+            self._thread.start()
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._state)
+
+    def shutdown(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+
+directory = NovaPoshtaDirectory(adb)
@@ -0,0 +1,189 @@
+"""
+Позиции заказов в отдельной таблице order_items.
+
+Корзина раньше хранилась только JSON-строкой в orders.items, и любое
+чтение заказов разбирало JSON каждой строки, а продажи по товарам нельзя
+было посчитать запросом. Теперь позиции пишутся в order_items в той же
+транзакции, что и заказ (orders.items остается для совместимости со
+старыми клиентами), а статистика по товарам и вариантам - обычные
+агрегаты SQL по индексам (product_id, order_date) и (order_date).
+
+order_date копирует orders.date, чтобы отбор по периоду не требовал
+соединения с orders. Позиции удаляются вместе с заказом (ON DELETE
+CASCADE, PRAGMA foreign_keys включена в пуле). Заказы, созданные до
+появления таблицы, переносятся при старте (backfill).
+"""
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH = 500
+
+COLUMNS = ("order_id", "position", "product_id", "name", "variant_info", "pack_size", "unit",
+           "price", "quantity", "line_total", "order_date")
+
+
+def ensure_table(conn):
+    """Создает order_items с индексами и переносит позиции старых заказов"""
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS order_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_id INTEGER NOT NULL REFERENCES orders (id) ON DELETE CASCADE,
+                position INTEGER NOT NULL,
+                product_id INTEGER,
+                name TEXT,
+                variant_info TEXT,
+                pack_size TEXT,
+                unit TEXT,
+                price REAL,
+                quantity INTEGER,
+                line_total REAL,
+                order_date TEXT
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items (product_id, order_date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_date ON order_items (order_date)")
+        conn.commit()
+        logger.info("✅ Таблица order_items готова.")
+    except Exception as e:
+        logger.error(f"⚠️ Ошибка создания таблицы order_items: {e}")
+        return
+    try:
+        backfilled = backfill(conn)
+        if backfilled:
+            logger.info(f"✅ Позиции перенесены в order_items: {backfilled} заказ(ов)")
+    except Exception as e:
+        logger.error(f"⚠️ Ошибка переноса позиций в order_items: {e}")
+
+
+def _number(value, cast, default):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def item_rows(order_id, items, order_date):
+    """Позиции корзины (список dict, как в OrderRequest.items) -> строки order_items"""
+    rows = []
+    for position, item in enumerate(items or []):
+        if not isinstance(item, dict):
+            continue
+        price = _number(item.get("price"), float, 0.0)
+        quantity = _number(item.get("quantity"), int, 1)
+        pack_size = item.get("packSize")
+        rows.append((
+            order_id,
+            position,
+            _number(item.get("id"), int, None),
+            item.get("name"),
+            item.get("variant_info"),
+            str(pack_size) if pack_size is not None else None,
+            item.get("unit"),
+            price,
+            quantity,
+            price * quantity,
+            order_date,
+        ))
+    return rows
+
+
+def insert_items(conn, order_id, items, order_date):
+    """Записывает позиции заказа в текущей транзакции conn"""
+    conn.executemany(
+        f"INSERT INTO order_items ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+        item_rows(order_id, items, order_date),
+    )
+
+
+def backfill(conn):
+    """Переносит позиции из orders.items для заказов без строк в order_items; возвращает число заказов"""
+    done, last_id = 0, 0
+    while True:
+        orders = conn.execute('''
+            SELECT o.id, o.items, o.date FROM orders o
+            WHERE o.id > ? AND o.items IS NOT NULL AND o.items != ''
+              AND NOT EXISTS (SELECT 1 FROM order_items i WHERE i.order_id = o.id)
+            ORDER BY o.id LIMIT ?
+        ''', (last_id, BACKFILL_BATCH)).fetchall()
+        if not orders:
+            return done
+        for order in orders:
+            try:
+                items = json.loads(order["items"])
+            except ValueError:
+                continue
+            insert_items(conn, order["id"], items if isinstance(items, list) else [], order["date"])
+            done += 1
+        last_id = orders[-1]["id"]
+        conn.commit()
+
+
+def items_by_order(conn, order_ids):
+    """{order_id: [позиции]} для списка заказов, в порядке корзины"""
+    result = {order_id: [] for order_id in order_ids}
+    ids = list(result)
+    # Лимит числа параметров SQLite - запрашиваем частями
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        rows = conn.execute(f'''
+            SELECT order_id, product_id, name, variant_info, pack_size, unit, price, quantity, line_total
+            FROM order_items WHERE order_id IN ({','.join('?' * len(chunk))})
+            ORDER BY order_id, position
+        ''', chunk).fetchall()
+        for row in rows:
+            item = dict(row)
+            result[item.pop("order_id")].append(item)
+    return result
+
+
+def _period(date_from, date_to, status, alias="i"):
+    """Условия отбора по периоду (строки 'YYYY-MM-DD[ HH:MM:SS]') и статусу заказа"""
+    where, params = [], []
+    if date_from:
+        where.append(f"{alias}.order_date >= ?")
+        params.append(date_from)
+    if date_to:
+        # Дата без времени включает весь день
+        where.append(f"{alias}.order_date <= ?")
+        params.append(date_to if len(date_to) > 10 else f"{date_to} 23:59:59")
+    if status:
+        where.append(f"{alias}.order_id IN (SELECT id FROM orders WHERE status = ?)")
+        params.append(status)
+    return where, params
+
+
+def product_sales(conn, date_from=None, date_to=None, status=None, limit=100):
+    """Продажи по товарам за период: заказы, количество и выручка, по убыванию выручки"""
+    where, params = _period(date_from, date_to, status)
+    rows = conn.execute(f'''
+        SELECT i.product_id, MAX(i.name) AS name,
+               COUNT(DISTINCT i.order_id) AS orders,
+               SUM(i.quantity) AS quantity,
+               SUM(i.line_total) AS revenue
+        FROM order_items i
+        {"WHERE " + " AND ".join(where) if where else ""}
+        GROUP BY i.product_id
+        ORDER BY revenue DESC
+        LIMIT ?
+    ''', (*params, limit)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def variant_sales(conn, product_id, date_from=None, date_to=None, status=None):
+    """Продажи товара в разрезе вариантов (variant_info / pack_size)"""
+    where, params = _period(date_from, date_to, status)
+    rows = conn.execute(f'''
+        SELECT COALESCE(i.variant_info, i.pack_size) AS variant,
+               COUNT(DISTINCT i.order_id) AS orders,
+               SUM(i.quantity) AS quantity,
+               SUM(i.line_total) AS revenue
+        FROM order_items i
+        WHERE {" AND ".join(["i.product_id = ?", *where])}
+        GROUP BY variant
+        ORDER BY revenue DESC
+    ''', (product_id, *params)).fetchall()
+    return [dict(row) for row in rows]
@@ -0,0 +1,140 @@
+"""
+Список заказов для админки: keyset пагинация, фильтры и счетчик.
+
+Админка опрашивает /api/orders каждые несколько секунд, поэтому ответ
+ограничен страницей (limit), а следующая страница берется по курсору
+(id или дата последнего заказа) - без OFFSET, стоимость запроса не зависит
+от того, насколько глубоко пролистан список и сколько всего заказов.
+Фильтры (статус, способ оплаты, период, телефон) опираются на индексы
+вида (колонка, id), так что страница с фильтром тоже читается по индексу.
+
+Поиск по телефону - по окончанию номера: в phone_key хранятся цифры
+номера в обратном порядке, и «+380 67 123-45-67», «0671234567» и
+«671234567» находятся одним запросом по диапазону индекса.
+"""
+import logging
+import re
+
+from catalog import encode_cursor, decode_cursor
+import order_items
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних цифр номера сравнивается (номер абонента без кода страны)
+PHONE_MATCH_DIGITS = 9
+
+SORT_KEYS = {
+    "-id": ("id", True),
+    "id": ("id", False),
+    "-date": ("date", True),
+    "date": ("date", False),
+}
+
+# Колонки заказа в ответе списка: служебные (idempotency_key, payment_url, invoice_*,
+# phone_key) наружу не отдаются; позиции (items) берутся из order_items
+PUBLIC_COLUMNS = ("id", "date", "name", "phone", "user_email", "city", "cityRef", "warehouse", "warehouseRef",
+                  "total", "totalPrice", "status", "payment_method", "payment_stage", "payment_status", "invoiceId")
+
+INDEXES = {
+    "idx_orders_status": "status, id",
+    "idx_orders_payment_method": "payment_method, id",
+    "idx_orders_date": "date, id",
+    "idx_orders_phone_key": "phone_key, id",
+}
+
+
+def phone_key(phone):
+    """Цифры номера в обратном порядке (для поиска по окончанию номера)"""
+    return re.sub(r"\D", "", str(phone or ""))[::-1]
+
+
+def ensure_order_indexes(conn):
+    """Колонка phone_key (с заполнением для старых заказов) и индексы фильтров списка заказов"""
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(orders)").fetchall()}
+        if "phone_key" not in columns:
+            conn.execute("ALTER TABLE orders ADD COLUMN phone_key TEXT")
+            logger.info("✅ Добавлена колонка phone_key в orders")
+        rows = conn.execute("SELECT id, phone FROM orders WHERE phone_key IS NULL").fetchall()
+        conn.executemany("UPDATE orders SET phone_key = ? WHERE id = ?",
+                         [(phone_key(row["phone"]), row["id"]) for row in rows])
+        for name, columns in INDEXES.items():
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON orders ({columns})")
+        conn.commit()
+        logger.info("✅ Индексы orders созданы.")
+    except Exception as e:
+        logger.error(f"⚠️ Ошибка создания индексов orders: {e}")
+
+
+def _filters(status=None, payment_method=None, date_from=None, date_to=None, phone=None):
+    where, params = [], []
+    if status:
+        where.append("status = ?")
+        params.append(status)
+    if payment_method:
+        where.append("payment_method = ?")
+        params.append(payment_method)
+    if date_from:
+        where.append("date >= ?")
+        params.append(date_from)
+    if date_to:
+        # Дата без времени включает весь день
+        where.append("date <= ?")
+        params.append(date_to if len(date_to) > 10 else f"{date_to} 23:59:59")
+    if phone:
+        key = phone_key(phone)[:PHONE_MATCH_DIGITS]
+        if not key:
+            raise ValueError("phone must contain digits")
+        # Префикс phone_key = окончание номера; '~' больше любой цифры
+        where.append("phone_key >= ? AND phone_key < ?")
+        params.extend([key, key + "~"])
+    return where, params
+
+
+def count_orders(conn, **filters):
+    where, params = _filters(**filters)
+    sql = "SELECT COUNT(*) FROM orders"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return conn.execute(sql, params).fetchone()[0]
+
+
+def query_orders(conn, limit, cursor=None, sort="-id", with_count=True, **filters):
+    """
+    Одна страница заказов (новые сверху) с позициями из order_items.
+    Возвращает {"items": [...], "next_cursor": str | None, "total": int | None};
+    total считается только для первой страницы. ValueError при неверных параметрах.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort: {sort}. Allowed: {', '.join(SORT_KEYS)}")
+    column, descending = SORT_KEYS[sort]
+    where, params = _filters(**filters)
+    total = count_orders(conn, **filters) if with_count and not cursor else None
+
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort)
+        op = "<" if descending else ">"
+        if column == "id":
+            where.append(f"id {op} ?")
+            params.append(last_id)
+        else:
+            where.append(f"({column}, id) {op} (?, ?)")
+            params.extend([value, last_id])
+
+    direction = "DESC" if descending else "ASC"
+    order_by = f"id {direction}" if column == "id" else f"{column} {direction}, id {direction}"
+    sql = f"SELECT {', '.join(PUBLIC_COLUMNS)} FROM orders"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order_by} LIMIT ?"
+    rows = [dict(row) for row in conn.execute(sql, params + [limit + 1]).fetchall()]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort, rows[-1][column], rows[-1]["id"])
+
+    items = order_items.items_by_order(conn, [row["id"] for row in rows])
+    for row in rows:
+        row["items"] = items[row["id"]]
+    return {"items": rows, "next_cursor": next_cursor, "total": total}
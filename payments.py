@@ -0,0 +1,296 @@
+"""
+Создание счетов Monobank для заказов с оплатой картой - по этапам.
+
+Заказ сохраняется сразу (payment_stage = awaiting_invoice), и только потом,
+уже без открытой транзакции, создается счет в банке. Этапы:
+
+    awaiting_invoice -> creating_invoice -> invoice_created
+                             |
+                             +-> awaiting_invoice (ошибка, повтор позже)
+                             +-> invoice_failed   (исчерпаны попытки)
+
+Заказы без онлайн-оплаты получают этап not_required.
+
+Переход в creating_invoice - это захват заказа (UPDATE ... WHERE stage =
+awaiting_invoice): счет для заказа создает только один участник - запрос
+/create_order или фоновый InvoiceReconciler, который подбирает заказы с
+неудавшимся этапом (с растущей паузой) и зависшие захваты. Повторный
+запрос клиента с тем же Idempotency-Key возвращает уже созданный заказ,
+а не новый (см. find_by_idempotency_key).
+
+В счет передается reference = id заказа, так что вебхук найдет заказ
+даже по счету, чей invoiceId не успели записать.
+"""
+import base64
+import logging
+import os
+import random
+import threading
+import time
+
+import httpx
+
+from db import pool, adb
+from http_clients import http_clients
+
+logger = logging.getLogger(__name__)
+
+MONOBANK_INVOICE_URL = "https://api.monobank.ua/api/merchant/invoice/create"
+MONOBANK_INVOICE_STATUS_URL = "https://api.monobank.ua/api/merchant/invoice/status"
+MONOBANK_PUBKEY_URL = "https://api.monobank.ua/api/merchant/pubkey"
+# Вебхук и страница возврата после оплаты по умолчанию (прежние значения).
+# MONOBANK_WEBHOOK_URL / MONOBANK_REDIRECT_URL читаются при создании счета, как
+# и токен: main загружает .env уже после импорта модуля
+DEFAULT_WEBHOOK_URL = "https://farrah-unenlightening-oversorrowfully.ngrok-free.dev/monobank-webhook"
+DEFAULT_REDIRECT_URL = "https://google.com"
+INVOICE_MAX_ATTEMPTS = int(os.getenv("INVOICE_MAX_ATTEMPTS", "8"))
+# Как часто фоновый процесс ищет заказы без счета
+RECONCILE_INTERVAL = float(os.getenv("INVOICE_RECONCILE_INTERVAL", "30"))
+# Захват creating_invoice старше этого считается зависшим (процесс упал посреди запроса)
+CLAIM_TIMEOUT = 120
+RETRY_MAX_DELAY = 1800
+
+AWAITING_INVOICE = "awaiting_invoice"
+CREATING_INVOICE = "creating_invoice"
+INVOICE_CREATED = "invoice_created"
+INVOICE_FAILED = "invoice_failed"
+NOT_REQUIRED = "not_required"
+
+ORDER_COLUMNS = {
+    "idempotency_key": "TEXT",
+    "payment_stage": "TEXT",
+    "payment_url": "TEXT",
+    "invoice_attempts": "INTEGER DEFAULT 0",
+    "invoice_error": "TEXT",
+    "invoice_next_attempt_at": "REAL DEFAULT 0",
+    "invoice_claimed_at": "REAL",
+}
+
+
+class InvoiceError(Exception):
+    """Банк не создал счет"""
+
+
+def ensure_columns(conn):
+    """Колонки этапов оплаты в orders и индексы для идемпотентности и сверки"""
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(orders)").fetchall()}
+        for name, definition in ORDER_COLUMNS.items():
+            if name not in columns:
+                conn.execute(f"ALTER TABLE orders ADD COLUMN {name} {definition}")
+                logger.info(f"✅ Добавлена колонка {name} в orders")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key ON orders (idempotency_key)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_payment_stage ON orders (payment_stage, invoice_next_attempt_at)")
+        conn.commit()
+    except Exception as e:
+        logger.error(f"⚠️ Ошибка миграции этапов оплаты orders: {e}")
+
+
+def initial_stage(payment_method):
+    return AWAITING_INVOICE if payment_method == "card" else NOT_REQUIRED
+
+
+def find_by_idempotency_key(conn, key):
+    row = conn.execute(
+        "SELECT id, payment_method, payment_stage, payment_url FROM orders WHERE idempotency_key = ?", (key,)
+    ).fetchone()
+    return dict(row) if row is not None else None
+
+
+def payment_state(conn, order_id):
+    row = conn.execute(
+        "SELECT id, status, payment_stage, payment_url, invoice_attempts, invoice_error FROM orders WHERE id = ?",
+        (order_id,),
+    ).fetchone()
+    return dict(row) if row is not None else None
+
+
+def _claim(conn, order_id, reclaim_stale=False):
+    """Переводит заказ в creating_invoice; возвращает строку заказа или None, если этап уже не наш"""
+    now = time.time()
+    stale_before = now - CLAIM_TIMEOUT if reclaim_stale else -1
+    claimed = conn.execute('''
+        UPDATE orders SET payment_stage = ?, invoice_claimed_at = ?
+        WHERE id = ? AND (payment_stage = ? OR (payment_stage = ? AND invoice_claimed_at < ?))
+    ''', (CREATING_INVOICE, now, order_id, AWAITING_INVOICE, CREATING_INVOICE, stale_before)).rowcount
+    if not claimed:
+        return None
+    return conn.execute("SELECT id, totalPrice, total FROM orders WHERE id = ?", (order_id,)).fetchone()
+
+
+def _payload(order):
+    total = order["totalPrice"] if order["totalPrice"] is not None else order["total"]
+    return {
+        # Сумма в копейках
+        "amount": int(round(float(total or 0) * 100)),
+        "ccy": 980,
+        "merchantPaymInfo": {
+            "reference": str(order["id"]),
+            "destination": "Test Purchase"
+        },
+        "redirectUrl": os.getenv("MONOBANK_REDIRECT_URL", DEFAULT_REDIRECT_URL),
+        "webHookUrl": os.getenv("MONOBANK_WEBHOOK_URL", DEFAULT_WEBHOOK_URL),
+    }
+
+
+def _parse_response(response):
+    if response.status_code != 200:
+        raise InvoiceError(f"HTTP {response.status_code}: {response.text[:300]}")
+    data = response.json()
+    if not data.get("invoiceId") or not data.get("pageUrl"):
+        raise InvoiceError(f"Unexpected response: {response.text[:300]}")
+    return data["invoiceId"], data["pageUrl"]
+
+
+def _record_success(conn, order_id, invoice_id, page_url):
+    conn.execute('''
+        UPDATE orders SET payment_stage = ?, invoiceId = ?, payment_url = ?, invoice_error = NULL,
+                          invoice_attempts = invoice_attempts + 1, invoice_claimed_at = NULL
+        WHERE id = ?
+    ''', (INVOICE_CREATED, invoice_id, page_url, order_id))
+
+
+def _record_failure(conn, order_id, error):
+    attempts = conn.execute("SELECT invoice_attempts FROM orders WHERE id = ?", (order_id,)).fetchone()[0] or 0
+    attempts += 1
+    stage = INVOICE_FAILED if attempts >= INVOICE_MAX_ATTEMPTS else AWAITING_INVOICE
+    next_at = time.time() + random.uniform(0.5, 1.0) * min(RETRY_MAX_DELAY, 15 * 2 ** attempts)
+    conn.execute('''
+        UPDATE orders SET payment_stage = ?, invoice_attempts = ?, invoice_error = ?,
+                          invoice_next_attempt_at = ?, invoice_claimed_at = NULL
+        WHERE id = ?
+    ''', (stage, attempts, str(error)[:500], next_at, order_id))
+    return stage
+
+
+def _token():
+    token = os.getenv("MONOBANK_API_TOKEN")
+    if not token:
+        raise InvoiceError("MONOBANK_API_TOKEN not configured")
+    return token
+
+
+def invoice_status(invoice_id):
+    """
+    Счет по данным банка (invoice/status): dict с invoiceId, status, reference и т.д.
+    Блокирующая - для фоновых потоков; httpx.HTTPError при ошибке запроса.
+    """
+    response = http_clients.request_blocking("monobank", "GET", MONOBANK_INVOICE_STATUS_URL,
+                                             headers={"X-Token": _token()}, params={"invoiceId": invoice_id})
+    response.raise_for_status()
+    return response.json()
+
+
+async def merchant_pubkey():
+    """Открытый ключ мерчанта (PEM) для проверки подписи вебхуков X-Sign"""
+    response = await http_clients.request("monobank", "GET", MONOBANK_PUBKEY_URL, headers={"X-Token": _token()})
+    response.raise_for_status()
+    return base64.b64decode(response.json()["key"])
+
+
+async def create_invoice(order_id):
+    """
+    Создает счет для заказа (этап awaiting_invoice) из обработчика запроса.
+    Возвращает payment_url или None, если заказ сейчас обрабатывает кто-то
+    другой. InvoiceError - если банк не создал счет (заказ вернется в
+    очередь на повтор).
+    """
+    order = await adb.write(_claim, order_id)
+    if order is None:
+        return None
+    try:
+        response = await http_clients.request("monobank", "POST", MONOBANK_INVOICE_URL,
+                                              headers={"X-Token": _token()}, json=_payload(order))
+        invoice_id, page_url = _parse_response(response)
+    except (InvoiceError, httpx.HTTPError, ValueError) as e:
+        stage = await adb.write(_record_failure, order_id, e)
+        logger.error(f"❌ Счет для заказа #{order_id} не создан ({stage}): {e}")
+        raise InvoiceError(str(e))
+    except BaseException:
+        # Отмена запроса клиентом и т.п. - отдаем заказ фоновой сверке
+        await adb.write(_record_failure, order_id, "interrupted")
+        raise
+    await adb.write(_record_success, order_id, invoice_id, page_url)
+    logger.info(f"💳 Счет {invoice_id} создан для заказа #{order_id}")
+    return page_url
+
+
+class InvoiceReconciler:
+    """Фоновый повтор этапа создания счета для заказов, где он не удался или завис"""
+
+    def __init__(self, pool, adb, interval=RECONCILE_INTERVAL):
+        self.pool = pool
+        self.adb = adb
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"runs": 0, "created": 0, "failed": 0, "last_error": None}
+
+    def _due(self):
+        now = time.time()
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT id FROM orders
+                WHERE (payment_stage = ? AND invoice_next_attempt_at <= ?)
+                   OR (payment_stage = ? AND invoice_claimed_at < ?)
+                ORDER BY id LIMIT 100
+            ''', (AWAITING_INVOICE, now, CREATING_INVOICE, now - CLAIM_TIMEOUT)).fetchall()
+        return [row[0] for row in rows]
+
+    def _process(self, order_id):
+        order = self.adb.write_blocking(_claim, order_id, True)
+        if order is None:
+            return
+        try:
+            response = http_clients.request_blocking("monobank", "POST", MONOBANK_INVOICE_URL,
+                                                     headers={"X-Token": _token()}, json=_payload(order))
+            invoice_id, page_url = _parse_response(response)
+        except Exception as e:
+            stage = self.adb.write_blocking(_record_failure, order_id, e)
+            self._stats["failed"] += 1
+            self._stats["last_error"] = str(e)
+            logger.error(f"❌ Сверка: счет для заказа #{order_id} не создан ({stage}): {e}")
+            return
+        self.adb.write_blocking(_record_success, order_id, invoice_id, page_url)
+        self._stats["created"] += 1
+        logger.info(f"💳 Сверка: счет {invoice_id} создан для заказа #{order_id}")
+
+    def run_once(self):
+        self._stats["runs"] += 1
+        for order_id in self._due():
+            if self._stop.is_set():
+                return
+            self._process(order_id)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self._stats["last_error"] = str(e)
+                logger.error(f"❌ Ошибка сверки счетов: {e}")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="invoice-reconciler", daemon=True)
+            self._thread.start()
+
+    def metrics(self):
+        try:
+            with self.pool.connection() as conn:
+                stages = dict(conn.execute(
+                    "SELECT payment_stage, COUNT(*) FROM orders WHERE payment_stage IN (?, ?, ?) GROUP BY payment_stage",
+                    (AWAITING_INVOICE, CREATING_INVOICE, INVOICE_FAILED),
+                ).fetchall())
+        except Exception:
+            stages = {}
+        return {"stages": stages, **self._stats}
+
+    def shutdown(self):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+
+reconciler = InvoiceReconciler(pool, adb)
@@ -0,0 +1,119 @@
+"""
+Бенчмарк ресайза для /image: полное декодирование + LANCZOS против
+уменьшения при декодировании JPEG (draft) + reducing_gap.
+
+Запуск из корня проекта:
+    python scripts/bench_image_resize.py                 # синтетические «фото»
+    python scripts/bench_image_resize.py uploads/*.jpg   # свои файлы
+
+Для каждой ширины печатает медианное время обоих путей, ускорение и PSNR
+быстрого результата относительно эталонного (выше 35 dB разница на глаз
+не видна).
+"""
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import images  # noqa: E402
+
+WIDTHS = [150, 300, 600, 1200]
+REPEAT = 5
+MIN_PSNR = 35.0
+
+
+def synthetic_photo(path, size=(4000, 3000), seed=0):
+    """Похожая на фото картинка: плавные градиенты, мелкие детали и шум сенсора"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([
+        127 + 100 * np.sin(x / 370 + seed) * np.cos(y / 290),
+        127 + 90 * np.sin((x + y) / 510),
+        127 + 80 * np.cos(x / 230 - y / 410),
+    ], axis=-1)
+    detail = Image.effect_mandelbrot(size, (-0.75, -0.1, -0.65, 0.0), 120).convert("RGB")
+    img = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+    img = Image.blend(img, detail.filter(ImageFilter.GaussianBlur(1.5)), 0.35)
+    noise = rng.normal(0, 6, (height, width, 3))
+    img = Image.fromarray(np.clip(np.asarray(img, dtype=np.float32) + noise, 0, 255).astype(np.uint8))
+    img.save(path, "JPEG", quality=90)
+    return path
+
+
+def reference(path, w):
+    """Прежний путь: полное декодирование и LANCZOS без промежуточного reduce"""
+    with Image.open(path) as img:
+        size = images.target_size(img.size, w, None)
+        return img.resize(size, Image.Resampling.LANCZOS)
+
+
+def fast(path, w):
+    """Текущий путь images.render_image без кодирования результата"""
+    with Image.open(path) as img:
+        size = images.target_size(img.size, w, None)
+        images.draft_for(img, size)
+        return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=images.IMAGE_REDUCING_GAP)
+
+
+def timed(fn, *args):
+    times = []
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        result = fn(*args)
+        times.append(time.perf_counter() - started)
+    return result, statistics.median(times)
+
+
+def psnr(a, b):
+    diff = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+    mse = float(np.mean(diff ** 2))
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def bench(path):
+    with Image.open(path) as img:
+        print(f"\n{os.path.basename(path)}: {img.width}x{img.height} {img.format}, {os.path.getsize(path) / 1024:.0f} KB")
+    print(f"{'width':>6} {'full, ms':>10} {'fast, ms':>10} {'speedup':>8} {'PSNR, dB':>9}")
+    worst = float("inf")
+    for w in WIDTHS:
+        ref_img, ref_time = timed(reference, path, w)
+        fast_img, fast_time = timed(fast, path, w)
+        quality = psnr(ref_img, fast_img)
+        worst = min(worst, quality)
+        print(f"{w:>6} {ref_time * 1000:>10.1f} {fast_time * 1000:>10.1f} {ref_time / fast_time:>7.1f}x {quality:>9.1f}")
+
+    # Полный путь /image с кодированием в WebP (то, что видит клиент)
+    _, ref_time = timed(lambda: _encode(reference(path, 300)))
+    _, fast_time = timed(images.render_image, path, 300, None, 85, "WEBP")
+    print(f"/image?w=300&format=webp: {ref_time * 1000:.1f} ms -> {fast_time * 1000:.1f} ms ({ref_time / fast_time:.1f}x)")
+    return worst
+
+
+def _encode(img):
+    buf = io.BytesIO()
+    img.save(buf, format="WEBP", quality=85, method=6)
+    return buf.getvalue()
+
+
+def main(paths):
+    with tempfile.TemporaryDirectory() as tmp:
+        if not paths:
+            paths = [
+                synthetic_photo(os.path.join(tmp, "photo_4000x3000.jpg")),
+                synthetic_photo(os.path.join(tmp, "photo_2400x1800.jpg"), size=(2400, 1800), seed=1),
+            ]
+        worst = min(bench(path) for path in paths)
+    print(f"\nМинимальный PSNR: {worst:.1f} dB (порог {MIN_PSNR} dB)")
+    return 0 if worst >= MIN_PSNR else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,91 @@
+"""
+Проверка: процессы пула изображений (spawn) не трогают базу.
+
+Запуск из корня проекта:
+    python scripts/check_image_workers.py
+
+spawn заново импортирует главный модуль в каждом процессе пула. Скрипт
+импортирует main на верхнем уровне, поэтому процессы пула проходят тот же
+импорт, что и при запуске python main.py. Во временной папке создается база
+с заказом, через пул готовятся варианты картинки (как в RenditionWorker), и
+проверяется, что процесс пула не открывал и не пытался открыть соединение
+SQLite, не смог бы его открыть и что заказ остался на месте. Код возврата 1 -
+если что-то не так.
+"""
+import os
+import sys
+import tempfile
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Процессы пула наследуют окружение: временная папка создается только в родителе
+if "CHECK_IMAGE_WORKERS_DIR" not in os.environ:
+    os.environ["CHECK_IMAGE_WORKERS_DIR"] = tempfile.mkdtemp(prefix="check-image-workers-")
+WORKDIR = os.environ["CHECK_IMAGE_WORKERS_DIR"]
+os.environ["DB_PATH"] = os.path.join(WORKDIR, "shop.db")
+os.chdir(WORKDIR)
+
+import main  # noqa: E402,F401
+import images  # noqa: E402
+from db import pool  # noqa: E402
+
+
+def probe():
+    """Выполняется в процессе пула: (pid, открыто соединений, отказов до проверки, удалось ли подключиться)"""
+    import db
+    metrics = db.pool.metrics()
+    try:
+        with db.pool.connection():
+            connected = True
+    except RuntimeError:
+        connected = False
+    return os.getpid(), metrics["opened_total"], metrics["refused_total"], connected
+
+
+def count_orders():
+    with pool.connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0]
+
+
+def check():
+    main.prepare_database()
+    with pool.transaction() as conn:
+        conn.execute("INSERT INTO orders (name, status) VALUES ('check', 'New')")
+
+    os.makedirs(main.UPLOADS_DIR, exist_ok=True)
+    path = os.path.join(main.UPLOADS_DIR, "check.jpg")
+    Image.effect_noise((1600, 1200), 64).convert("RGB").save(path, quality=90)
+    specs = [(width, 80, "JPEG") for width in images.RENDITION_WIDTHS]
+    try:
+        results = images.processor.run_blocking(images.render_renditions, path, specs)
+        pid, opened, refused, connected = images.processor.run_blocking(probe)
+    finally:
+        images.processor.shutdown()
+
+    problems = []
+    if len(results) != len(specs):
+        problems.append(f"варианты: {len(results)} из {len(specs)}")
+    if pid == os.getpid():
+        problems.append("пробник выполнился в основном процессе")
+    if opened:
+        problems.append(f"процесс пула {pid} открыл соединений SQLite: {opened}")
+    if refused:
+        problems.append(f"процесс пула {pid} пытался подключиться к базе при импорте: {refused} раз")
+    if connected:
+        problems.append(f"процесс пула {pid} смог подключиться к базе")
+    orders = count_orders()
+    if orders != 1:
+        problems.append(f"заказов в базе после работы пула: {orders} (ожидался 1)")
+
+    for problem in problems:
+        print(f"FAIL  {problem}")
+    if not problems:
+        print(f"OK    процесс пула {pid}: соединений 0, подключение запрещено, заказ на месте")
+    return not problems
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check() else 1)
@@ -0,0 +1,105 @@
+"""
+Полнотекстовый поиск по каталогу (SQLite FTS5).
+
+Индекс products_fts построен поверх таблицы products (external content) и
+синхронизируется триггерами, поэтому любые вставки/изменения/удаления
+товаров - из API, импортов или вручную через sqlite - сразу попадают в поиск.
+Токенайзер unicode61 приводит кириллицу (украинский/русский) к нижнему
+регистру и убирает диакритику, ранжирование - BM25.
+"""
+import logging
+import re
+
+from catalog import normalize_product, parse_fields, PRODUCT_FIELDS
+
+logger = logging.getLogger(__name__)
+
+FTS_COLUMNS = ("name", "description", "composition", "usage", "category")
+# Веса BM25 в порядке FTS_COLUMNS: совпадение в названии важнее всего
+BM25_WEIGHTS = (10.0, 1.0, 2.0, 1.0, 4.0)
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+available = True
+
+
+def ensure_search_index(conn):
+    """Создает FTS5 таблицу и триггеры; при первом создании индексирует каталог"""
+    global available
+    columns = ", ".join(FTS_COLUMNS)
+    new_values = ", ".join(f"new.{c}" for c in FTS_COLUMNS)
+    old_values = ", ".join(f"old.{c}" for c in FTS_COLUMNS)
+    try:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+        ).fetchone()
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                {columns},
+                content='products',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+                INSERT INTO products_fts(rowid, {columns}) VALUES (new.id, {new_values});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+                INSERT INTO products_fts(products_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF {columns} ON products BEGIN
+                INSERT INTO products_fts(products_fts, rowid, {columns}) VALUES ('delete', old.id, {old_values});
+                INSERT INTO products_fts(rowid, {columns}) VALUES (new.id, {new_values});
+            END
+        """)
+        if not exists:
+            conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+            logger.info("✅ Поисковый индекс products_fts построен.")
+        conn.commit()
+        available = True
+    except Exception as e:
+        available = False
+        logger.error(f"⚠️ Полнотекстовый поиск недоступен (FTS5): {e}")
+
+
+def build_match_query(text, prefix=True):
+    """
+    Превращает ввод пользователя в безопасный FTS5 запрос: каждое слово в
+    кавычках (операторы FTS не интерпретируются), все слова обязательны.
+    При prefix=True последнее слово ищется по префиксу (автодополнение).
+    """
+    tokens = _TOKEN_RE.findall(text or "")
+    if not tokens:
+        return None
+    terms = [f'"{t}"' for t in tokens]
+    if prefix:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_products(conn, text, limit=20, prefix=True, fields=None):
+    """Товары, подходящие под запрос, в порядке релевантности (BM25)"""
+    match = build_match_query(text, prefix)
+    if match is None:
+        return []
+    selected = parse_fields(fields) or list(PRODUCT_FIELDS)
+    weights = ", ".join(str(w) for w in BM25_WEIGHTS)
+    rows = conn.execute(f"""
+        SELECT p.*
+        FROM products_fts
+        JOIN products p ON p.id = products_fts.rowid
+        WHERE products_fts MATCH ?
+        ORDER BY bm25(products_fts, {weights})
+        LIMIT ?
+    """, (match, limit)).fetchall()
+    items = []
+    for row in rows:
+        item = normalize_product(row)
+        items.append({f: item.get(f) for f in selected})
+    return items
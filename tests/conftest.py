@@ -0,0 +1,77 @@
+"""
+Общие фикстуры тестов.
+
+Каждый сценарий выполняется в отдельном процессе: main при старте
+привязывает базу к процессу (pool.bind_process), а остановка приложения
+закрывает пулы и исполнители - поэтому «перезапуск сервера» в тестах
+это просто второй процесс над той же временной папкой и базой.
+"""
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESULT_MARKER = "RESULT "
+
+# Код сценария выполняется внутри with TestClient(...) - между стартом и остановкой приложения
+PRELUDE = """\
+import json
+from fastapi.testclient import TestClient
+import main
+result = {}
+with TestClient(main.app) as c:
+"""
+
+EPILOGUE = f"""
+print({RESULT_MARKER!r} + json.dumps(result))
+"""
+
+ORDER = {
+    "name": "Тест",
+    "phone": "+380671234567",
+    "city": "Київ",
+    "cityRef": "city-ref",
+    "warehouse": "Відділення №1",
+    "warehouseRef": "warehouse-ref",
+    "items": [{"id": 1, "name": "Омега-3", "price": 250, "quantity": 2}],
+    "totalPrice": 500,
+    "payment_method": "cash",
+}
+
+
+@pytest.fixture
+def run_app(tmp_path):
+    """
+    Запускает сервер в новом процессе (рабочая папка и база - tmp_path) и
+    выполняет в нем код сценария: c - TestClient, ORDER - тело заказа,
+    в result кладется то, что вернуть тесту. Возвращает result.
+    """
+    def run(code, **env):
+        script = (
+            PRELUDE
+            + f"    ORDER = {ORDER!r}\n"
+            + textwrap.indent(textwrap.dedent(code), "    ")
+            + EPILOGUE
+        )
+        environ = {
+            **os.environ,
+            "DB_PATH": str(tmp_path / "shop.db"),
+            "PYTHONPATH": ROOT,
+            "ENVIRONMENT": "production",
+            **env,
+        }
+        environ.pop("DB_OWNER_PID", None)
+        proc = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=tmp_path, env=environ, capture_output=True, text=True, timeout=120,
+        )
+        assert proc.returncode == 0, proc.stderr[-4000:]
+        lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+        assert lines, proc.stdout[-2000:] + proc.stderr[-2000:]
+        return json.loads(lines[-1][len(RESULT_MARKER):])
+    return run
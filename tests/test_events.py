@@ -0,0 +1,18 @@
+"""Лента изменений заказов (/api/orders/changes)"""
+
+
+def test_change_of_deleted_order_has_no_order(run_app):
+    result = run_app("""
+        kept = c.post("/create_order", json=ORDER).json()["order_id"]
+        deleted = c.post("/create_order", json=ORDER).json()["order_id"]
+        c.delete(f"/orders/{deleted}")
+        result["kept"], result["deleted"] = kept, deleted
+        result["changes"] = c.get("/api/orders/changes", params={"since": 0, "timeout": 0}).json()["changes"]
+    """)
+
+    changes = {change["order_id"]: change for change in result["changes"]}
+    assert set(changes) == {result["kept"], result["deleted"]}
+    assert changes[result["deleted"]]["order"] is None
+    assert changes[result["deleted"]]["kind"] == "created"
+    assert changes[result["kept"]]["order"]["id"] == result["kept"]
+    assert changes[result["kept"]]["order"]["name"] == "Тест"
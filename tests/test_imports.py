@@ -0,0 +1,60 @@
+"""Прерванный пачечный импорт не оставляет устаревший снимок каталога"""
+
+
+def test_partial_xml_import_invalidates_catalog(run_app):
+    result = run_app("""
+        import importers
+        before = c.get("/products")
+        result["before_status"] = before.status_code
+        result["before_count"] = len(before.json())
+        result["chunk_size"] = importers.IMPORT_CHUNK_SIZE
+        etag = before.headers["ETag"]
+
+        # Больше одной пачки товаров, затем битый XML: первая пачка уже записана
+        offers = "".join(
+            f"<offer id='sku-{i}'><name>Товар {i}</name><price>{100 + i}</price></offer>"
+            for i in range(importers.IMPORT_CHUNK_SIZE + 10)
+        )
+        feed = f"<yml_catalog><shop><offers>{offers}<offer id='broken'><name>Битый".encode()
+        response = c.post("/upload_xml", files={"file": ("feed.xml", feed, "text/xml")},
+                          data={"mode": "upsert"}, follow_redirects=False)
+        result["import_status"] = response.status_code
+        result["import_message"] = response.text
+
+        after = c.get("/products", headers={"If-None-Match": etag})
+        result["after_status"] = after.status_code
+        result["after_count"] = len(after.json())
+        result["etag_changed"] = after.headers["ETag"] != etag
+    """)
+
+    assert result["before_status"] == 200
+    assert result["import_status"] == 400
+    assert "Импорт прерван" in result["import_message"]
+    # Записанная пачка видна сразу: новый ETag, а не 304 со старым снимком
+    assert result["after_status"] == 200
+    assert result["etag_changed"]
+    assert result["after_count"] == result["before_count"] + result["chunk_size"]
+
+
+def test_partial_csv_import_invalidates_catalog(run_app):
+    result = run_app("""
+        import importers
+        etag = c.get("/products").headers["ETag"]
+
+        # Первая пачка pandas уже разобрана и записана, во второй - незакрытая кавычка
+        rows = "".join(f"Товар {i},{100 + i},sku-{i}\\n" for i in range(importers.CSV_CHUNK_SIZE + 5))
+        price = f"name,price,sku\\n{rows}Битый,\\"100,sku-broken\\n".encode()
+        response = c.post("/upload_csv", files={"file": ("price.csv", price, "text/csv")}, data={"mode": "upsert"})
+        result["import_status"] = response.status_code
+        result["import_detail"] = response.json()["detail"]
+
+        after = c.get("/products", headers={"If-None-Match": etag})
+        result["after_status"] = after.status_code
+        result["after_count"] = len(after.json())
+        result["chunk_size"] = importers.CSV_CHUNK_SIZE
+    """)
+
+    assert result["import_status"] == 400
+    assert "Импорт прерван" in result["import_detail"]
+    assert result["after_status"] == 200
+    assert result["after_count"] >= result["chunk_size"]
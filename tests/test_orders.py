@@ -0,0 +1,51 @@
+"""Заказы переживают перезапуск сервера"""
+
+
+def test_orders_survive_restart(run_app):
+    first = run_app("""
+        result["order_id"] = c.post("/create_order", json=ORDER).json()["order_id"]
+    """)
+
+    second = run_app("""
+        orders = c.get("/api/orders").json()
+        result["ids"] = [order["id"] for order in orders["items"]]
+        result["total"] = orders["total"]
+        result["sales"] = c.get("/api/stats/products").json()
+        result["new_id"] = c.post("/create_order", json=ORDER).json()["order_id"]
+    """)
+
+    assert second["ids"] == [first["order_id"]]
+    assert second["total"] == 1
+    # Позиции заказа (order_items) не удалены каскадом вместе с заказом
+    assert [(row["product_id"], row["quantity"]) for row in second["sales"]] == [(1, 2)]
+    # AUTOINCREMENT не сброшен: новый заказ не получает номер старого
+    assert second["new_id"] > first["order_id"]
+
+
+def test_reset_orders_on_start_is_opt_in(run_app):
+    run_app("""
+        c.post("/create_order", json=ORDER)
+    """)
+
+    kept = run_app("""
+        result["total"] = c.get("/api/orders").json()["total"]
+    """)
+    reset = run_app("""
+        result["total"] = c.get("/api/orders").json()["total"]
+    """, RESET_ORDERS_ON_START="1")
+
+    assert kept["total"] == 1
+    assert reset["total"] == 0
+
+
+def test_order_list_hides_internal_columns(run_app):
+    result = run_app("""
+        import orders
+        c.post("/create_order", json=ORDER, headers={"Idempotency-Key": "key-1"})
+        result["order"] = c.get("/api/orders").json()["items"][0]
+        result["columns"] = list(orders.PUBLIC_COLUMNS)
+    """)
+
+    assert set(result["order"]) == set(result["columns"]) | {"items"}
+    assert "idempotency_key" not in result["order"]
+    assert result["order"]["items"][0]["quantity"] == 2
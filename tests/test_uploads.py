@@ -0,0 +1,22 @@
+"""Загрузка картинок (POST /upload)"""
+
+
+def test_oversized_upload_rejected_by_content_length(run_app, tmp_path):
+    staging = tmp_path / "staging"
+    result = run_app("""
+        import io
+        from PIL import Image
+        buf = io.BytesIO()
+        Image.new("RGB", (8, 8), "red").save(buf, "PNG")
+        small = c.post("/upload", files={"file": ("small.png", buf.getvalue(), "image/png")})
+        result["small"] = small.status_code
+
+        big = c.post("/upload", files={"file": ("big.png", b"\\x89PNG\\r\\n\\x1a\\n" + bytes(300_000), "image/png")})
+        result["big"] = big.status_code
+        result["detail"] = big.json()["detail"]
+    """, UPLOAD_MAX_BYTES="100000", UPLOAD_STAGING_DIR=str(staging))
+
+    assert result["small"] == 200
+    assert result["big"] == 413
+    assert "File too large" in result["detail"]
+    assert list(staging.iterdir()) == []
@@ -0,0 +1,200 @@
+"""
+Потоковое сохранение загружаемых картинок (POST /upload).
+
+Starlette разбирает multipart целиком до вызова обработчика: тело формы
+спулится во временный файл (SpooledTemporaryFile, в память - только первые
+мегабайты). Поэтому запрос с заведомо большим телом отклоняется раньше, по
+Content-Length (UploadSizeLimit, 413 без чтения тела). Тело без
+Content-Length (chunked) спулится полностью, и лимит проверяется уже в
+save_image_upload.
+
+Обработчик переписывает файл по частям (UPLOAD_CHUNK_SIZE) во временный
+файл в UPLOAD_STAGING_DIR - вне раздаваемого /uploads, так что
+непроверенное содержимое не доступно по ссылке. Лимит размера файла
+проверяется по ходу копирования: файл больше лимита не попадает в staging
+дальше первого лишнего чанка. Тип определяется по сигнатуре (magic bytes) первого чанка,
+размеры картинки - по заголовку (Pillow открывает файл лениво, пиксели не
+декодируются), так что «бомба» из огромного холста отклоняется без
+распаковки. Только проверенный файл переносится в uploads атомарно
+(os.replace; staging должен быть на той же файловой системе, иначе файл
+копируется рядом с целью и уже потом переименовывается), и /uploads
+никогда не отдает недописанный или непроверенный файл.
+
+Все дисковые операции выполняются в потоках, event loop не блокируется.
+"""
+import asyncio
+import errno
+import logging
+import os
+import shutil
+import tempfile
+
+from PIL import Image as PILImage
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+# Ограничение по числу пикселей и по стороне (проверяется по заголовку)
+UPLOAD_MAX_PIXELS = int(os.getenv("UPLOAD_MAX_PIXELS", str(50_000_000)))
+UPLOAD_MAX_SIDE = int(os.getenv("UPLOAD_MAX_SIDE", "12000"))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Запас на заголовки и границы multipart сверх размера файла (проверка Content-Length)
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+# Каталог для недописанных и непроверенных загрузок (не раздается сервером)
+UPLOAD_STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR", os.path.join(tempfile.gettempdir(), "vitastore-uploads"))
+
+ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+# Формат по расширению и расширение по умолчанию для формата
+EXTENSION_FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG", ".gif": "GIF", ".webp": "WEBP"}
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp"}
+
+
+class InvalidUpload(ValueError):
+    """Загрузка отклонена (размер, тип или размеры картинки)"""
+
+
+class UploadSizeLimit:
+    """
+    ASGI middleware: POST на paths с Content-Length больше
+    max_bytes + UPLOAD_FORM_OVERHEAD сразу получает 413 - до того, как
+    Starlette начнет читать и спулить тело формы.
+    """
+
+    def __init__(self, app, paths=("/upload",), max_bytes=UPLOAD_MAX_BYTES):
+        self.app = app
+        self.paths = set(paths)
+        self.limit = max_bytes + UPLOAD_FORM_OVERHEAD
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in self.paths:
+            length = dict(scope["headers"]).get(b"content-length")
+            if length is not None and length.isdigit() and int(length) > self.limit:
+                logger.warning(f"⚠️ Загрузка отклонена по Content-Length: {int(length) / (1024 * 1024):.1f} MB")
+                response = JSONResponse(status_code=413, content={
+                    "detail": f"File too large. Maximum size: {self.max_bytes / (1024 * 1024):.1f} MB"
+                })
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+def sniff_format(head):
+    """Формат картинки по первым байтам файла или None"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "GIF"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def read_dimensions(path):
+    """Формат и размеры из заголовка файла (без декодирования пикселей)"""
+    try:
+        with PILImage.open(path) as img:
+            return img.format, img.width, img.height
+    except PILImage.DecompressionBombError:
+        raise InvalidUpload("Image dimensions exceed the limit")
+    except Exception:
+        raise InvalidUpload("File is not a valid image")
+
+
+def check_dimensions(path, expected_format):
+    image_format, width, height = read_dimensions(path)
+    if image_format != expected_format:
+        raise InvalidUpload("File content does not match its image format")
+    if width <= 0 or height <= 0:
+        raise InvalidUpload("Image has invalid dimensions")
+    if width > UPLOAD_MAX_SIDE or height > UPLOAD_MAX_SIDE or width * height > UPLOAD_MAX_PIXELS:
+        raise InvalidUpload(
+            f"Image dimensions {width}x{height} exceed the limit "
+            f"({UPLOAD_MAX_SIDE}px per side, {UPLOAD_MAX_PIXELS / 1_000_000:.0f} MP)"
+        )
+    return width, height
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _stage_file(staging_dir):
+    os.makedirs(staging_dir, mode=0o700, exist_ok=True)
+    return tempfile.mkstemp(dir=staging_dir, prefix="upload-", suffix=".part")
+
+
+def _publish(tmp_path, path):
+    """Переносит проверенный файл из staging на место"""
+    try:
+        os.replace(tmp_path, path)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    # staging на другой файловой системе: копия рядом с целью, затем атомарная замена
+    fd, part = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".upload-", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as dst, open(tmp_path, "rb") as src:
+            shutil.copyfileobj(src, dst)
+        os.replace(part, path)
+    except BaseException:
+        _remove(part)
+        raise
+    _remove(tmp_path)
+
+
+async def save_image_upload(upload, directory, basename, extension, max_bytes=UPLOAD_MAX_BYTES,
+                            staging_dir=UPLOAD_STAGING_DIR):
+    """
+    Потоково сохраняет UploadFile в directory/<basename><ext>.
+
+    Расширение берется по фактическому формату (если клиент прислал PNG
+    под именем .jpg, файл сохранится как .png - от расширения зависит
+    формат вариантов /image). Возвращает dict: filename, path, size,
+    format, width, height. Ошибки проверки - InvalidUpload.
+    """
+    fd, tmp_path = await asyncio.to_thread(_stage_file, staging_dir)
+    tmp = os.fdopen(fd, "wb")
+    try:
+        size = 0
+        image_format = None
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if image_format is None:
+                # Сигнатура проверяется до того, как на диск попадет остальное
+                image_format = sniff_format(chunk[:16])
+                if image_format is None:
+                    raise InvalidUpload("File content is not a supported image (JPEG, PNG, GIF, WebP)")
+            size += len(chunk)
+            if size > max_bytes:
+                raise InvalidUpload(f"File too large. Maximum size: {max_bytes / (1024 * 1024):.1f} MB")
+            await asyncio.to_thread(tmp.write, chunk)
+        await asyncio.to_thread(tmp.close)
+
+        if size == 0:
+            raise InvalidUpload("File is empty")
+
+        width, height = await asyncio.to_thread(check_dimensions, tmp_path, image_format)
+
+        if EXTENSION_FORMATS.get(extension) != image_format:
+            logger.warning(f"⚠️ Расширение {extension} не совпадает с форматом {image_format}, файл сохранен как {FORMAT_EXTENSIONS[image_format]}")
+            extension = FORMAT_EXTENSIONS[image_format]
+        filename = f"{basename}{extension}"
+        path = os.path.join(directory, filename)
+        await asyncio.to_thread(_publish, tmp_path, path)
+    except BaseException:
+        tmp.close()
+        await asyncio.shield(asyncio.to_thread(_remove, tmp_path))
+        raise
+
+    return {"filename": filename, "path": path, "size": size,
+            "format": image_format, "width": width, "height": height}
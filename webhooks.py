@@ -0,0 +1,468 @@
+"""
+Вебхуки Monobank: прием, дедупликация и фоновая обработка.
+
+Обработчик /monobank-webhook проверяет подпись X-Sign (ECDSA открытым ключом
+мерчанта), только сохраняет уведомление в таблицу webhook_events и сразу
+отвечает банку 200 - ни поиска заказа, ни уведомлений в Telegram на пути
+ответа. Неподписанное или подделанное уведомление отклоняется (403) и не
+сохраняется. Всплеск вебхуков на распродаже
+записывается групповыми коммитами: пока идет запись одной пачки, новые
+уведомления копятся в буфере и уходят следующей одной транзакцией, так что
+время ответа не растет с числом одновременных вебхуков.
+
+Повтор уведомления банком (тот же invoiceId, статус и modifiedDate) не
+создает второе событие - event_key уникален. Ответ 500 банк получает только
+если уведомление не удалось сохранить, тогда он пришлет его снова.
+
+Фоновый поток забирает события пачками и применяет переходы статуса
+счета (hold, success, failure/expired, reversed) в одной транзакции на
+пачку: заказ ищется по уникальному индексу orders.invoiceId (или по
+reference = id заказа, если это заказ с оплатой картой, счет которого еще
+создается, а банк через invoice/status подтвердил, что счет выставлен именно
+для него - только тогда invoiceId записывается в заказ), устаревшие по
+modifiedDate уведомления
+пропускаются, уведомление в Telegram и запись в ленту изменений
+(events.order_changes) ставятся вместе с изменением заказа.
+"""
+import asyncio
+import base64
+import html
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from db import pool, adb
+from events import order_changes
+import events
+from notifications import outbox
+import payments
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_BATCH = 100
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "10"))
+# Сколько хранить обработанные события (защита от повторов банка)
+WEBHOOK_RETENTION_DAYS = int(os.getenv("WEBHOOK_RETENTION_DAYS", "30"))
+RETRY_MAX_DELAY = 600
+# Ключ для проверки X-Sign перечитывается при несовпадении подписи не чаще этого
+PUBKEY_REFRESH_INTERVAL = 300
+
+PENDING, PROCESSED, IGNORED, FAILED = "pending", "processed", "ignored", "failed"
+
+ORDER_COLUMNS = {
+    # Последний примененный статус счета Monobank и его modifiedDate (unix time)
+    "payment_status": "TEXT",
+    "payment_status_at": "REAL",
+}
+
+# Статус счета -> статус заказа (None - статус заказа не меняется)
+ORDER_STATUSES = {
+    "hold": None,
+    "success": "Paid",
+    "failure": "PaymentFailed",
+    "expired": "PaymentFailed",
+    "reversed": "Refunded",
+}
+# Статусы заказа, которые еще можно менять по вебхуку; выставленные в админке
+# (Отправлен, Доставлен и т.п.) не перетираются - о событии придет уведомление
+PAYMENT_PHASE_STATUSES = ("New", "Pending", "Новый", "Paid", "PaymentFailed", "Refunded")
+
+NOTIFICATIONS = {
+    "hold": "🔒 <b>СРЕДСТВА ЗАБЛОКИРОВАНЫ (hold)</b>",
+    "success": "✅ <b>ОПЛАТА ПРОШЛА!</b>",
+    "failure": "❌ <b>ОПЛАТА НЕ ПРОШЛА</b>",
+    "expired": "⌛ <b>СЧЕТ ИСТЕК</b>",
+    "reversed": "↩️ <b>ВОЗВРАТ ОПЛАТЫ</b>",
+}
+
+
+class SignatureError(Exception):
+    """Подпись X-Sign не прошла проверку"""
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _timestamp(value):
+    """modifiedDate Monobank (ISO 8601, '...Z') -> unix time или None"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+def parse_event(payload):
+    """Тело вебхука -> строка webhook_events; ValueError, если это не уведомление о счете"""
+    if not isinstance(payload, dict) or not payload.get("invoiceId") or not payload.get("status"):
+        raise ValueError("invoiceId and status are required")
+    invoice_id = str(payload["invoiceId"])
+    status = str(payload["status"])
+    modified = payload.get("modifiedDate") or ""
+    return {
+        "event_key": f"{invoice_id}:{status}:{modified}",
+        "invoice_id": invoice_id,
+        "status": status,
+        "reference": str(payload.get("reference") or ""),
+        "modified_at": _timestamp(modified),
+        "payload": json.dumps(payload, ensure_ascii=False),
+    }
+
+
+def _find_order(conn, invoice_id, reference, confirmed):
+    row = conn.execute(
+        "SELECT id, name, user_email, total, status, payment_stage, payment_status, payment_status_at "
+        "FROM orders WHERE invoiceId = ?", (invoice_id,)
+    ).fetchone()
+    if row is None and reference.isdigit():
+        # Счет создан, но invoiceId не успели записать - ищем по reference (id заказа),
+        # но только заказ с оплатой картой, для которого счет еще создается, и только
+        # если банк подтвердил, что счет выставлен для этого заказа (confirmed)
+        bank_reference = confirmed.get(invoice_id)
+        if isinstance(bank_reference, Exception):
+            # invoice/status недоступен - событие повторится позже
+            raise bank_reference
+        if bank_reference != reference:
+            return None
+        row = conn.execute(
+            "SELECT id, name, user_email, total, status, payment_stage, payment_status, payment_status_at "
+            "FROM orders WHERE id = ? AND invoiceId IS NULL AND payment_method = 'card' "
+            "AND payment_stage IN (?, ?)",
+            (int(reference), payments.CREATING_INVOICE, payments.AWAITING_INVOICE),
+        ).fetchone()
+    return row
+
+
+def _notification(order, event):
+    failure = json.loads(event["payload"]).get("failureReason")
+    msg = (f"{NOTIFICATIONS.get(event['status'], html.escape(event['status']))}\n\n"
+           f"💰 Сумма: {order['total']} грн\n"
+           f"👤 Клиент: {html.escape(str(order['name'] or order['user_email'] or '-'))}\n"
+           f"📦 Заказ #{order['id']}")
+    if failure:
+        msg += f"\n⚠️ Причина: {html.escape(str(failure))}"
+    return msg
+
+
+def apply_event(conn, event, confirmed=None):
+    """
+    Применяет событие к заказу в текущей транзакции; (состояние события, пояснение).
+    confirmed - {invoiceId: reference по данным банка} для счетов, еще не записанных
+    в заказы (см. WebhookInbox._confirm_invoices)
+    """
+    if event["status"] not in ORDER_STATUSES:
+        # created / processing - промежуточные статусы, заказ не меняют
+        return IGNORED, f"status {event['status']} not tracked"
+    order = _find_order(conn, event["invoice_id"], event["reference"], confirmed or {})
+    if order is None:
+        return IGNORED, "order not found"
+    last_at = order["payment_status_at"]
+    if last_at is not None and event["modified_at"] is not None and event["modified_at"] < last_at:
+        return IGNORED, "stale"
+
+    order_status = ORDER_STATUSES[event["status"]]
+    if order_status is not None and order_status != order["status"] and (
+            order["status"] is None or order["status"] in PAYMENT_PHASE_STATUSES):
+        conn.execute("UPDATE orders SET status = ? WHERE id = ?", (order_status, order["id"]))
+        order_changes.record(conn, order["id"], events.STATUS, order_status)
+    conn.execute(
+        "UPDATE orders SET invoiceId = ?, payment_status = ?, payment_status_at = ? WHERE id = ?",
+        (event["invoice_id"], event["status"], event["modified_at"], order["id"]),
+    )
+    if order["payment_stage"] in (payments.AWAITING_INVOICE, payments.INVOICE_FAILED):
+        # Счет в банке есть (ответ на создание потерялся) - второй создавать не нужно
+        conn.execute("UPDATE orders SET payment_stage = ? WHERE id = ?", (payments.INVOICE_CREATED, order["id"]))
+    if order["payment_status"] != event["status"]:
+        outbox.enqueue(conn, "payment", _notification(order, event))
+    return PROCESSED, f"order #{order['id']}"
+
+
+def _verify(key, body, signature):
+    try:
+        key.verify(signature, body, ec.ECDSA(hashes.SHA256()))
+        return True
+    except InvalidSignature:
+        return False
+
+
+class MonobankSignature:
+    """
+    Проверка X-Sign: ECDSA-подпись (SHA-256) тела вебхука. Открытый ключ
+    мерчанта берется из /api/merchant/pubkey и кэшируется; если подпись не
+    сошлась, ключ перечитывается (банк мог его сменить), но не чаще
+    PUBKEY_REFRESH_INTERVAL, чтобы поток поддельных запросов не превращался
+    в запросы к банку.
+    """
+
+    def __init__(self):
+        self._key = None
+        self._fetched_at = 0.0
+        self._stats = {"verified": 0, "rejected": 0, "key_fetches": 0}
+
+    async def _public_key(self, refresh=False):
+        if self._key is None or (refresh and time.time() - self._fetched_at >= PUBKEY_REFRESH_INTERVAL):
+            self._key = serialization.load_pem_public_key(await payments.merchant_pubkey())
+            self._fetched_at = time.time()
+            self._stats["key_fetches"] += 1
+        return self._key
+
+    async def verify(self, body, x_sign):
+        """True, если x_sign (base64 из заголовка X-Sign) - подпись body; ошибки получения ключа пробрасываются"""
+        try:
+            signature = base64.b64decode(x_sign or "", validate=True)
+        except ValueError:
+            signature = b""
+        valid = False
+        if signature:
+            key = await self._public_key()
+            valid = _verify(key, body, signature)
+            if not valid:
+                fresh = await self._public_key(refresh=True)
+                valid = fresh is not key and _verify(fresh, body, signature)
+        self._stats["verified" if valid else "rejected"] += 1
+        return valid
+
+    def metrics(self):
+        return {"key_loaded": self._key is not None, **self._stats}
+
+
+class WebhookInbox:
+    def __init__(self, pool, adb, signature):
+        self.pool = pool
+        self.adb = adb
+        self.signature = signature
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        # Групповой коммит приема: [(событие, future)] и задача, которая их пишет
+        self._buffer = []
+        self._flusher = None
+        self._stats = {"received": 0, "duplicates": 0, "flushes": 0, "processed": 0, "ignored": 0,
+                       "failed": 0, "retries": 0, "confirmations": 0, "last_error": None}
+
+    def ensure_tables(self, conn):
+        """Таблица событий, колонки статуса счета и индекс orders.invoiceId"""
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS webhook_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event_key TEXT NOT NULL UNIQUE,
+                    invoice_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    reference TEXT,
+                    modified_at REAL,
+                    payload TEXT,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    result TEXT,
+                    received_at TEXT,
+                    processed_at TEXT
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_pending ON webhook_events (state, next_attempt_at)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(orders)").fetchall()}
+            for name, definition in ORDER_COLUMNS.items():
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE orders ADD COLUMN {name} {definition}")
+                    logger.info(f"✅ Добавлена колонка {name} в orders")
+            cutoff = (datetime.now() - timedelta(days=WEBHOOK_RETENTION_DAYS)).isoformat(timespec="seconds")
+            conn.execute("DELETE FROM webhook_events WHERE state != ? AND received_at < ?", (PENDING, cutoff))
+            conn.commit()
+            logger.info("✅ Таблица webhook_events готова.")
+        except Exception as e:
+            logger.error(f"⚠️ Ошибка создания таблицы webhook_events: {e}")
+        try:
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_invoice_id ON orders (invoiceId)")
+            conn.commit()
+        except Exception as e:
+            # В старых данных есть дубли invoiceId - хотя бы обычный индекс для поиска
+            logger.error(f"⚠️ Уникальный индекс orders.invoiceId не создан: {e}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_invoice_id_lookup ON orders (invoiceId)")
+            conn.commit()
+
+    # --- Прием ---
+
+    async def receive(self, body, x_sign):
+        """
+        Проверяет подпись и сохраняет уведомление банка (групповым коммитом с
+        соседними запросами). Возвращает (событие, True - новое / False - повтор).
+        SignatureError - подпись неверна; ValueError - тело не похоже на
+        уведомление о счете; ошибки базы и получения ключа пробрасываются.
+        """
+        if not await self.signature.verify(body, x_sign):
+            raise SignatureError("X-Sign verification failed")
+        event = parse_event(json.loads(body))
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._buffer.append((event, future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush())
+        return event, await future
+
+    async def _flush(self):
+        while self._buffer:
+            batch, self._buffer = self._buffer, []
+            try:
+                inserted = await self.adb.write(self._insert, [event for event, _ in batch])
+            except Exception as e:
+                logger.error(f"❌ Вебхуки не сохранены ({len(batch)}): {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self._stats["flushes"] += 1
+            for (_, future), is_new in zip(batch, inserted):
+                self._stats["received" if is_new else "duplicates"] += 1
+                if not future.done():
+                    future.set_result(is_new)
+
+    def _insert(self, conn, batch):
+        received_at = _now()
+        inserted = [
+            conn.execute('''
+                INSERT OR IGNORE INTO webhook_events
+                    (event_key, invoice_id, status, reference, modified_at, payload, received_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (event["event_key"], event["invoice_id"], event["status"], event["reference"],
+                  event["modified_at"], event["payload"], received_at)).rowcount == 1
+            for event in batch
+        ]
+        if any(inserted):
+            self.pool.after_commit(self.wake)
+        return inserted
+
+    # --- Обработка ---
+
+    def wake(self):
+        """Будит поток обработки (и запускает его, если он еще не работает)"""
+        self.start()
+        self._wake.set()
+
+    def start(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._loop, name="webhook-inbox", daemon=True)
+                self._thread.start()
+
+    def _due(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT * FROM webhook_events
+                WHERE state = ? AND next_attempt_at <= ?
+                ORDER BY id LIMIT ?
+            ''', (PENDING, time.time(), WEBHOOK_BATCH)).fetchall()
+            next_at = None
+            if not rows:
+                next_at = conn.execute(
+                    "SELECT MIN(next_attempt_at) FROM webhook_events WHERE state = ?", (PENDING,)
+                ).fetchone()[0]
+        return [dict(row) for row in rows], next_at
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                rows, next_at = self._due()
+            except Exception as e:
+                logger.error(f"❌ Очередь вебхуков недоступна: {e}")
+                rows, next_at = [], time.time() + 30
+            if not rows:
+                timeout = None if next_at is None else max(0.0, next_at - time.time())
+                self._wake.wait(timeout)
+                self._wake.clear()
+                continue
+            try:
+                # Запросы к банку - до транзакции, не держа поток-писатель
+                confirmed = self._confirm_invoices(rows)
+                self.adb.write_blocking(self._process_batch, rows, confirmed)
+            except Exception as e:
+                self._stats["last_error"] = str(e)
+                logger.error(f"❌ Ошибка обработки вебхуков: {e}")
+                self._stop.wait(5)
+
+    def _confirm_invoices(self, rows):
+        """
+        {invoiceId: reference по данным банка (invoice/status)} для событий, чей
+        счет еще не записан ни в один заказ: привязать счет к заказу по reference
+        можно только после подтверждения банком. Ошибка запроса сохраняется
+        вместо reference - такое событие будет повторено позже.
+        """
+        unknown = {row["invoice_id"] for row in rows
+                   if row["status"] in ORDER_STATUSES and (row["reference"] or "").isdigit()}
+        if not unknown:
+            return {}
+        with self.pool.connection() as conn:
+            known = {row[0] for row in conn.execute(
+                f"SELECT invoiceId FROM orders WHERE invoiceId IN ({','.join('?' * len(unknown))})", list(unknown)
+            ).fetchall()}
+        confirmed = {}
+        for invoice_id in unknown - known:
+            try:
+                invoice = payments.invoice_status(invoice_id)
+                if str(invoice.get("invoiceId")) == invoice_id:
+                    confirmed[invoice_id] = str(invoice.get("reference") or "")
+                self._stats["confirmations"] += 1
+            except Exception as e:
+                confirmed[invoice_id] = e
+                logger.error(f"❌ Не удалось проверить счет {invoice_id} в банке: {e}")
+        return confirmed
+
+    def _process_batch(self, conn, rows, confirmed=None):
+        """Вся пачка - одна транзакция; ошибка одного события откатывает только его (SAVEPOINT)"""
+        now = _now()
+        for event in rows:
+            conn.execute("SAVEPOINT webhook_event")
+            try:
+                state, result = apply_event(conn, event, confirmed)
+            except Exception as e:
+                conn.execute("ROLLBACK TO webhook_event")
+                attempts = event["attempts"] + 1
+                state, result = (FAILED if attempts >= WEBHOOK_MAX_ATTEMPTS else PENDING), f"{type(e).__name__}: {e}"
+                next_at = time.time() + random.uniform(0.5, 1.0) * min(RETRY_MAX_DELAY, 5 * 2 ** attempts)
+                conn.execute(
+                    "UPDATE webhook_events SET state = ?, attempts = ?, next_attempt_at = ?, result = ? WHERE id = ?",
+                    (state, attempts, next_at, result[:500], event["id"]),
+                )
+                self._stats["failed" if state == FAILED else "retries"] += 1
+                self._stats["last_error"] = result
+                logger.error(f"❌ Вебхук {event['invoice_id']} ({event['status']}) не обработан: {result}")
+            else:
+                conn.execute(
+                    "UPDATE webhook_events SET state = ?, result = ?, processed_at = ? WHERE id = ?",
+                    (state, result, now, event["id"]),
+                )
+                self._stats["processed" if state == PROCESSED else "ignored"] += 1
+                logger.info(f"🔔 Вебхук {event['invoice_id']}: {event['status']} -> {result}")
+            conn.execute("RELEASE webhook_event")
+
+    def metrics(self):
+        try:
+            with self.pool.connection() as conn:
+                pending = conn.execute(
+                    "SELECT COUNT(*) FROM webhook_events WHERE state = ?", (PENDING,)
+                ).fetchone()[0]
+        except Exception:
+            pending = None
+        return {"pending": pending, "buffered": len(self._buffer), **self._stats,
+                "signatures": self.signature.metrics()}
+
+    def shutdown(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=5)
+
+
+inbox = WebhookInbox(pool, adb, MonobankSignature())